@@ -35,6 +35,9 @@ import jnius_config
 from capreolus.utils.common import Anserini
 
 jnius_config.set_classpath(Anserini.get_fat_jar())
+_helper_classpath = Anserini.get_helper_classpath(constants["CACHE_BASE_PATH"])
+if _helper_classpath:
+    jnius_config.add_classpath(_helper_classpath)
 
 
 ### convenience imports
@@ -1,12 +1,20 @@
+import hashlib
+import json
+import multiprocessing
 import os
 
 import numpy as np
 import pytrec_eval
 
+from capreolus import constants
 from capreolus.searcher import Searcher
+from capreolus.searcher.gridrun import GRID_SUFFIX, GridRun
 from capreolus.utils.loginit import get_logger
+from capreolus.utils.metrics import evaluate_columns, evaluate_dense, is_supported, judged_at, max_cutoff, top_candidates
+from capreolus.utils.trec import SIDECAR_DIR, load_trec_run_columns
 
 logger = get_logger(__name__)
+MAX_THREADS = constants["MAX_THREADS"]
 
 DEFAULT_METRICS = [
     "P_1",
@@ -26,26 +34,31 @@ DEFAULT_METRICS = [
 ]
 
 
-def judged(qrels, runs, n):
-    scores = []
+def judged_by_cutoff(qrels, runs, cutoffs):
+    """ Return a dict mapping each qid in both ``runs`` and ``qrels`` to an array of its judged@k for each k in ``cutoffs`` """
+    scores = {}
     for q, rundocs in runs.items():
         if q not in qrels:
             logger.error(f"{q} in run files cannot be found in qrels")
             continue
 
-        if len(rundocs) == 0:
-            scores.append(0)
-            continue
+        docids = list(rundocs)
+        scores[q] = judged_at(qrels[q], docids, np.fromiter(rundocs.values(), dtype=np.float64, count=len(docids)), cutoffs)
+
+    return scores
 
-        topn = sorted(rundocs.keys(), key=rundocs.get, reverse=True)[:n]
-        score = sum(docid in qrels[q] for docid in topn) / len(topn)
-        scores.append(score)
 
-    return sum(scores) / len(scores)
+def judged(qrels, runs, n):
+    return np.mean([scores[0] for scores in judged_by_cutoff(qrels, runs, [n]).values()])
 
 
 def _eval_runs(runs, qrels, metrics, dev_qids, relevance_level):
     assert isinstance(metrics, list)
+    if all(is_supported(metric) for metric in metrics):
+        dev_qrels = {qid: labels for qid, labels in qrels.items() if qid in dev_qids}
+        _, scores = RunEvaluator(dev_qrels, metrics, relevance_level).evaluate(runs)
+        return dict(zip(metrics, scores.mean(axis=0).tolist()))
+
     calc_judged = [int(metric.split("_")[1]) for metric in metrics if metric.startswith("judged_")]
     for n in calc_judged:
         metrics.remove(f"judged_{n}")
@@ -56,8 +69,10 @@ def _eval_runs(runs, qrels, metrics, dev_qids, relevance_level):
     scores = np.array(scores).mean(axis=0).tolist()
     scores = dict(zip(metrics, scores))
 
-    for n in calc_judged:
-        scores[f"judged_{n}"] = judged(qrels, runs, n)
+    if calc_judged:
+        # one top-K pass per query serves every judged cutoff
+        judged_scores = np.mean(list(judged_by_cutoff(qrels, runs, calc_judged).values()), axis=0)
+        scores.update({f"judged_{n}": score for n, score in zip(calc_judged, judged_scores.tolist())})
 
     return scores
 
@@ -96,12 +111,161 @@ def eval_runfile(runfile, qrels, metrics, relevance_level):
     return _eval_runs(runs, qrels, metrics, list(qrels.keys()), relevance_level)
 
 
+class RunEvaluator:
+    """Computes a matrix of per-query scores for runs with a qrels and metric set.
+
+    Metrics supported by :mod:`capreolus.utils.metrics` are computed natively on columnar arrays. Otherwise, one
+    pytrec_eval evaluator is reused for every run.
+
+    Args:
+        qrels: dict containing relevance judgements (e.g., ``benchmark.qrels``)
+        metrics (list): metrics to calculate, including any ``judged_n`` metrics
+        relevance_level (int): relevance label threshold to use with non-graded metrics
+    """
+
+    def __init__(self, qrels, metrics, relevance_level):
+        self.qrels = qrels
+        self.metrics = list(metrics)
+        self.relevance_level = int(relevance_level)
+        self.native = all(is_supported(metric) for metric in self.metrics)
+        self.trec_metrics = [metric for metric in self.metrics if not metric.startswith("judged_")]
+        self.evaluator = None
+        if not self.native:
+            self.evaluator = pytrec_eval.RelevanceEvaluator(qrels, self.trec_metrics, relevance_level=self.relevance_level)
+
+    def evaluate(self, runs):
+        """Evaluate ``runs`` in the format ``{qid: {docid: score}}``
+
+        Returns:
+            a ``(qids, scores)`` tuple, where ``scores[i, j]`` is ``qids[i]``'s score for ``self.metrics[j]``. Only qids
+            present in both ``runs`` and the qrels are included.
+        """
+
+        qids = [qid for qid in runs if qid in self.qrels]
+        if self.native:
+            # only the docs that can reach the deepest cutoff need to be ranked
+            depth = max_cutoff(self.metrics)
+            q_docids, q_scores = [], []
+            for qid in qids:
+                docids = np.array(list(runs[qid]), dtype=object)
+                scores = np.fromiter(runs[qid].values(), dtype=np.float64, count=len(docids))
+                candidates = top_candidates(scores, depth)
+                q_docids.append(docids[candidates])
+                q_scores.append(scores[candidates])
+
+            offsets = np.cumsum([0] + [len(docids) for docids in q_docids])
+            docids = np.concatenate(q_docids) if qids else np.zeros(0, dtype=object)
+            scores = np.concatenate(q_scores) if qids else np.zeros(0)
+            return qids, evaluate_columns(self.qrels, qids, offsets, docids, scores, self.metrics, self.relevance_level)
+
+        per_query = self.evaluator.evaluate(runs)
+        judged_idxs = [idx for idx, metric in enumerate(self.metrics) if metric.startswith("judged_")]
+        judged_cutoffs = [int(self.metrics[idx].split("_")[1]) for idx in judged_idxs]
+        judged_scores = judged_by_cutoff(self.qrels, {qid: runs[qid] for qid in qids}, judged_cutoffs) if judged_idxs else {}
+
+        scores = np.zeros((len(qids), len(self.metrics)))
+        for idx, qid in enumerate(qids):
+            for metric_idx, metric in enumerate(self.metrics):
+                if not metric.startswith("judged_"):
+                    scores[idx, metric_idx] = per_query.get(qid, {}).get(metric, -1)
+            if judged_idxs:
+                scores[idx, judged_idxs] = judged_scores[qid]
+
+        return qids, scores
+
+    def evaluate_columns(self, qids, offsets, docs, vocab, scores):
+        """ Evaluate a run in the columnar format returned by ``load_trec_run_columns`` (see :meth:`evaluate`) """
+        docids = np.asarray(vocab, dtype=object)[docs]
+        if not self.native:
+            runs = {
+                qid: dict(zip(docids[offsets[idx] : offsets[idx + 1]], scores[offsets[idx] : offsets[idx + 1]].tolist()))
+                for idx, qid in enumerate(qids)
+            }
+            return self.evaluate(runs)
+
+        offsets = np.asarray(offsets)
+        keep = np.array([qid in self.qrels for qid in qids], dtype=bool)
+        if not keep.all():
+            lengths = np.diff(offsets)
+            entries = np.repeat(keep, lengths)
+            qids = [qid for qid, kept in zip(qids, keep) if kept]
+            offsets = np.cumsum(np.concatenate(([0], lengths[keep])))
+            docids, scores = docids[entries], scores[entries]
+
+        return list(qids), evaluate_columns(self.qrels, qids, offsets, docids, scores, self.metrics, self.relevance_level)
+
+
+_worker_evaluator = None
+
+
+def _init_worker_evaluator(qrels, metrics, relevance_level):
+    global _worker_evaluator
+    _worker_evaluator = RunEvaluator(qrels, metrics, relevance_level)
+
+
+def _get_eval_cache_key(runfile, evaluator):
+    if not hasattr(evaluator, "settings_hash"):
+        settings = [evaluator.metrics, evaluator.relevance_level, evaluator.qrels]
+        evaluator.settings_hash = hashlib.md5(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+    key = hashlib.md5(evaluator.settings_hash.encode("utf-8"))
+    with open(runfile, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            key.update(chunk)
+    return key.hexdigest()
+
+
+def _evaluate_runfile(runfile):
+    evaluator = _worker_evaluator
+    cache_fn = os.path.join(os.path.dirname(runfile), SIDECAR_DIR, os.path.basename(runfile) + ".eval.npz")
+    key = _get_eval_cache_key(runfile, evaluator)
+
+    if os.path.exists(cache_fn):
+        cached = np.load(cache_fn)
+        if cached["key"].item() == key:
+            return cached["qids"].tolist(), cached["scores"]
+
+    qids, scores = evaluator.evaluate_columns(*load_trec_run_columns(runfile))
+
+    os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+    tmp_fn = f"{cache_fn}.tmp_{os.getpid()}"
+    with open(tmp_fn, "wb") as outf:
+        np.savez(outf, key=np.array(key), metrics=np.array(evaluator.metrics), qids=np.array(qids, dtype=str), scores=scores)
+    os.replace(tmp_fn, cache_fn)
+
+    return qids, scores
+
+
+def evaluate_runfiles(runfiles, qrels, metrics, relevance_level, processes=MAX_THREADS):
+    """Compute a per-query score matrix for each run file (see :class:`RunEvaluator`) using a pool of processes.
+
+    Results are cached in each run file's ``.runcache`` directory under a hash of the run file's contents, the qrels
+    and the metrics, so unchanged run files are not evaluated again.
+
+    Returns:
+        a list containing a ``(qids, scores)`` tuple for each run file
+    """
+
+    metrics = list(metrics)
+    if processes <= 1 or len(runfiles) <= 1:
+        _init_worker_evaluator(qrels, metrics, relevance_level)
+        return [_evaluate_runfile(runfile) for runfile in runfiles]
+
+    # this process usually has a JVM loaded, which cannot be safely inherited with fork
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        min(processes, len(runfiles)), initializer=_init_worker_evaluator, initargs=(qrels, metrics, relevance_level)
+    ) as pool:
+        return pool.map(_evaluate_runfile, runfiles)
+
+
 def search_best_run(runfile_dirs, benchmark, primary_metric, metrics=None, folds=None):
     """
     Select the runfile with respect to the specified metric
 
     Args:
-        runfile_dirs: the directory path to all the runfiles to select from
+        runfile_dirs: the directory path to all the runfiles to select from. Columnar grid files (``*.grid.npz``) in
+            these directories are evaluated one config column at a time, and the best config is written to a run file.
         benchmark: Benchmark class
         primary_metric: str, metric used to select the best runfile , e.g. ndcg_cut_20, etc
         metrics: str or list, metric expected by be calculated on the best runs
@@ -119,68 +283,137 @@ def search_best_run(runfile_dirs, benchmark, primary_metric, metrics=None, folds
         metrics = [primary_metric] + metrics
 
     folds = {s: benchmark.folds[s] for s in [folds]} if folds else benchmark.folds
-    runfiles = [
-        os.path.join(runfile_dir, f)
-        for runfile_dir in runfile_dirs
-        for f in os.listdir(runfile_dir)
-        if (f != "done" and not os.path.isdir(os.path.join(runfile_dir, f)))
-    ]
-
+    runfiles, grids = [], []
+    for runfile_dir in runfile_dirs:
+        fns = [f for f in os.listdir(runfile_dir) if (f != "done" and not os.path.isdir(os.path.join(runfile_dir, f)))]
+
+        # columnar grid files provide one run per config; skip run files we previously wrote out from a grid's column
+        grid_fns = [f for f in fns if f.endswith(GRID_SUFFIX)]
+        grid_configs = set()
+        for f in grid_fns:
+            grid = GridRun.load(os.path.join(runfile_dir, f))
+            grids.append((runfile_dir, grid))
+            grid_configs.update("searcher_" + config for config in grid.configs)
+
+        runfiles.extend(os.path.join(runfile_dir, f) for f in fns if f not in grid_fns and f not in grid_configs)
+
+    # score every candidate once per query for all metrics, so folds only need to average rows of these matrices
+    per_query = dict(zip(runfiles, evaluate_runfiles(runfiles, benchmark.qrels, metrics, benchmark.relevance_level)))
+    run_evaluator = RunEvaluator(benchmark.qrels, metrics, benchmark.relevance_level)
+    for runfile_dir, grid in grids:
+        for config in grid.configs:
+            per_query[(runfile_dir, grid, config)] = run_evaluator.evaluate(grid.get_run(config))
+
+    primary_idx = metrics.index(primary_metric)
     best_scores = {s: {primary_metric: 0, "path": None} for s in folds}
-    for runfile in runfiles:
-        runs = Searcher.load_trec_run(runfile)
+    for candidate, (qids, scores) in per_query.items():
         for s, v in folds.items():
-            score = _eval_runs(
-                runs,
-                benchmark.qrels,
-                [primary_metric],
-                (set(v["train_qids"]) | set(v["predict"]["dev"])),
-                benchmark.relevance_level,
-            )[primary_metric]
+            dev_qids = set(v["train_qids"]) | set(v["predict"]["dev"])
+            rows = [idx for idx, qid in enumerate(qids) if qid in dev_qids]
+            if not rows:
+                continue
+
+            score = scores[rows, primary_idx].mean()
             if score > best_scores[s][primary_metric]:
-                best_scores[s] = {primary_metric: score, "path": runfile}
+                best_scores[s] = {primary_metric: score, "path": candidate}
 
-    test_runs = {}
+    test_scores = {}
     for s, score_dict in best_scores.items():
-        test_qids = folds[s]["predict"]["test"]
-        # any empty (no results) queries need to be added so they contribute zeros to the average
-        test_runs.update({qid: {} for qid in test_qids})
-        test_runs.update({qid: v for qid, v in Searcher.load_trec_run(score_dict["path"]).items() if qid in test_qids})
+        qids, scores = per_query[score_dict["path"]]
+        if isinstance(score_dict["path"], tuple):
+            # write the best config from a grid to a run file, so that callers can load it like any other run
+            runfile_dir, grid, config = score_dict["path"]
+            score_dict["path"] = os.path.join(runfile_dir, "searcher_" + config)
+            if not os.path.exists(score_dict["path"]):
+                Searcher.write_trec_run(grid.get_run(config), score_dict["path"])
+
+        # any empty (no results) queries contribute zeros to the average
+        test_qids = [qid for qid in folds[s]["predict"]["test"] if qid in benchmark.qrels]
+        test_scores.update({qid: np.zeros(len(metrics)) for qid in test_qids})
+        test_qids = set(test_qids)
+        test_scores.update({qid: scores[idx] for idx, qid in enumerate(qids) if qid in test_qids})
 
-    scores = eval_runs(test_runs, benchmark.qrels, metrics, benchmark.relevance_level)
-    return {"score": scores, "path": {s: v["path"] for s, v in best_scores.items()}}
+    scores = np.array(list(test_scores.values())).mean(axis=0).tolist()
+    return {"score": dict(zip(metrics, scores)), "path": {s: v["path"] for s, v in best_scores.items()}}
 
 
 def interpolate_runs(run1, run2, qids, alpha):
     out = {}
+    for qid, (docids, scores) in align_runs(run1, run2, qids).items():
+        out[qid] = dict(zip(docids, interpolate_scores(scores, [alpha])[0].tolist()))
+
+    return out
+
+
+INTERPOLATION_ALPHAS = np.arange(0, 1.001, 0.05)
+
+
+def _minmax_bounds(scores):
+    if len(scores) == 0:
+        return 0, 1
+
+    min_score, max_score = scores.min(), scores.max()
+    if min_score == max_score:
+        min_score = 0.01 * max_score - 0.01
+    return min_score, max_score
+
+
+def align_runs(run1, run2, qids):
+    """Align two runs into dense arrays with one min-max normalized score row per run, as used by ``interpolate_runs``.
+
+    Returns:
+        a dict in the format ``{qid: (docids, scores)}``, where ``scores`` has shape ``(2, len(docids))``. A doc missing
+        from one of the runs receives that run's minimum score (i.e., a normalized score of 0).
+    """
+
+    aligned = {}
     for qid in qids:
-        out[qid] = {}
+        docs1, docs2 = run1.get(qid, {}), run2.get(qid, {})
+        docids = list(docs1.keys() | docs2)
+        scores = np.zeros((2, len(docids)))
+        for row, docs in enumerate((docs1, docs2)):
+            raw = np.array([docs[docid] for docid in docs], dtype=np.float64)
+            min_score, max_score = _minmax_bounds(raw)
+            scores[row] = [(docs.get(docid, min_score) - min_score) / (max_score - min_score) for docid in docids]
 
-        if len(run1[qid]) == 0:
-            min1, max1 = 0, 1
-        else:
-            min1, max1 = min(run1[qid].values()), max(run1[qid].values())
+        aligned[qid] = (np.array(docids, dtype=object), scores)
 
-            if min1 == max1:
-                min1 = 0.01 * max1 - 0.01
+    return aligned
 
-        if len(run2[qid]) == 0:
-            min2, max2 = 0, 1
-        else:
-            min2, max2 = min(run2[qid].values()), max(run2[qid].values())
 
-            if min2 == max2:
-                min2 = 0.01 * max2 - 0.01
+def interpolate_scores(scores, alphas):
+    """ Broadcast ``alpha * scores[0] + (1 - alpha) * scores[1]`` over ``alphas``, returning one row per alpha """
+    alphas = np.asarray(alphas, dtype=np.float64)[:, None]
+    return alphas * scores[0] + (1 - alphas) * scores[1]
 
-        for docid in run1[qid].keys() | run2[qid]:
-            score1 = run1[qid].get(docid, min1)
-            score2 = run2[qid].get(docid, min2)
 
-            score1 = (score1 - min1) / (max1 - min1)
-            score2 = (score2 - min2) / (max2 - min2)
-            out[qid][docid] = alpha * score1 + (1 - alpha) * score2
+def eval_fused_runs(aligned, qrels, metrics, relevance_level, fuse):
+    """Evaluate every fused ranking produced by ``fuse`` for the aligned runs returned by ``align_runs``
 
-    return out
+    Args:
+        aligned: dict in the format ``{qid: (docids, scores)}``
+        fuse: function mapping a query's ``scores`` array to a ``(nrankings, len(docids))`` array of fused scores
+            (e.g., ``lambda scores: interpolate_scores(scores, alphas)``)
+
+    Returns:
+        a ``(qids, scores)`` tuple, where ``scores[i, j, k]`` is ``qids[i]``'s score for ranking ``j`` and ``metrics[k]``.
+        Only qids present in the qrels are included.
+    """
+
+    qids = [qid for qid in aligned if qid in qrels]
+    docids = [aligned[qid][0] for qid in qids]
+    fused = [fuse(aligned[qid][1]) for qid in qids]
+    if all(is_supported(metric) for metric in metrics):
+        return qids, evaluate_dense(qrels, qids, docids, fused, metrics, relevance_level)
+
+    # fall back to pytrec_eval with one run per fused ranking
+    nrankings = fused[0].shape[0] if fused else 0
+    run_evaluator = RunEvaluator(qrels, metrics, relevance_level)
+    scores = np.zeros((len(qids), nrankings, len(metrics)))
+    for ranking in range(nrankings):
+        run = {qid: dict(zip(docids[idx], fused[idx][ranking].tolist())) for idx, qid in enumerate(qids)}
+        scores[:, ranking] = run_evaluator.evaluate(run)[1]
+    return qids, scores
 
 
 def interpolated_eval(run1, run2, benchmark, primary_metric, metrics=None):
@@ -188,27 +421,30 @@ def interpolated_eval(run1, run2, benchmark, primary_metric, metrics=None):
     if primary_metric not in metrics:
         metrics = [primary_metric] + metrics
 
-    test_runs = {}
+    def interpolate(scores):
+        return interpolate_scores(scores, INTERPOLATION_ALPHAS)
+
+    primary_idx = metrics.index(primary_metric)
+    test_scores = {}
     alphas = {}
     for s, v in benchmark.folds.items():
-        best_metric = None
-        dev_qids = set(v["predict"]["dev"])
-        dev1, dev2 = run1[s]["dev"], run2[s]["dev"]
-
-        for alpha in np.arange(0, 1.001, 0.05):
-            interpolated_run = interpolate_runs(dev1, dev2, dev_qids, alpha)
-            metrics = eval_runs(interpolated_run, benchmark.qrels, metrics, benchmark.relevance_level)
-
-            if best_metric is None or metrics[primary_metric] > best_metric:
-                best_metric = metrics[primary_metric]
-                alphas[s] = alpha
-
-        test_qids = set(v["predict"]["test"])
-        test1, test2 = run1[s]["test"], run2[s]["test"]
-        interpolated_test_run = interpolate_runs(test1, test2, test_qids, alphas[s])
-        for qid in test_qids:
-            assert qid not in test_runs
-            test_runs[qid] = interpolated_test_run[qid].copy()
-
-    scores = eval_runs(test_runs, benchmark.qrels, metrics, benchmark.relevance_level)
-    return {"score": scores, "alphas": alphas}
+        # evaluate every alpha at once, then choose the first alpha with the best mean dev score
+        dev_aligned = align_runs(run1[s]["dev"], run2[s]["dev"], v["predict"]["dev"])
+        _, dev_scores = eval_fused_runs(dev_aligned, benchmark.qrels, metrics, benchmark.relevance_level, interpolate)
+        best_idx = int(dev_scores[:, :, primary_idx].mean(axis=0).argmax()) if len(dev_scores) else 0
+        alphas[s] = INTERPOLATION_ALPHAS[best_idx]
+
+        test_aligned = align_runs(run1[s]["test"], run2[s]["test"], v["predict"]["test"])
+        test_qids, scores = eval_fused_runs(
+            test_aligned,
+            benchmark.qrels,
+            metrics,
+            benchmark.relevance_level,
+            lambda scores: interpolate_scores(scores, [alphas[s]]),
+        )
+        for idx, qid in enumerate(test_qids):
+            assert qid not in test_scores
+            test_scores[qid] = scores[idx, 0]
+
+    scores = np.array(list(test_scores.values())).mean(axis=0).tolist()
+    return {"score": dict(zip(metrics, scores)), "alphas": alphas}
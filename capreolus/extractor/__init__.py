@@ -11,6 +11,9 @@ class Extractor(ModuleBase):
 
     Modules should provide:
         - an ``id2vec(qid, posid, negid=None)`` method that converts the given query and document ids to an appropriate representation
+
+    Modules may also provide:
+        - a ``batch2vec(qids, posids, negids=None, labels=None)`` method that converts a whole batch of ids at once
     """
 
     module_type = "extractor"
@@ -29,16 +32,49 @@ class Extractor(ModuleBase):
             calc_idf = False
 
         n_words_before = len(self.stoi)
+        missing_idf = {}
         for toks in toks_list:
             toks = [toks] if isinstance(toks, str) else toks
             for tok in toks:
                 if tok not in self.stoi:
                     self.stoi[tok] = len(self.stoi)
                 if calc_idf and tok not in self.idf:
-                    self.idf[tok] = self.index.get_idf(tok)
+                    missing_idf[tok] = None
+
+        # look up the IDF of all new terms in one batch rather than making one index call per term
+        if missing_idf:
+            missing_idf = list(missing_idf)
+            self.idf.update(zip(missing_idf, self.index.get_idfs(missing_idf).tolist()))
 
         logger.debug(f"added {len(self.stoi)-n_words_before} terms to the stoi of extractor {self.module_name}")
 
+    def _tokenize_docs(self, docids, method="tokenize", desc="doctoks"):
+        """Tokenize the contents of ``docids`` in parallel shards, returning a dict in the format ``{docid: tokens}``.
+        ``method`` names the tokenizer method to apply to each shard's list of documents (e.g., ``"encode"`` for ids).
+
+        Tokenized docs are cached per docid (see ``DocTokenCache``) for the index and tokenizer configs, so only docs that
+        have not been tokenized by any earlier run (e.g., one reranking a different first-stage run) are tokenized."""
+        from .doccache import DocTokenCache
+        from .parallel import tokenize_docs
+
+        docids = list(dict.fromkeys(docids))
+        cache_fn = self.index.get_cache_path() / "doctoks" / self.tokenizer.get_module_path() / f"{method}.sqlite3"
+        cache = DocTokenCache(cache_fn)
+        try:
+            docid2toks = cache.get_many(docids)
+            missing = [docid for docid in docids if docid not in docid2toks]
+            logger.info("%s of %s documents found in the tokenization cache", len(docid2toks), len(docids))
+            if missing:
+                new_docid2toks = tokenize_docs(
+                    self.index, self.tokenizer, missing, self.get_cache_path() / "shards", method=method, desc=desc
+                )
+                cache.put_many(new_docid2toks)
+                docid2toks.update(new_docid2toks)
+        finally:
+            cache.close()
+
+        return {docid: docid2toks[docid] for docid in docids}
+
     def cache_state(self, qids, docids):
         raise NotImplementedError
 
@@ -49,9 +85,12 @@ class Extractor(ModuleBase):
         """
         Returns the path to the cache file used to store the extractor state, regardless of whether it exists or not
         """
-        sorted_qids = sorted(qids)
-        sorted_docids = sorted(docids)
-        return self.get_cache_path() / hashlib.md5(str(sorted_qids + sorted_docids).encode("utf-8")).hexdigest()
+        # hash the ids incrementally rather than building one large string; the digest matches md5(str(sorted_ids))
+        md5 = hashlib.md5(b"[")
+        for idx, id_ in enumerate(sorted(qids) + sorted(docids)):
+            md5.update((", " + repr(id_) if idx else repr(id_)).encode("utf-8"))
+        md5.update(b"]")
+        return self.get_cache_path() / md5.hexdigest()
 
     def is_state_cached(self, qids, docids):
         """
@@ -78,6 +117,19 @@ class Extractor(ModuleBase):
         """
         raise NotImplementedError
 
+    def batch2vec(self, qids, posdocids, negdocids=None, labels=None):
+        """
+        Optionally, creates the features of a whole batch of (qid, posdocid[, negdocid]) samples at once, with ``labels``
+        containing each sample's label as described in id2vec. The result has the format PyTorch's default collate
+        function would produce from the samples' id2vec features: ids are lists, and the other values are arrays whose
+        first dimension is the batch. Raises MissingDocError when any of the docs is missing.
+        Extractors providing this let samplers yield whole batches (see :meth:`~capreolus.sampler.Sampler.set_batch_size`)
+        """
+        raise NotImplementedError
+
+    def provides_batch2vec(self):
+        return type(self).batch2vec is not Extractor.batch2vec
+
 
 from profane import import_all_modules
 
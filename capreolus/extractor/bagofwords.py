@@ -1,6 +1,5 @@
-import os
 import pickle
-from collections import Counter, defaultdict
+from collections import defaultdict
 
 import numpy as np
 
@@ -8,6 +7,7 @@ from capreolus import ConfigOption, Dependency
 from capreolus.utils.loginit import get_logger
 
 from . import Extractor
+from .tokenids import TokenIds, load_vocab, save_vocab
 
 logger = get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -38,25 +38,30 @@ class BagOfWords(Extractor):
         return [self.stoi.get(tok, 0) for tok in toks]
 
     def load_state(self, qids, docids):
-        with open(self.get_state_cache_file_path(qids, docids), "rb") as f:
-            state_dict = pickle.load(f)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        if state_path.is_file():
+            # older caches pickled the token lists
+            with open(state_path, "rb") as f:
+                state_dict = pickle.load(f)
+            self.stoi, self.itos = state_dict["stoi"], state_dict["itos"]
             self.qid2toks = state_dict["qid2toks"]
-            self.docid2toks = state_dict["docid2toks"]
-            self.stoi = state_dict["stoi"]
-            self.itos = state_dict["itos"]
+            self.docid2ids = TokenIds.from_toks(state_dict["docid2toks"], self.stoi)
             self.idf = defaultdict(lambda: 0, state_dict["idf"])
+            return
+
+        self.stoi, self.itos = load_vocab(state_path)
+        self.qid2toks = TokenIds.load(state_path / "queries").to_toks(self.itos)
+        self.docid2ids = TokenIds.load(state_path / "docs")
+        with np.load(state_path / "idf.npz") as data:
+            self.idf = defaultdict(lambda: 0, zip([self.itos[idx] for idx in data["ids"].tolist()], data["idfs"].tolist()))
 
     def cache_state(self, qids, docids):
-        os.makedirs(self.get_cache_path(), exist_ok=True)
-        with open(self.get_state_cache_file_path(qids, docids), "wb") as f:
-            state_dict = {
-                "qid2toks": self.qid2toks,
-                "docid2toks": self.docid2toks,
-                "stoi": self.stoi,
-                "itos": self.itos,
-                "idf": dict(self.idf),
-            }
-            pickle.dump(state_dict, f, protocol=-1)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        save_vocab(state_path, self.itos)
+        TokenIds.from_toks(self.qid2toks, self.stoi).save(state_path / "queries")
+        self.docid2ids.save(state_path / "docs")
+        idf_ids = np.array([self.stoi[tok] for tok in self.idf], dtype=np.int32)
+        np.savez(state_path / "idf.npz", ids=idf_ids, idfs=np.array(list(self.idf.values()), dtype=np.float64))
 
     def get_trigrams_for_toks(self, toks_list):
         return [("#%s#" % tok)[i : i + 3] for tok in toks_list for i in range(len(tok))]
@@ -64,19 +69,23 @@ class BagOfWords(Extractor):
     def _build_vocab_unigram(self, qids, docids, topics):
         tokenize = self.tokenizer.tokenize
         self.qid2toks = {qid: tokenize(topics[qid]) for qid in qids}
-        self.docid2toks = {docid: tokenize(self.index.get_doc(docid)) for docid in docids}
+        self.docid2toks = self._tokenize_docs(docids)
         self._extend_stoi(self.qid2toks.values(), calc_idf=True)
         self._extend_stoi(self.docid2toks.values())
         self.itos = {i: s for s, i in self.stoi.items()}
+        self.docid2ids = TokenIds.from_toks(self.docid2toks, self.stoi)
+        del self.docid2toks
         logger.info(f"vocabulary constructed, with {len(self.itos)} terms in total")
 
     def _build_vocab_trigram(self, qids, docids, topics):
         tokenize = self.tokenizer.tokenize
         self.qid2toks = {qid: self.get_trigrams_for_toks(tokenize(topics[qid])) for qid in qids}
-        self.docid2toks = {docid: self.get_trigrams_for_toks(tokenize(self.index.get_doc(docid))) for docid in docids}
+        self.docid2toks = {docid: self.get_trigrams_for_toks(toks) for docid, toks in self._tokenize_docs(docids).items()}
         self._extend_stoi(self.qid2toks.values(), calc_idf=True)
         self._extend_stoi(self.docid2toks.values())
         self.itos = {i: s for s, i in self.stoi.items()}
+        self.docid2ids = TokenIds.from_toks(self.docid2toks, self.stoi)
+        del self.docid2toks
         logger.info(f"vocabulary constructed, with {len(self.itos)} terms in total")
 
     def _build_vocab(self, qids, docids, topics):
@@ -94,9 +103,15 @@ class BagOfWords(Extractor):
                 self.cache_state(qids, docids)
 
         self.embeddings = self.stoi
+        self.set_max_terms()
+
+    def set_max_terms(self):
+        """ Find the largest number of distinct terms in a query and in a doc, which determines the length of features """
+        self.max_query_terms = max([len(set(self._tok2vec(toks))) for toks in self.qid2toks.values()] + [1])
+        self.max_doc_terms = max([len(np.unique(ids)) for _, ids in self.docid2ids.items()] + [1])
 
     def exist(self):
-        return hasattr(self, "qid2toks") and hasattr(self, "docid2toks") and len(self.stoi) > 1
+        return hasattr(self, "qid2toks") and hasattr(self, "docid2ids") and len(self.stoi) > 1
 
     def preprocess(self, qids, docids, topics):
         if self.exist():
@@ -105,7 +120,6 @@ class BagOfWords(Extractor):
         self.itos = {self.pad: self.pad_tok}
         self.stoi = {self.pad_tok: self.pad}
         self.qid2toks = defaultdict(list)
-        self.docid2toks = defaultdict(list)
         self.idf = defaultdict(lambda: 0)
         self.embeddings = None
         # self.cache = self.load_cache()    # TODO
@@ -113,51 +127,55 @@ class BagOfWords(Extractor):
         self._build_vocab(qids, docids, topics)
 
     def id2vec(self, q_id, posdoc_id, negdoc_id=None, **kwargs):
+        """
+        Texts are represented sparsely, with each text's distinct term ids (e.g., ``query``) and their counts (e.g.,
+        ``query_counts``) padded to a fixed number of terms with ``pad`` ids and zero counts. ``query_idf`` contains the
+        IDF of each term in ``query``.
+        """
         query_toks = self.qid2toks[q_id]
-        posdoc_toks = self.docid2toks.get(posdoc_id)
+        posdoc_ids = self.docid2ids.get(posdoc_id)
 
-        if not posdoc_toks:
+        if posdoc_ids is None or len(posdoc_ids) == 0:
             logger.debug("missing docid %s", posdoc_id)
             return None
 
-        transformed_query = self.transform_txt(query_toks, self.config["maxqlen"])
-
-        query_idf_vector = np.zeros(len(self.stoi), dtype=np.float32)
-        for tok in query_toks:
-            query_idf_vector[self.stoi.get(tok, 0)] = self.idf[tok]
+        query, query_counts = self.transform_ids(self._tok2vec(query_toks), self.max_query_terms)
+        # as with a dense vector indexed by term id, the last token mapped to a (e.g., unknown) term id sets its IDF
+        term_idfs = {self.stoi.get(tok, 0): self.idf[tok] for tok in query_toks}
+        query_idf = np.zeros(self.max_query_terms, dtype=np.float32)
+        nterms = min(len(term_idfs), self.max_query_terms)
+        query_idf[:nterms] = [term_idfs[term] for term in query[:nterms]]
 
+        posdoc, posdoc_counts = self.transform_ids(posdoc_ids, self.max_doc_terms)
         transformed = {
             "qid": q_id,
             "posdocid": posdoc_id,
-            "query": transformed_query,
-            "posdoc": self.transform_txt(posdoc_toks, self.config["maxdoclen"]),
-            "query_idf": query_idf_vector,
+            "query": query,
+            "query_counts": query_counts,
+            "posdoc": posdoc,
+            "posdoc_counts": posdoc_counts,
+            "query_idf": query_idf,
         }
         if negdoc_id is not None:
-            negdoc_toks = self.docid2toks.get(negdoc_id)
-            if not negdoc_toks:
+            negdoc_ids = self.docid2ids.get(negdoc_id)
+            if negdoc_ids is None or len(negdoc_ids) == 0:
                 logger.debug("missing docid %s", negdoc_id)
                 return None
             transformed["negdocid"] = negdoc_id
-            transformed["negdoc"] = self.transform_txt(negdoc_toks, self.config["maxdoclen"])
+            transformed["negdoc"], transformed["negdoc_counts"] = self.transform_ids(negdoc_ids, self.max_doc_terms)
 
         return transformed
 
-    def transform_txt(self, term_list, maxlen):
-        term_vec = self._tok2vec(term_list)
-        nvocab = len(self.stoi)
-        bog_txt = np.zeros(nvocab, dtype=np.float32)
-
-        if self.config["datamode"] == "unigram":
-            for term in term_vec:
-                bog_txt[term] += 1
-        elif self.config["datamode"] == "trigram":
-            trigrams = self.get_trigrams_for_toks(term_list)
-            toks = [self.stoi.get(trigram, 0) for trigram in trigrams]
-            tok_counts = Counter(toks)
-            for tok, count in tok_counts.items():
-                bog_txt[tok] = count
-        else:
-            raise Exception("Unknown datamode")
-
-        return bog_txt
+    def transform_ids(self, term_ids, maxterms):
+        """Count the occurrences of each term (a unigram or a trigram, depending on ``datamode``) in ``term_ids``.
+
+        Returns:
+            a tuple ``(terms, counts)`` containing the distinct term ids in increasing order and their counts, each padded
+            to ``maxterms`` entries with ``pad`` and 0
+        """
+        terms, counts = np.unique(np.asarray(term_ids, dtype=np.int64), return_counts=True)
+        padded_terms = np.full(maxterms, self.pad, dtype=np.int64)
+        padded_counts = np.zeros(maxterms, dtype=np.float32)
+        padded_terms[: len(terms)] = terms[:maxterms]
+        padded_counts[: len(terms)] = counts[:maxterms]
+        return padded_terms, padded_counts
@@ -1,18 +1,20 @@
 import pickle
-import os
+import zlib
 import tensorflow as tf
 import numpy as np
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from tqdm import tqdm
 
 
 from capreolus.extractor import Extractor
 from capreolus import Dependency, ConfigOption, get_logger
-from capreolus.utils.common import padlist
 from capreolus.utils.exceptions import MissingDocError
 from capreolus.tokenizer.punkt import PunktTokenizer
+from capreolus.extractor.tokenids import TokenIds
 
 logger = get_logger(__name__)
+# memory budget (in bytes) for the passage matrices kept in memory, which determines how many docs are cached
+PASSAGE_CACHE_BYTES = 64 * 1024 * 1024
 
 
 @Extractor.register
@@ -58,20 +60,40 @@ class BertPassage(Extractor):
         self.pad_tok = self.tokenizer.bert_tokenizer.pad_token
         self.cls_tok = self.tokenizer.bert_tokenizer.cls_token
         self.sep_tok = self.tokenizer.bert_tokenizer.sep_token
+        self.qid2ids = {}
 
     def load_state(self, qids, docids):
-        cache_fn = self.get_state_cache_file_path(qids, docids)
-        logger.debug("loading state from: %s", cache_fn)
-        with open(cache_fn, "rb") as f:
-            state_dict = pickle.load(f)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        logger.debug("loading state from: %s", state_path)
+        if state_path.is_file():
+            # older caches pickled the query tokens and passages
+            with open(state_path, "rb") as f:
+                state_dict = pickle.load(f)
             self.qid2toks = state_dict["qid2toks"]
-            self.docid2passages = state_dict["docid2passages"]
+            docid2passages = state_dict["docid2passages"]
+            # the oldest caches stored passages as token strings rather than token ids
+            if not state_dict.get("passage_ids", False):
+                docid2passages = {
+                    docid: [self._passage_toks_to_ids(passage) for passage in passages]
+                    for docid, passages in docid2passages.items()
+                }
+            self.docid2passages = TokenIds.from_lists(docid2passages, nested=True)
+            return
+
+        self.qid2ids = {qid: ids.tolist() for qid, ids in TokenIds.load(state_path / "queries").items()}
+        self.qid2toks = {qid: self.tokenizer.bert_tokenizer.convert_ids_to_tokens(ids) for qid, ids in self.qid2ids.items()}
+        if (state_path / "docs").exists():
+            self.docid2ids = TokenIds.load(state_path / "docs")
+        else:
+            self.docid2passages = TokenIds.load(state_path / "passages")
 
     def cache_state(self, qids, docids):
-        os.makedirs(self.get_cache_path(), exist_ok=True)
-        with open(self.get_state_cache_file_path(qids, docids), "wb") as f:
-            state_dict = {"qid2toks": self.qid2toks, "docid2passages": self.docid2passages}
-            pickle.dump(state_dict, f, protocol=-1)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        TokenIds.from_lists({qid: self._get_query_ids(qid) for qid in self.qid2toks}).save(state_path / "queries")
+        if self.docid2passages is None:
+            self.docid2ids.save(state_path / "docs")
+        else:
+            self.docid2passages.save(state_path / "passages")
 
     def get_tf_feature_description(self):
         feature_description = {
@@ -224,34 +246,47 @@ class BertPassage(Extractor):
 
         return (pos_bert_input, pos_mask, pos_seg, neg_bert_input, neg_mask, neg_seg), label
 
-    def _prepare_doc_psgs(self, doc):
+    def _passage_toks_to_ids(self, passage):
+        # passages padded with the empty string contain no tokens
+        return [] if passage == [""] else self.tokenizer.convert_tokens_to_ids(list(passage))
+
+    def _sample_passage_starts(self, docid, doclen):
         """
-        Extract passages from the doc.
-        If there are too many passages, keep the first and the last one and sample from the rest.
-        If there are not enough packages, pad.
+        Return the offsets of the passages to use from a doc of ``doclen`` token ids, which has one passage every
+        ``stride`` tokens. If there are too many passages, keep the first and the last one and sample from the rest.
+        The sample is drawn from an RNG seeded with the docid, so it does not depend on the order in which docs are seen.
         """
-        passages = []
         numpassages = self.config["numpassages"]
-        doc = self.tokenizer.tokenize(doc)
-
-        for i in range(0, len(doc), self.config["stride"]):
-            if i >= len(doc):
-                assert len(passages) > 0, f"no passage can be built from empty document {doc}"
-                break
-            passages.append(doc[i : i + self.config["passagelen"]])
-
-        n_actual_passages = len(passages)
+        starts = np.arange(0, doclen, self.config["stride"])
         # If we have a more passages than required, keep the first and last, and sample from the rest
-        if n_actual_passages > numpassages:
+        if len(starts) > numpassages:
             if numpassages > 1:
-                passages = [passages[0]] + list(self.rng.choice(passages[1:-1], numpassages - 2, replace=False)) + [passages[-1]]
+                rng = np.random.Generator(np.random.PCG64([self.config["seed"], zlib.crc32(docid.encode("utf-8"))]))
+                sampled = rng.choice(len(starts) - 2, numpassages - 2, replace=False)
+                starts = np.concatenate([starts[:1], starts[sampled + 1], starts[-1:]])
             else:
-                passages = [passages[0]]
-        else:
-            # Pad until we have the required number of passages
-            passages.extend([[self.pad_tok] for _ in range(numpassages - n_actual_passages)])
+                starts = starts[:1]
+
+        return starts
 
-        assert len(passages) == self.config["numpassages"]
+    def _get_passages(self, docid):
+        """
+        Return the ``numpassages`` passages of token ids used for the doc.
+        Passages are slices of the doc's token ids, whose offsets are sampled once per doc (see ``_sample_passage_starts``).
+        If there are not enough passages, pad.
+        """
+        # passages built from sentences (or loaded from an older cache) are stored as they are used
+        if self.docid2passages is not None:
+            return self.docid2passages[docid]
+
+        doc = self.docid2ids[docid]
+        if docid not in self._docid2starts:
+            self._docid2starts[docid] = self._sample_passage_starts(docid, len(doc))
+
+        passagelen = self.config["passagelen"]
+        passages = [doc[start : start + passagelen] for start in self._docid2starts[docid]]
+        # Pad until we have the required number of passages
+        passages.extend([[self.pad] for _ in range(self.config["numpassages"] - len(passages))])
         return passages
 
     # from https://github.com/castorini/birch/blob/2dd0401ebb388a1c96f8f3357a064164a5db3f0e/src/utils/doc_utils.py#L73
@@ -294,28 +329,35 @@ class BertPassage(Extractor):
 
                 assert len(passages) == self.config["numpassages"]
 
-            self.docid2passages[docid] = sorted(passages, key=len)
+            self.docid2passages[docid] = [self._passage_toks_to_ids(passage) for passage in sorted(passages, key=len)]
 
     def _build_vocab(self, qids, docids, topics):
+        self.qid2ids = {}
+        self.docid2passages, self.docid2ids = None, None
+        self._docid2starts = {}
+        self._qid2input = {}
+        self._passage_cache = OrderedDict()
         if self.is_state_cached(qids, docids) and self.config["usecache"]:
             self.load_state(qids, docids)
             logger.info("Vocabulary loaded from cache")
         elif self.config["sentences"]:
             self.docid2passages = {}
             self._build_passages_from_sentences(docids)
+            self.docid2passages = TokenIds.from_lists(self.docid2passages, nested=True)
             self.qid2toks = {qid: self.tokenizer.tokenize(topics[qid]) for qid in tqdm(qids, desc="querytoks")}
             self.cache_state(qids, docids)
         else:
             logger.info("Building bertpassage vocabulary")
 
             self.qid2toks = {qid: self.tokenizer.tokenize(topics[qid]) for qid in tqdm(qids, desc="querytoks")}
-            self.docid2passages = {
-                docid: self._prepare_doc_psgs(self.index.get_doc(docid)) for docid in tqdm(sorted(docids), "extract passages")
-            }
+            # passages are taken from the doc's token ids when they are used, see _get_passages
+            self.docid2ids = TokenIds.from_lists(self._tokenize_docs(sorted(docids), method="encode"))
             self.cache_state(qids, docids)
 
     def exist(self):
-        return hasattr(self, "docid2passages") and len(self.docid2passages)
+        if getattr(self, "docid2passages", None) is not None:
+            return len(self.docid2passages) > 0
+        return getattr(self, "docid2ids", None) is not None and len(self.docid2ids) > 0
 
     def preprocess(self, qids, docids, topics):
         if self.exist():
@@ -327,19 +369,69 @@ class BertPassage(Extractor):
 
         self._build_vocab(qids, docids, topics)
 
-    def _prepare_bert_input(self, query_toks, psg_toks):
-        maxseqlen, maxqlen = self.config["maxseqlen"], self.config["maxqlen"]
-        if len(query_toks) > maxqlen:
-            logger.warning(f"Truncating query from {len(query_toks)} to {maxqlen}")
-            query_toks = query_toks[:maxqlen]
-        psg_toks = psg_toks[: maxseqlen - len(query_toks) - 3]
-
-        psg_toks = " ".join(psg_toks).split()  # in case that psg_toks is np.array
-        input_line = [self.cls_tok] + query_toks + [self.sep_tok] + psg_toks + [self.sep_tok]
-        padded_input_line = padlist(input_line, padlen=maxseqlen, pad_token=self.pad_tok)
-        inp = self.tokenizer.convert_tokens_to_ids(padded_input_line)
-        mask = [1] * len(input_line) + [0] * (len(padded_input_line) - len(input_line))
-        seg = [0] * (len(query_toks) + 2) + [1] * (len(padded_input_line) - len(query_toks) - 2)
+    def _get_query_ids(self, qid):
+        if qid not in self.qid2ids:
+            self.qid2ids[qid] = self.tokenizer.convert_tokens_to_ids(self.qid2toks[qid])
+        return self.qid2ids[qid]
+
+    def _get_query_input(self, qid):
+        """ Return the ``[CLS] query [SEP]`` part of the BERT inputs for the query as an array of token ids """
+        if qid not in self._qid2input:
+            query_ids, maxqlen = self._get_query_ids(qid), self.config["maxqlen"]
+            if len(query_ids) > maxqlen:
+                logger.warning(f"Truncating query from {len(query_ids)} to {maxqlen}")
+                query_ids = query_ids[:maxqlen]
+            self._qid2input[qid] = np.array([self.cls] + list(query_ids) + [self.sep], dtype=np.int64)
+        return self._qid2input[qid]
+
+    def _get_passage_matrix(self, docid):
+        """
+        Return a tuple ``(passages, lengths)`` containing a ``(numpassages, maxseqlen - 3)`` matrix of the doc's passages of
+        token ids padded with ``pad`` and the passages' lengths. Matrices do not depend on the query, so the most recently
+        used ones are kept in memory as int32 (up to ``PASSAGE_CACHE_BYTES``) and cast when the inputs are assembled.
+        """
+        if docid in self._passage_cache:
+            self._passage_cache.move_to_end(docid)
+            return self._passage_cache[docid]
+
+        passages = self._get_passages(docid)
+        lengths = np.array([len(passage) for passage in passages], dtype=np.int64)
+        ids = np.concatenate([np.asarray(passage, dtype=np.int32) for passage in passages] + [np.empty(0, dtype=np.int32)])
+        # scatter the concatenated passages into the rows of the matrix, truncating each to the width of the matrix
+        width = self.config["maxseqlen"] - 3
+        rows = np.repeat(np.arange(len(passages)), lengths)
+        cols = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        keep = cols < width
+        matrix = np.full((len(passages), width), self.pad, dtype=np.int32)
+        matrix[rows[keep], cols[keep]] = ids[keep]
+
+        self._passage_cache[docid] = (matrix, np.minimum(lengths, width))
+        if len(self._passage_cache) > max(1, PASSAGE_CACHE_BYTES // (self.config["numpassages"] * width * matrix.itemsize)):
+            self._passage_cache.popitem(last=False)
+        return self._passage_cache[docid]
+
+    def _prepare_bert_inputs(self, query_input, passages, lengths):
+        """
+        Build the ``[CLS] query [SEP] passage [SEP]`` input of each passage, padded to ``maxseqlen``, from the query's
+        ``_get_query_input`` and the doc's ``_get_passage_matrix``. Returns a tuple ``(inp, mask, seg)`` of arrays with the
+        shape ``(numpassages, maxseqlen)``.
+        """
+        maxseqlen = self.config["maxseqlen"]
+        qlen = len(query_input)
+        # passages are truncated to fit the query and the final [SEP]
+        psglen = maxseqlen - qlen - 1
+        lengths = np.minimum(lengths, psglen)
+
+        inp = np.empty((len(passages), maxseqlen), dtype=np.int64)
+        inp[:, :qlen] = query_input
+        # the cached passage matrices are int32, and are cast to the input's dtype here
+        inp[:, qlen:-1] = passages[:, :psglen]
+        inp[:, -1] = self.pad
+        inp[np.arange(len(passages)), qlen + lengths] = self.sep
+
+        positions = np.arange(maxseqlen)
+        mask = (positions < (qlen + lengths + 1)[:, None]).astype(np.int64)
+        seg = np.repeat((positions >= qlen).astype(np.int64)[None, :], len(passages), axis=0)
         return inp, mask, seg
 
     def id2vec(self, qid, posid, negid=None, label=None):
@@ -350,48 +442,32 @@ class BertPassage(Extractor):
         maxseqlen = self.config["maxseqlen"]
         numpassages = self.config["numpassages"]
 
-        query_toks = self.qid2toks[qid]
-        pos_bert_inputs, pos_bert_masks, pos_bert_segs = [], [], []
-
-        # N.B: The passages in self.docid2passages are not bert tokenized
-        pos_passages = self.docid2passages[posid]
-        for tokenized_passage in pos_passages:
-            inp, mask, seg = self._prepare_bert_input(query_toks, tokenized_passage)
-            pos_bert_inputs.append(inp)
-            pos_bert_masks.append(mask)
-            pos_bert_segs.append(seg)
+        query_input = self._get_query_input(qid)
+        pos_bert_input, pos_mask, pos_seg = self._prepare_bert_inputs(query_input, *self._get_passage_matrix(posid))
 
         # TODO: Rename the posdoc key in the below dict to 'pos_bert_input'
         data = {
             "qid": qid,
             "posdocid": posid,
-            "pos_bert_input": np.array(pos_bert_inputs, dtype=np.long),
-            "pos_mask": np.array(pos_bert_masks, dtype=np.long),
-            "pos_seg": np.array(pos_bert_segs, dtype=np.long),
+            "pos_bert_input": pos_bert_input,
+            "pos_mask": pos_mask,
+            "pos_seg": pos_seg,
             "negdocid": "",
-            "neg_bert_input": np.zeros((numpassages, maxseqlen), dtype=np.long),
-            "neg_mask": np.zeros((numpassages, maxseqlen), dtype=np.long),
-            "neg_seg": np.zeros((numpassages, maxseqlen), dtype=np.long),
+            "neg_bert_input": np.zeros((numpassages, maxseqlen), dtype=np.int64),
+            "neg_mask": np.zeros((numpassages, maxseqlen), dtype=np.int64),
+            "neg_seg": np.zeros((numpassages, maxseqlen), dtype=np.int64),
             "label": np.repeat(np.array([label], dtype=np.float32), numpassages, 0),
         }
 
         if not negid:
             return data
 
-        neg_bert_inputs, neg_bert_masks, neg_bert_segs = [], [], []
-        neg_passages = self.docid2passages[negid]
-
-        for tokenized_passage in neg_passages:
-            inp, mask, seg = self._prepare_bert_input(query_toks, tokenized_passage)
-            neg_bert_inputs.append(inp)
-            neg_bert_masks.append(mask)
-            neg_bert_segs.append(seg)
-
-        if not neg_bert_inputs:
+        neg_passages, neg_lengths = self._get_passage_matrix(negid)
+        if not len(neg_lengths):
             raise MissingDocError(qid, negid)
 
         data["negdocid"] = negid
-        data["neg_bert_input"] = np.array(neg_bert_inputs, dtype=np.long)
-        data["neg_mask"] = np.array(neg_bert_masks, dtype=np.long)
-        data["neg_seg"] = np.array(neg_bert_segs, dtype=np.long)
+        data["neg_bert_input"], data["neg_mask"], data["neg_seg"] = self._prepare_bert_inputs(
+            query_input, neg_passages, neg_lengths
+        )
         return data
@@ -97,7 +97,7 @@ class BertText(Extractor):
             logger.info("Building bertext vocabulary")
             tokenize = self.tokenizer.tokenize
             self.qid2toks = {qid: tokenize(topics[qid]) for qid in tqdm(qids, desc="querytoks")}
-            self.docid2toks = {docid: tokenize(self.index.get_doc(docid)) for docid in tqdm(docids, desc="doctoks")}
+            self.docid2toks = self._tokenize_docs(docids)
             self.clsidx, self.sepidx = self.tokenizer.convert_tokens_to_ids(["CLS", "SEP"])
 
             self.cache_state(qids, docids)
@@ -1,3 +1,7 @@
+import hashlib
+import os
+from itertools import islice
+
 import numpy as np
 from pymagnitude import Magnitude, MagnitudeUtils
 
@@ -13,9 +17,12 @@ embedding_paths = {
 }
 
 pad_tok = "<pad>"
+# number of vectors read from Magnitude before they are written to the embedding matrix
+CONVERSION_CHUNK_SIZE = 100000
 
 
-def load_pretrained_embeddings(embedding_name):
+def prepare_embeddings(embedding_name):
+    """ Download and convert the embeddings unless they are cached, returning the paths to their matrix and vocab file """
     if embedding_name not in embedding_paths:
         raise ValueError(f"embedding name '{embedding_name}' is not a recognized embedding: {sorted(embedding_paths.keys())}")
 
@@ -24,27 +31,106 @@ def load_pretrained_embeddings(embedding_name):
     vocab_cache = embedding_cache / (embedding_name + ".vocab.txt")
 
     if numpy_cache.exists() and vocab_cache.exists():
-        logger.debug("loading embeddings from %s", numpy_cache)
-        stoi, itos = load_vocab_file(vocab_cache)
-        embeddings = np.load(numpy_cache, mmap_mode="r").reshape(len(stoi), -1)
-
-        return embeddings, itos, stoi
+        return numpy_cache, vocab_cache
 
     logger.debug("preparing embeddings and vocab")
     magnitude = Magnitude(MagnitudeUtils.download_model(embedding_paths[embedding_name], download_dir=embedding_cache))
 
-    terms, vectors = zip(*((term, vector) for term, vector in magnitude))
-    pad_vector = np.zeros(magnitude.dim, dtype=np.float32)
-    terms = [pad_tok] + list(terms)
-    vectors = np.array([pad_vector] + list(vectors), dtype=np.float32)
-    itos = {idx: term for idx, term in enumerate(terms)}
-
+    # stream the vectors into a preallocated matrix, so only one chunk of them is held in memory as Python objects.
+    # files are written under temporary names and then renamed, so a partial conversion is never mistaken for a cache
+    tmp_numpy_cache = numpy_cache.with_suffix(".tmp.npy")
+    tmp_vocab_cache = vocab_cache.with_suffix(".tmp.txt")
+    vectors = np.lib.format.open_memmap(tmp_numpy_cache, mode="w+", dtype=np.float32, shape=(len(magnitude) + 1, magnitude.dim))
+    vectors[0] = 0  # pad_tok
     logger.debug("saving embeddings to %s", numpy_cache)
-    np.save(numpy_cache, vectors, allow_pickle=False)
-    save_vocab_file(itos, vocab_cache)
-    stoi = {s: i for i, s in itos.items()}
+    with open(tmp_vocab_cache, "wt") as outf:
+        print(pad_tok, file=outf)
+        items, row = iter(magnitude), 1
+        for chunk in iter(lambda: list(islice(items, CONVERSION_CHUNK_SIZE)), []):
+            terms, chunk_vectors = zip(*chunk)
+            vectors[row : row + len(chunk)] = chunk_vectors
+            outf.write("".join(term + "\n" for term in terms))
+            row += len(chunk)
 
-    return vectors, itos, stoi
+    assert row == len(vectors), f"expected {len(vectors) - 1} vectors but Magnitude returned {row - 1}"
+    vectors.flush()
+    del vectors
+    os.replace(tmp_numpy_cache, numpy_cache)
+    os.replace(tmp_vocab_cache, vocab_cache)
+
+    return numpy_cache, vocab_cache
+
+
+def load_pretrained_embeddings(embedding_name):
+    numpy_cache, vocab_cache = prepare_embeddings(embedding_name)
+    logger.debug("loading embeddings from %s", numpy_cache)
+    stoi, itos = load_vocab_file(vocab_cache)
+    embeddings = np.load(numpy_cache, mmap_mode="r").reshape(len(stoi), -1)
+
+    return embeddings, itos, stoi
+
+
+class EmbeddingVocab:
+    """The vocab of pretrained embeddings, stored as a sorted array of UTF-8 encoded terms and the embedding row of each.
+
+    The arrays are cached as ``.npy`` files next to the vocab file and memory-mapped, so looking up terms does not require
+    building dicts of the whole vocab. As with ``load_vocab_file``, a term appearing on several lines maps to the last one.
+    """
+
+    def __init__(self, vocab_fn):
+        terms_fn = vocab_fn.with_suffix(".sorted.npy")
+        rows_fn = vocab_fn.with_suffix(".rows.npy")
+        if not (terms_fn.exists() and rows_fn.exists()):
+            with open(vocab_fn, "rt") as f:
+                terms = np.array([line.strip().encode("utf-8") for line in f], dtype=np.bytes_)
+            rows = np.argsort(terms, kind="stable").astype(np.int32)
+            np.save(terms_fn, terms[rows], allow_pickle=False)
+            np.save(rows_fn, rows, allow_pickle=False)
+
+        self.terms = np.load(terms_fn, mmap_mode="r")
+        self.rows = np.load(rows_fn, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.terms)
+
+    def lookup(self, terms):
+        """ Return an array containing the embedding row of each term in ``terms``, or -1 if the term is not in the vocab """
+        if not len(terms):
+            return np.empty(0, dtype=np.int64)
+
+        terms = np.array([term.encode("utf-8") for term in terms], dtype=np.bytes_)
+        # the last (i.e., highest) row of each term comes last among equal terms
+        pos = np.searchsorted(self.terms, terms, side="right") - 1
+        candidates = pos.clip(min=0)
+        found = (pos >= 0) & (self.terms[candidates] == terms)
+        return np.where(found, self.rows[candidates], -1)
+
+
+def load_embedding_subset(embedding_name, terms):
+    """
+    Return a tuple ``(vectors, found)`` containing a ``(len(terms), dim)`` matrix with the pretrained embedding of each term
+    in ``terms`` and a boolean array indicating which terms have one (the vectors of the others are zeros). Only these rows
+    are read from the memory-mapped embeddings, and the result is cached for the combination of embeddings and terms.
+    """
+    terms_hash = hashlib.md5("\n".join(terms).encode("utf-8")).hexdigest()
+    subset_fn = constants["CACHE_BASE_PATH"] / "embeddings" / "subsets" / embedding_name / f"{terms_hash}.npz"
+    if subset_fn.exists():
+        with np.load(subset_fn) as data:
+            return data["vectors"], data["found"]
+
+    numpy_cache, vocab_cache = prepare_embeddings(embedding_name)
+    term_rows = EmbeddingVocab(vocab_cache).lookup(terms)
+    found = term_rows >= 0
+    embeddings = np.load(numpy_cache, mmap_mode="r")
+    vectors = np.zeros((len(terms), embeddings.shape[-1]), dtype=np.float32)
+    # read each needed row once and in increasing order
+    rows, inverse = np.unique(term_rows[found], return_inverse=True)
+    vectors[found] = embeddings[rows][inverse]
+    logger.debug("found %s of %s terms in embeddings %s", found.sum(), len(terms), embedding_name)
+
+    os.makedirs(subset_fn.parent, exist_ok=True)
+    np.savez(subset_fn, vectors=vectors, found=found)
+    return vectors, found
 
 
 def load_vocab_file(fn):
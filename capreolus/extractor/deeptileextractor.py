@@ -1,14 +1,12 @@
 import math
-import os
+import multiprocessing
 import pickle
-import re
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from functools import reduce
 
 import numpy as np
 import torch
 from nltk import TextTilingTokenizer
-from pymagnitude import Magnitude, MagnitudeUtils
 from tqdm import tqdm
 
 from capreolus import ConfigOption, Dependency, constants
@@ -16,9 +14,60 @@ from capreolus.utils.common import padlist
 from capreolus.utils.loginit import get_logger
 
 from . import Extractor
+from .common import load_embedding_subset
+from .doccache import DocTokenCache
+from .tokenids import TokenIds, load_vocab, save_vocab
 
 logger = get_logger(__name__)
-CACHE_BASE_PATH = constants["CACHE_BASE_PATH"]
+MAX_THREADS = constants["MAX_THREADS"]
+# maximum number of (qid, docid) tiles to keep in memory
+TILE_CACHE_SIZE = 100000
+# TextTilingTokenizer's k (the size of the blocks compared when finding boundaries)
+TEXTTILING_K = 6
+# number of docs per unit of work when segmenting in worker processes
+SEGMENT_CHUNK_SIZE = 64
+
+
+def _slices_text(doc_toks, slicelen):
+    """ Join the tokens by a white space, but after every ``slicelen`` tokens insert a double newline character """
+    slice_count = math.ceil(len(doc_toks) / slicelen)
+    return "\n\n".join(" ".join(doc_toks[i * slicelen : i * slicelen + slicelen]) for i in range(slice_count))
+
+
+def _segment_bounds(doc_text, ttt):
+    """Return the segments of ``doc_text`` as a flat list of ``[start, end, start, end, ...]`` character offsets.
+
+    1. Tries to extract segments using nltk.TextTilingTokenizer (instance passed as an arg), which partitions the text
+    2. If that fails, simply splits on the double newlines between slices
+    """
+    try:
+        # tokenize() internally converts the doc_text to lowercase and removes non alpha numeric chars before tiling
+        # see https://www.nltk.org/_modules/nltk/tokenize/texttiling.html. Hence we don't have to do any
+        # preprocessing. However, the returned segments have everything (i.e non-alphanums) preserved.
+        ends = np.cumsum([len(segment) for segment in ttt.tokenize(doc_text)]).tolist()
+        starts = [0] + ends[:-1]
+    except ValueError:
+        # TextTilingTokenizer throws an error if the input is too short (eg: less than 100 chars) or if it could not
+        # find any paragraphs. In that case, naively split on every artificial paragraph that we inserted
+        starts, ends, start = [], [], 0
+        for paragraph in doc_text.split("\n\n"):
+            starts.append(start)
+            ends.append(start + len(paragraph))
+            start = ends[-1] + 2
+
+    return [offset for bounds in zip(starts, ends) for offset in bounds]
+
+
+def _bounds_to_segments(doc_text, bounds):
+    # Remove all paragraph breaks (the ones that were already there and the ones that we inserted) - we don't
+    # really need them once ttt is done
+    return [doc_text[start:end].replace("\n\n", " ") for start, end in zip(bounds[::2], bounds[1::2])]
+
+
+def _segment_chunk(args):
+    slicelen, k, docs = args
+    ttt = TextTilingTokenizer(k=k)
+    return [_segment_bounds(_slices_text(doc_toks, slicelen), ttt) for doc_toks in docs]
 
 
 @Extractor.register
@@ -29,13 +78,6 @@ class DeepTileExtractor(Extractor):
     pad = 0
     pad_tok = "<pad>"
 
-    embed_paths = {
-        "glove6b": "glove/light/glove.6B.300d",
-        "glove6b.50d": "glove/light/glove.6B.50d",
-        "w2vnews": "word2vec/light/GoogleNews-vectors-negative300",
-        "fasttext": "fasttext/light/wiki-news-300d-1M-subword",
-    }
-
     requires_random_seed = True
     dependencies = [
         Dependency(key="benchmark", module="benchmark", name=None),
@@ -56,30 +98,34 @@ class DeepTileExtractor(Extractor):
         ConfigOption("usecache", True),
     ]
 
-    def _get_pretrained_emb(self):
-        magnitude_cache = CACHE_BASE_PATH / "magnitude/"
-        return Magnitude(MagnitudeUtils.download_model(self.embed_paths[self.config["embeddings"]], download_dir=magnitude_cache))
+    def _load_pretrained_embeddings(self, terms):
+        return load_embedding_subset(self.config["embeddings"], terms)
 
     def load_state(self, qids, docids):
-        with open(self.get_state_cache_file_path(qids, docids), "rb") as f:
-            state_dict = pickle.load(f)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        if state_path.is_file():
+            # older caches pickled the token lists
+            with open(state_path, "rb") as f:
+                state_dict = pickle.load(f)
+            self.stoi, self.itos = state_dict["stoi"], state_dict["itos"]
             self.qid2toks = state_dict["qid2toks"]
-            self.docid2toks = state_dict["docid2toks"]
-            self.stoi = state_dict["stoi"]
-            self.itos = state_dict["itos"]
+            self.docid2ids = TokenIds.from_toks(state_dict["docid2toks"], self.stoi)
             self.docid2segments = state_dict["docid2segments"]
+            return
+
+        self.stoi, self.itos = load_vocab(state_path)
+        self.qid2toks = TokenIds.load(state_path / "queries").to_toks(self.itos)
+        self.docid2ids = TokenIds.load(state_path / "docs")
+        self.docid2segments = {
+            docid: self.clean_segments(segments)
+            for docid, segments in self._extract_segments(self.docid2ids.to_toks(self.itos)).items()
+        }
 
     def cache_state(self, qids, docids):
-        os.makedirs(self.get_cache_path(), exist_ok=True)
-        with open(self.get_state_cache_file_path(qids, docids), "wb") as f:
-            state_dict = {
-                "qid2toks": self.qid2toks,
-                "docid2toks": self.docid2toks,
-                "stoi": self.stoi,
-                "itos": self.itos,
-                "docid2segments": self.docid2segments,
-            }
-            pickle.dump(state_dict, f, protocol=-1)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        save_vocab(state_path, self.itos)
+        TokenIds.from_toks(self.qid2toks, self.stoi).save(state_path / "queries")
+        self.docid2ids.save(state_path / "docs")
 
     def get_tf_feature_description(self):
         raise NotImplementedError()
@@ -95,26 +141,48 @@ class DeepTileExtractor(Extractor):
         1. Tries to extract segments using nlt.TextTilingTokenizer (instance passed as an arg)
         2. If that fails, simply splits into segments of 20 tokens each
         """
-        # Join the tokens by a white space, but after every 20 tokens inside a double newline character
         # 20 tokens is an arbitrary decision.
-        slice_count = math.ceil(len(doc_toks) / slicelen)
-        tok_slices = [" ".join(doc_toks[i * slicelen : i * slicelen + slicelen]) for i in range(slice_count)]
-        doc_text = "\n\n".join(tok_slices)
-
+        doc_text = _slices_text(doc_toks, slicelen)
+        return _bounds_to_segments(doc_text, _segment_bounds(doc_text, ttt))
+
+    def _extract_segments(self, docid2toks):
+        """Segment each doc in ``docid2toks`` with TextTiling in a pool of worker processes, returning a dict in the format
+        ``{docid: segments}``. Segment boundaries are cached per docid, ``slicelen`` and k, so they are computed only once
+        for the index and tokenizer configs regardless of the other extractor options."""
+        slicelen = self.config["slicelen"]
+        cache_fn = (
+            self.index.get_cache_path()
+            / "doctoks"
+            / self.tokenizer.get_module_path()
+            / f"texttiling-slicelen{slicelen}-k{TEXTTILING_K}.sqlite3"
+        )
+        cache = DocTokenCache(cache_fn)
         try:
-            # tokenize() internally converts the doc_text to lowercase and removes non alpha numeric chars before tiling
-            # see https://www.nltk.org/_modules/nltk/tokenize/texttiling.html. Hence we don't have to do any
-            # preprocessing. However, the returned segments have everything (i.e non-alphanums) preserved.
-            segments = ttt.tokenize(doc_text)
-            # Remove all paragraph breaks (the ones that were already there and the ones that we inserted) - we don't
-            # really need them once ttt is done
-            segments = [re.sub("\n\n", " ", segment) for segment in segments]
-        except ValueError:
-            # TextTilingTokenizer throws an error if the input is too short (eg: less than 100 chars) or if it could not
-            # find any paragraphs. In that case, naively split on every artificial paragraph that we inserted
-            segments = doc_text.split("\n\n")
+            docid2bounds = cache.get_many(docid2toks)
+            missing = [docid for docid in docid2toks if docid not in docid2bounds]
+            logger.info("%s of %s documents found in the segment cache", len(docid2bounds), len(docid2toks))
+
+            chunks = [
+                (slicelen, TEXTTILING_K, [docid2toks[docid] for docid in missing[start : start + SEGMENT_CHUNK_SIZE]])
+                for start in range(0, len(missing), SEGMENT_CHUNK_SIZE)
+            ]
+            processes = min(MAX_THREADS, len(chunks))
+            if processes > 1:
+                with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                    chunk_bounds = list(tqdm(pool.imap(_segment_chunk, chunks), total=len(chunks), desc="Extracting segments"))
+            else:
+                chunk_bounds = [_segment_chunk(chunk) for chunk in tqdm(chunks, desc="Extracting segments")]
 
-        return segments
+            new_docid2bounds = dict(zip(missing, (bounds for chunk in chunk_bounds for bounds in chunk)))
+            cache.put_many(new_docid2bounds)
+            docid2bounds.update(new_docid2bounds)
+        finally:
+            cache.close()
+
+        return {
+            docid: _bounds_to_segments(_slices_text(doc_toks, slicelen), docid2bounds[docid])
+            for docid, doc_toks in docid2toks.items()
+        }
 
     def clean_segments(self, segments, p_len=30):
         """
@@ -130,42 +198,43 @@ class DeepTileExtractor(Extractor):
 
         return segments
 
-    def gaussian(self, x1, z1):
-        x = np.asarray(x1)
-        z = np.asarray(z1)
-        return np.exp((-(np.linalg.norm(x - z) ** 2)) / (2 * 1))
-
-    def color_grid(self, q_tok, topic_segment, embeddings_matrix):
-        """
-        See the section titles "Coloring" in the original paper: https://arxiv.org/pdf/1811.00606.pdf
-        Calculates TF, IDF and max gaussian for the given q_tok <> topic_segment pair
-        :param q_tok: List of tokens in a query
-        :param topic_segment: A single segment. String. (A document can have multiple segments)
-        """
+    def _segment_ids(self, segments):
+        """Convert a doc's segments to lists of token ids. Tokens missing from ``stoi`` are mapped to -1, and a padding
+        segment (i.e., ``pad_tok``) is mapped to ``[pad]``."""
+        return [[self.stoi.get(tok, -1) for tok in segment.split(" ")] for segment in segments]
 
-        channels = []
-        if q_tok != self.pad_tok and topic_segment != self.pad_tok:
-            segment_toks = topic_segment.split(" ")
-            tf = segment_toks.count(q_tok)
-
-            if self.config["tfchannel"]:
-                channels.append(tf)
-
-            channels.append(self.idf.get(q_tok, 0) if tf else 0)
-            sim = max(
-                self.gaussian(
-                    embeddings_matrix[self.stoi.get(segment_toks[i], self.pad)], embeddings_matrix[self.stoi.get(q_tok, self.pad)]
-                )
-                if segment_toks[i] != self.pad_tok
-                else 0
-                for i in range(len(segment_toks))
-            )
-            channels.append(sim)
-        else:
-            channels = [0.0] * self.config["tilechannels"]
+    def _query_features(self, query_toks):
+        """ Return the ids of ``query_toks`` (where tokens missing from ``stoi`` match no segment token) and their IDFs """
+        query_ids = np.array([self.stoi.get(tok, -2) for tok in query_toks], dtype=np.int64)
+        return query_ids, np.array([self.idf.get(tok, 0) for tok in query_toks], dtype=np.float64)
 
-        tile = torch.tensor(channels, dtype=torch.float)
-        return tile
+    def _tiles(self, query_ids, query_idfs, segment_ids, embeddings_matrix):
+        """ Compute the (maxqlen, passagelen, channels) tiles of every query term and segment at once (see ``create_visualization_matrix``) """
+        p_len = self.config["passagelen"]
+        segment_ids = segment_ids[:p_len]
+        lengths = np.array([len(ids) for ids in segment_ids], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        tok_ids = np.concatenate([np.asarray(ids, dtype=np.int64) for ids in segment_ids])
+        pad_segments = (lengths == 1) & (tok_ids[starts] == self.pad)
+
+        # max gaussian similarity between each query term and any segment token, where padding tokens count as 0
+        # and tokens without an embedding use the padding embedding
+        query_emb = embeddings_matrix[np.where(query_ids < 0, self.pad, query_ids)].astype(np.float64)
+        tok_emb = embeddings_matrix[np.where(tok_ids < 0, self.pad, tok_ids)].astype(np.float64)
+        sqdist = (query_emb ** 2).sum(axis=1)[:, None] + (tok_emb ** 2).sum(axis=1)[None, :] - 2 * query_emb @ tok_emb.T
+        gaussian = np.where(tok_ids == self.pad, 0, np.exp(-np.maximum(sqdist, 0) / 2))
+        sim = np.maximum.reduceat(gaussian, starts, axis=1)
+
+        tf = np.add.reduceat((tok_ids[None, :] == query_ids[:, None]).astype(np.float64), starts, axis=1)
+        channels = [query_idfs[:, None] * (tf > 0), sim]
+        if self.config["tfchannel"]:
+            channels.insert(0, tf)
+
+        tiles = np.zeros((len(query_ids), p_len, self.config["tilechannels"]), dtype=np.float32)
+        tiles[:, : len(segment_ids), : len(channels)] = np.stack(channels, axis=-1)
+        tiles[query_ids == self.pad] = 0
+        tiles[:, : len(segment_ids)][:, pad_segments] = 0
+        return tiles
 
     def create_visualization_matrix(self, query_toks, document_segments, embeddings_matrix):
         """
@@ -174,38 +243,39 @@ class DeepTileExtractor(Extractor):
         The 2nd and 3rd dimensions (i.e maxqlen and passagelen) together represents a "tile" between a query token and
         a passage (i.e doc segment). The "tile" is up to dimension 3 - it contains TF of the query term in that passage,
         idf of the query term, and the max word2vec similarity between query term and any term in the passage
+        See the section titles "Coloring" in the original paper: https://arxiv.org/pdf/1811.00606.pdf
         :param query_toks: A list of tokens in the query. Eg: ['hello', 'world']
         :param document_segments: List of segments in a document. Each segment is a string
         :param embeddings_matrix: Used to look up word2vec embeddings
         """
-        q_len = self.config["maxqlen"]
-        p_len = self.config["passagelen"]
-        # The 'document_segments' arg to the method is a list of segments (segregated by topic) in a single document
-        # Hence query_to_doc_tiles matrix stores the tiles (scores) b/w each query tok and each passage in the doc
-        query_to_doc_tiles = torch.zeros(1, q_len, p_len, self.config["tilechannels"]).float()
+        query_ids, query_idfs = self._query_features(query_toks[: self.config["maxqlen"]])
+        tiles = self._tiles(query_ids, query_idfs, self._segment_ids(document_segments), embeddings_matrix)
+        return torch.from_numpy(tiles).unsqueeze(0)
 
-        for q_idx in range(q_len):
-            q_tok = query_toks[q_idx]
-            for seg_idx in range(p_len):
-                topic_segment = document_segments[seg_idx]
-                tile = self.color_grid(q_tok, topic_segment, embeddings_matrix)
-                query_to_doc_tiles[0][q_idx][seg_idx] = tile
+    def _get_tiles(self, qid, docid):
+        """ Return the tiles of ``qid`` and ``docid``, which are cached because they do not change across epochs """
+        key = (qid, docid)
+        if key in self._tile_cache:
+            self._tile_cache.move_to_end(key)
+            return self._tile_cache[key]
 
-        return query_to_doc_tiles
+        query_toks = padlist(self.qid2toks[qid], self.config["maxqlen"], pad_token=self.pad_tok)
+        query_ids, query_idfs = self._query_features(query_toks)
+        tiles = torch.from_numpy(self._tiles(query_ids, query_idfs, self.docid2segment_ids[docid], self.embeddings))
+        self._tile_cache[key] = tiles.unsqueeze(0)
+        if len(self._tile_cache) > TILE_CACHE_SIZE:
+            self._tile_cache.popitem(last=False)
+        return self._tile_cache[key]
 
     def _build_embedding_matrix(self):
-        magnitude_embeddings = self._get_pretrained_emb()
-        embedding_vocab = set(term for term, _ in magnitude_embeddings)
-
-        embedding_matrix = np.zeros((len(self.stoi), magnitude_embeddings.dim), dtype=np.float32)
-        for term, idx in tqdm(self.stoi.items(), desc="Building embedding matrix"):
-            if term in embedding_vocab:
-                embedding_matrix[idx] = magnitude_embeddings.query(term)
-            elif term == self.pad_tok:
-                padidx = idx
-            else:
-                embedding_matrix[idx] = np.random.normal(scale=0.5, size=magnitude_embeddings.dim)
-            embedding_matrix[padidx] = np.zeros(magnitude_embeddings.dim)
+        # only the rows of the terms in our vocab are read from the pretrained embeddings
+        embedding_matrix, found = self._load_pretrained_embeddings(sorted(self.stoi, key=self.stoi.get))
+        embedding_matrix = np.array(embedding_matrix, dtype=np.float32)
+
+        missed = ~found
+        missed[self.stoi[self.pad_tok]] = False
+        embedding_matrix[self.stoi[self.pad_tok]] = 0
+        embedding_matrix[missed] = np.random.normal(scale=0.5, size=(int(missed.sum()), embedding_matrix.shape[1]))
 
         self.embeddings = embedding_matrix
 
@@ -215,18 +285,17 @@ class DeepTileExtractor(Extractor):
             logger.info("Vocabulary loaded from cache")
         else:
             tokenize = self.tokenizer.tokenize
-            ttt = TextTilingTokenizer(k=6)  # TODO: Make K configurable?
-
             # TODO: Move the stoi and itos creation to a reusable mixin
             self.qid2toks = {qid: tokenize(topics[qid]) for qid in qids}
-            self.docid2toks = {docid: tokenize(self.index.get_doc(docid)) for docid in docids}
+            self.docid2toks = self._tokenize_docs(docids)
             self._extend_stoi(self.qid2toks.values(), calc_idf=True)
             self._extend_stoi(self.docid2toks.values(), calc_idf=True)
             self.itos = {i: s for s, i in self.stoi.items()}
             self.docid2segments = {
-                doc_id: self.clean_segments(self.extract_segment(doc_toks, ttt, slicelen=self.config["slicelen"]))
-                for doc_id, doc_toks in tqdm(self.docid2toks.items(), desc="Extracting segments")
+                docid: self.clean_segments(segments) for docid, segments in self._extract_segments(self.docid2toks).items()
             }
+            self.docid2ids = TokenIds.from_toks(self.docid2toks, self.stoi)
+            del self.docid2toks
             if self.config["usecache"]:
                 self.cache_state(qids, docids)
 
@@ -242,16 +311,19 @@ class DeepTileExtractor(Extractor):
         self.stoi = {self.pad_tok: self.pad}
         self.idf = defaultdict(lambda: 0)
         self.qid2toks = defaultdict(list)
-        self.docid2toks = defaultdict(list)
         self.docid2segments = {}
         self.embeddings = None
 
         self._build_vocab(qids, docids, topics)
         self._build_embedding_matrix()
+        # segments are converted to token ids once rather than split and looked up in every id2vec call
+        self.docid2segment_ids = TokenIds.from_lists(
+            {docid: self._segment_ids(segments) for docid, segments in self.docid2segments.items()}, nested=True
+        )
+        self._tile_cache = OrderedDict()
 
     def id2vec(self, qid, posdocid, negdocid=None, **kwargs):
-        query_toks = padlist(self.qid2toks[qid], self.config["maxqlen"], pad_token=self.pad_tok)
-        posdoc_tilebar = self.create_visualization_matrix(query_toks, self.docid2segments[posdocid], self.embeddings)
+        posdoc_tilebar = self._get_tiles(qid, posdocid)
 
         data = {
             "qid": qid,
@@ -263,7 +335,7 @@ class DeepTileExtractor(Extractor):
         }
 
         if negdocid:
-            negdoc_tilebar = self.create_visualization_matrix(query_toks, self.docid2segments[negdocid], self.embeddings)
+            negdoc_tilebar = self._get_tiles(qid, negdocid)
             data["negdocid"] = negdocid
             data["negdoc"] = negdoc_tilebar
 
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from capreolus import get_logger
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+# stay below SQLite's limit on the number of parameters in one statement
+MAX_QUERY_PARAMS = 900
+
+
+def _encode_toks(toks):
+    if len(toks) and not isinstance(toks[0], str):
+        return b"i" + np.asarray(toks, dtype=np.int32).tobytes()
+    return b"s" + "\0".join(toks).encode("utf-8")
+
+
+def _decode_toks(blob):
+    kind, payload = blob[:1], blob[1:]
+    if kind == b"i":
+        return np.frombuffer(payload, dtype=np.int32).tolist()
+    return payload.decode("utf-8").split("\0") if payload else []
+
+
+class DocTokenCache:
+    """A persistent cache of tokenized documents, stored in an SQLite database at ``path``.
+
+    Entries are keyed by docid only, so each cache must correspond to a single combination of index (i.e., document
+    contents) and tokenizer config. Tokens are stored as either strings or int32 token ids.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(str(path), timeout=600)
+        self.db.execute("CREATE TABLE IF NOT EXISTS doctoks (docid TEXT PRIMARY KEY, toks BLOB NOT NULL)")
+
+    def get_many(self, docids):
+        """ Return a dict in the format ``{docid: tokens}`` containing the cached docs among ``docids`` """
+        docids = list(docids)
+        found = {}
+        for start in range(0, len(docids), MAX_QUERY_PARAMS):
+            batch = docids[start : start + MAX_QUERY_PARAMS]
+            query = "SELECT docid, toks FROM doctoks WHERE docid IN (%s)" % ",".join("?" * len(batch))
+            found.update((docid, _decode_toks(blob)) for docid, blob in self.db.execute(query, batch))
+        return found
+
+    def put_many(self, docid2toks):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO doctoks (docid, toks) VALUES (?, ?)",
+                ((docid, _encode_toks(toks)) for docid, toks in docid2toks.items()),
+            )
+
+    def close(self):
+        self.db.close()
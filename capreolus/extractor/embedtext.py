@@ -1,4 +1,5 @@
 from collections import defaultdict, Counter
+from itertools import chain
 
 import numpy as np
 import tensorflow as tf
@@ -8,7 +9,7 @@ from capreolus.utils.common import padlist
 from capreolus.utils.exceptions import MissingDocError
 
 from . import Extractor
-from .common import load_pretrained_embeddings
+from .common import load_embedding_subset
 
 logger = get_logger(__name__)
 
@@ -41,10 +42,17 @@ class EmbedText(Extractor):
         self._next_oov_index = -1
 
     def _load_pretrained_embeddings(self):
-        if self.embeddings is not None:
-            return
+        """
+        Load the pretrained embeddings of the terms in ``qid2toks`` and ``docid2toks`` into a compact matrix whose first row
+        is padding, and create a vocab containing only these terms. Terms without an embedding are handled as OOV terms.
+        """
+        terms = sorted(set(chain.from_iterable(chain(self.qid2toks.values(), self.docid2toks.values()))) - {self.pad_tok})
+        vectors, found = load_embedding_subset(self.config["embeddings"], terms)
 
-        self.embeddings, self.itos, self.stoi = load_pretrained_embeddings(self.config["embeddings"])
+        self.embeddings = np.concatenate([np.zeros((1, vectors.shape[1]), dtype=np.float32), vectors[found]])
+        self.itos = dict(enumerate([self.pad_tok] + [term for term, is_found in zip(terms, found) if is_found]))
+        self.stoi = {term: idx for idx, term in self.itos.items()}
+        logger.info("embedding matrix %s constructed, with shape %s", self.config["embeddings"], self.embeddings.shape)
 
     def get_tf_feature_description(self):
         feature_description = {
@@ -87,8 +95,6 @@ class EmbedText(Extractor):
         return [self.idf.get(tok, 0) for tok in toks]
 
     def preprocess(self, qids, docids, topics):
-        self._load_pretrained_embeddings()
-
         self.index.create_index()
 
         self.qid2toks = {}
@@ -98,7 +104,13 @@ class EmbedText(Extractor):
         for qid in qids:
             if qid not in self.qid2toks:
                 self.qid2toks[qid] = self.tokenizer.tokenize(topics[qid])
-                self._add_oov_to_vocab(self.qid2toks[qid])
+
+        self.docid2toks = self._tokenize_docs(docids)
+
+        self._next_oov_index = -1
+        self._load_pretrained_embeddings()
+        for toks in chain(self.qid2toks.values(), self.docid2toks.values()):
+            self._add_oov_to_vocab(toks)
 
         query_lengths = Counter(len(toks) for toks in self.qid2toks.values())
         if any(qlen > self.config["maxqlen"] for qlen in query_lengths):
@@ -108,12 +120,33 @@ class EmbedText(Extractor):
                 sorted(query_lengths.items()),
             )
 
-    def get_doc_tokens(self, docid):
-        if docid not in self.docid2toks:
-            self.docid2toks[docid] = self.tokenizer.tokenize(self.index.get_doc(docid))
-            self._add_oov_to_vocab(self.docid2toks[docid])
+        self._build_id_arrays()
 
-        return self.docid2toks[docid]
+    def _build_id_arrays(self):
+        """
+        Convert the queries and docs to fixed-length arrays of token ids, so that id2vec does not look up any tokens.
+        Queries and docs are stored as the rows of ``(nqueries, maxqlen)`` and ``(ndocs, maxdoclen)`` matrices, which lets
+        batch2vec gather a whole batch at once, and ``doclens`` contains the docs' untruncated lengths.
+        """
+        qlen, doclen = self.config["maxqlen"], self.config["maxdoclen"]
+        pad = self.stoi[self.pad_tok]
+
+        self.qid2row = {qid: row for row, qid in enumerate(self.qid2toks)}
+        self.query_ids = np.array(
+            [self._tok2vec(padlist(toks, qlen, self.pad_tok)) for toks in self.qid2toks.values()], dtype=np.int64
+        ).reshape(len(self.qid2toks), qlen)
+        self.query_idfs = np.array(
+            [padlist(self._get_idf(toks), qlen, 0) for toks in self.qid2toks.values()], dtype=np.float32
+        ).reshape(len(self.qid2toks), qlen)
+
+        self.docid2row = {docid: row for row, docid in enumerate(self.docid2toks)}
+        self.doclens = np.array([len(toks) for toks in self.docid2toks.values()], dtype=np.int64)
+        self.doc_ids = np.full((len(self.docid2toks), doclen), pad, dtype=np.int32)
+        for row, toks in enumerate(self.docid2toks.values()):
+            self.doc_ids[row, : min(len(toks), doclen)] = self._tok2vec(toks[:doclen])
+
+        # the token strings are no longer needed once every doc is an array of ids
+        self.docid2toks = {}
 
     def _add_oov_to_vocab(self, tokens):
         for tok in tokens:
@@ -125,38 +158,57 @@ class EmbedText(Extractor):
     def _tok2vec(self, toks):
         return [self.stoi[tok] for tok in toks]
 
-    def id2vec(self, qid, posid, negid=None, **kwargs):
-        query = self.qid2toks[qid]
+    def _get_doc_rows(self, qids, docids):
+        rows = np.array([self.docid2row.get(docid, -1) for docid in docids], dtype=np.int64)
+        missing = rows < 0
+        missing[~missing] = self.doclens[rows[~missing]] == 0
+        if missing.any():
+            idx = int(np.argmax(missing))
+            raise MissingDocError(qids[idx], docids[idx])
 
-        # TODO find a way to calculate qlen/doclen stats earlier, so we can log them and check sanity of our values
-        qlen, doclen = self.config["maxqlen"], self.config["maxdoclen"]
-        posdoc = self.get_doc_tokens(posid)
-        if not posdoc:
-            raise MissingDocError(qid, posid)
+        return rows
 
-        idfs = padlist(self._get_idf(query), qlen, 0)
-        query = self._tok2vec(padlist(query, qlen, self.pad_tok))
-        posdoc = self._tok2vec(padlist(posdoc, doclen, self.pad_tok))
+    def id2vec(self, qid, posid, negid=None, **kwargs):
+        # queries and docs were converted to arrays of ids by preprocess, so only the rows need to be gathered here
+        qrow = self.qid2row[qid]
+        posdoc = self.doc_ids[self._get_doc_rows([qid], [posid])[0]].astype(np.int64)
 
         # TODO determine whether pin_memory is happening. may not be because we don't place the strings in a np or torch object
         data = {
             "qid": qid,
             "posdocid": posid,
-            "idfs": np.array(idfs, dtype=np.float32),
-            "query": np.array(query, dtype=np.long),
-            "posdoc": np.array(posdoc, dtype=np.long),
-            "query_idf": np.array(idfs, dtype=np.float32),
+            "idfs": self.query_idfs[qrow],
+            "query": self.query_ids[qrow],
+            "posdoc": posdoc,
+            "query_idf": self.query_idfs[qrow],
             "negdocid": "",
             "negdoc": np.zeros(self.config["maxdoclen"], dtype=np.long),
         }
 
         if negid:
-            negdoc = self.get_doc_tokens(negid)
-            if not negdoc:
-                raise MissingDocError(qid, negid)
-
-            negdoc = self._tok2vec(padlist(negdoc, doclen, self.pad_tok))
             data["negdocid"] = negid
-            data["negdoc"] = np.array(negdoc, dtype=np.long)
+            data["negdoc"] = self.doc_ids[self._get_doc_rows([qid], [negid])[0]].astype(np.int64)
+
+        return data
+
+    def batch2vec(self, qids, posids, negids=None, labels=None):
+        qids, posids = list(qids), list(posids)
+        qrows = np.array([self.qid2row[qid] for qid in qids], dtype=np.int64)
+        query_idfs = self.query_idfs[qrows]
+
+        data = {
+            "qid": qids,
+            "posdocid": posids,
+            "idfs": query_idfs,
+            "query": self.query_ids[qrows],
+            "posdoc": self.doc_ids[self._get_doc_rows(qids, posids)].astype(np.int64),
+            "query_idf": query_idfs,
+            "negdocid": [""] * len(qids),
+            "negdoc": np.zeros((len(qids), self.config["maxdoclen"]), dtype=np.int64),
+        }
+
+        if negids is not None:
+            data["negdocid"] = list(negids)
+            data["negdoc"] = self.doc_ids[self._get_doc_rows(qids, data["negdocid"])].astype(np.int64)
 
         return data
@@ -0,0 +1,118 @@
+import math
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from capreolus import constants, get_logger
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+MAX_THREADS = constants["MAX_THREADS"]
+
+# shards smaller than this are not worth starting a worker (and a JVM) for
+MIN_SHARD_SIZE = 2000
+
+_worker_index = None
+_worker_tokenizer = None
+_worker_method = None
+
+
+def _module_spec(module):
+    return module.module_name, module.config._as_dict()
+
+
+def _init_worker(index_spec, tokenizer_spec, method):
+    global _worker_index, _worker_tokenizer, _worker_method
+    from capreolus.index import Index
+    from capreolus.tokenizer import Tokenizer
+
+    _worker_index = Index.create(*index_spec)
+    _worker_tokenizer = Tokenizer.create(*tokenizer_spec)
+    _worker_method = method
+
+
+def _tokenize_docs(index, tokenizer, docids, method):
+    docs = [doc if doc else "" for doc in index.get_docs(docids)]
+    return [list(toks) for toks in getattr(tokenizer, method)(docs)] if docs else []
+
+
+def _tokenize_shard(args):
+    shard_fn, docids = args
+    doc_toks = _tokenize_docs(_worker_index, _worker_tokenizer, docids, _worker_method)
+
+    # tokens are streamed back through the filesystem as flat arrays rather than pickled through the pool's pipe.
+    # str tokens are stored as one "\0"-joined UTF-8 string (as in DocTokenCache) and token ids as an int64 array
+    tokens = [tok for toks in doc_toks for tok in toks]
+    offsets = np.cumsum([0] + [len(toks) for toks in doc_toks], dtype=np.int64)
+    if tokens and isinstance(tokens[0], str):
+        arrays = {"text": np.frombuffer("\0".join(tokens).encode("utf-8"), dtype=np.uint8)}
+    else:
+        arrays = {"ids": np.asarray(tokens, dtype=np.int64)}
+    tmp_fn = f"{shard_fn}.tmp.npz"
+    with open(tmp_fn, "wb") as outf:
+        np.savez(outf, offsets=offsets, **arrays)
+    os.replace(tmp_fn, shard_fn)
+    return shard_fn
+
+
+def _load_shard(shard_fn):
+    with np.load(shard_fn) as data:
+        offsets = data["offsets"]
+        if "text" in data.files:
+            tokens = data["text"].tobytes().decode("utf-8").split("\0")
+        else:
+            tokens = data["ids"].tolist()
+    os.remove(shard_fn)
+    return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def tokenize_docs(index, tokenizer, docids, shard_path, method="tokenize", processes=MAX_THREADS, desc="doctoks"):
+    """Tokenize the contents of ``docids`` with a pool of worker processes.
+
+    The docids are split into contiguous shards. Each worker creates its own copy of ``index`` and ``tokenizer`` (and
+    thus its own JVM) from their configs, reads its shard's documents with ``index.get_docs`` and writes the shard's
+    tokens to ``shard_path``. Shards are merged in order, so the result (and any vocabulary built by iterating over it)
+    does not depend on the number of processes. Small inputs are tokenized in this process.
+
+    Args:
+        index (Index): index to read documents from
+        tokenizer (Tokenizer): tokenizer to apply to each document
+        docids (list): docids to tokenize
+        shard_path (Path): directory to write temporary shard files to
+        method (str): name of the tokenizer method to call with a list of documents (e.g., ``"tokenize"`` or ``"encode"``)
+        processes (int): maximum number of worker processes
+
+    Returns:
+        dict: a dict in the format ``{docid: tokens}``, with keys in the order of ``docids``
+    """
+
+    docids = list(dict.fromkeys(docids))
+    nshards = min(processes, math.ceil(len(docids) / MIN_SHARD_SIZE))
+    if nshards <= 1:
+        doc_toks = []
+        for start in tqdm(range(0, len(docids), MIN_SHARD_SIZE), desc=desc):
+            doc_toks.extend(_tokenize_docs(index, tokenizer, docids[start : start + MIN_SHARD_SIZE], method))
+        return dict(zip(docids, doc_toks))
+
+    # use more shards than processes so that slow shards do not leave workers idle
+    shard_size = math.ceil(len(docids) / (nshards * 4))
+    shards = [docids[start : start + shard_size] for start in range(0, len(docids), shard_size)]
+    shard_path = str(shard_path)
+    os.makedirs(shard_path, exist_ok=True)
+    shard_args = [(os.path.join(shard_path, f"shard{idx}.npz"), shard) for idx, shard in enumerate(shards)]
+    logger.info("tokenizing %s documents in %s shards with %s processes", len(docids), len(shards), nshards)
+
+    doc_toks = []
+    # workers start their own JVMs, which cannot be inherited from this process with fork
+    context = multiprocessing.get_context("spawn")
+    initargs = (_module_spec(index), _module_spec(tokenizer), method)
+    try:
+        with context.Pool(nshards, initializer=_init_worker, initargs=initargs) as pool:
+            for shard_fn in tqdm(pool.imap(_tokenize_shard, shard_args), total=len(shards), desc=desc):
+                doc_toks.extend(_load_shard(shard_fn))
+    finally:
+        shutil.rmtree(shard_path, ignore_errors=True)
+
+    return dict(zip(docids, doc_toks))
@@ -126,26 +126,16 @@ class PooledBertPassage(BertPassage):
         maxseqlen = self.config["maxseqlen"]
         numpassages = self.config["numpassages"]
 
-        query_toks = self.qid2toks[qid]
-        pos_bert_inputs = []
-        pos_bert_masks = []
-        pos_bert_segs = []
-
-        # N.B: The passages in self.docid2passages are not bert tokenized
-        pos_passages = self.docid2passages[posid]
-        for tokenized_passage in pos_passages:
-            inp, mask, seg = self._prepare_bert_input(query_toks, tokenized_passage)
-            pos_bert_inputs.append(inp)
-            pos_bert_masks.append(mask)
-            pos_bert_segs.append(seg)
+        query_input = self._get_query_input(qid)
+        pos_bert_input, pos_mask, pos_seg = self._prepare_bert_inputs(query_input, *self._get_passage_matrix(posid))
 
         # TODO: Rename the posdoc key in the below dict to 'pos_bert_input'
         data = {
             "qid": qid,
             "posdocid": posid,
-            "pos_bert_input": np.array(pos_bert_inputs, dtype=np.long),
-            "pos_mask": np.array(pos_bert_masks, dtype=np.long),
-            "pos_seg": np.array(pos_bert_segs, dtype=np.long),
+            "pos_bert_input": pos_bert_input,
+            "pos_mask": pos_mask,
+            "pos_seg": pos_seg,
             "negdocid": "",
             "neg_bert_input": np.zeros((numpassages, maxseqlen), dtype=np.long),
             "neg_mask": np.zeros((numpassages, maxseqlen), dtype=np.long),
@@ -156,20 +146,13 @@ class PooledBertPassage(BertPassage):
         if not negid:
             return data
 
-        neg_bert_inputs, neg_bert_masks, neg_bert_segs = [], [], []
-        neg_passages = self.docid2passages[negid]
-        for tokenized_passage in neg_passages:
-            inp, mask, seg = self._prepare_bert_input(query_toks, tokenized_passage)
-            neg_bert_inputs.append(inp)
-            neg_bert_masks.append(mask)
-            neg_bert_segs.append(seg)
-
-        if not neg_bert_inputs:
+        neg_passages, neg_lengths = self._get_passage_matrix(negid)
+        if not len(neg_lengths):
             raise MissingDocError(qid, negid)
 
         data["negdocid"] = negid
-        data["neg_bert_input"] = np.array(neg_bert_inputs, dtype=np.long)
-        data["neg_mask"] = np.array(neg_bert_masks, dtype=np.long)
-        data["neg_seg"] = np.array(neg_bert_segs, dtype=np.long)
+        data["neg_bert_input"], data["neg_mask"], data["neg_seg"] = self._prepare_bert_inputs(
+            query_input, neg_passages, neg_lengths
+        )
 
         return data
@@ -1,16 +1,15 @@
-import os
 import pickle
 from collections import defaultdict
 
 import numpy as np
 import tensorflow as tf
-from tqdm import tqdm
 
 from capreolus import ConfigOption, Dependency, get_logger
 from capreolus.utils.common import padlist
 from capreolus.utils.exceptions import MissingDocError
 from . import Extractor
-from .common import load_pretrained_embeddings
+from .tokenids import TokenIds, load_vocab, save_vocab
+from .common import load_embedding_subset
 
 logger = get_logger(__name__)
 
@@ -39,18 +38,25 @@ class SlowEmbedText(Extractor):
     pad_tok = "<pad>"
 
     def load_state(self, qids, docids):
-        with open(self.get_state_cache_file_path(qids, docids), "rb") as f:
-            state_dict = pickle.load(f)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        if state_path.is_file():
+            # older caches pickled the token lists
+            with open(state_path, "rb") as f:
+                state_dict = pickle.load(f)
+            self.stoi, self.itos = state_dict["stoi"], state_dict["itos"]
             self.qid2toks = state_dict["qid2toks"]
-            self.docid2toks = state_dict["docid2toks"]
-            self.stoi = state_dict["stoi"]
-            self.itos = state_dict["itos"]
+            self.docid2ids = TokenIds.from_toks(state_dict["docid2toks"], self.stoi)
+            return
+
+        self.stoi, self.itos = load_vocab(state_path)
+        self.qid2toks = TokenIds.load(state_path / "queries").to_toks(self.itos)
+        self.docid2ids = TokenIds.load(state_path / "docs")
 
     def cache_state(self, qids, docids):
-        os.makedirs(self.get_cache_path(), exist_ok=True)
-        with open(self.get_state_cache_file_path(qids, docids), "wb") as f:
-            state_dict = {"qid2toks": self.qid2toks, "docid2toks": self.docid2toks, "stoi": self.stoi, "itos": self.itos}
-            pickle.dump(state_dict, f, protocol=-1)
+        state_path = self.get_state_cache_file_path(qids, docids)
+        save_vocab(state_path, self.itos)
+        TokenIds.from_toks(self.qid2toks, self.stoi).save(state_path / "queries")
+        self.docid2ids.save(state_path / "docs")
 
     def get_tf_feature_description(self):
         feature_description = {
@@ -102,10 +108,12 @@ class SlowEmbedText(Extractor):
         else:
             tokenize = self.tokenizer.tokenize
             self.qid2toks = {qid: tokenize(topics[qid]) for qid in qids}
-            self.docid2toks = {docid: tokenize(self.index.get_doc(docid)) for docid in docids}
+            self.docid2toks = self._tokenize_docs(docids)
             self._extend_stoi(self.qid2toks.values(), calc_idf=self.config["calcidf"])
             self._extend_stoi(self.docid2toks.values(), calc_idf=self.config["calcidf"])
             self.itos = {i: s for s, i in self.stoi.items()}
+            self.docid2ids = TokenIds.from_toks(self.docid2toks, self.stoi)
+            del self.docid2toks
             logger.info(f"vocabulary constructed, with {len(self.itos)} terms in total")
             if self.config["usecache"]:
                 self.cache_state(qids, docids)
@@ -113,25 +121,23 @@ class SlowEmbedText(Extractor):
     def _get_idf(self, toks):
         return [self.idf.get(tok, 0) for tok in toks]
 
-    def _load_pretrained_embeddings(self):
-        return load_pretrained_embeddings(self.config["embeddings"])
+    def _load_pretrained_embeddings(self, terms):
+        return load_embedding_subset(self.config["embeddings"], terms)
 
     def _build_embedding_matrix(self):
         assert len(self.stoi) > 1  # needs more vocab than self.pad_tok
 
-        embeddings, _, embedding_stoi = self._load_pretrained_embeddings()
-        emb_dim = embeddings.shape[-1]
-        embed_matrix = np.zeros((len(self.stoi), emb_dim), dtype=np.float32)
+        # only the rows of the terms in our vocab are read from the pretrained embeddings
+        embed_matrix, found = self._load_pretrained_embeddings([self.itos[idx] for idx in range(len(self.itos))])
+        embed_matrix = np.array(embed_matrix, dtype=np.float32)
+        emb_dim = embed_matrix.shape[-1]
 
-        n_missed = 0
-        for term, idx in tqdm(self.stoi.items()):
-            if term in embedding_stoi:
-                embed_matrix[idx] = embeddings[embedding_stoi[term]]
-            elif term == self.pad_tok:
-                embed_matrix[idx] = np.zeros(emb_dim)
-            else:
-                n_missed += 1
-                embed_matrix[idx] = np.zeros(emb_dim) if self.config["zerounk"] else np.random.normal(scale=0.5, size=emb_dim)
+        missed = ~found
+        missed[self.pad] = False
+        embed_matrix[self.pad] = 0
+        n_missed = int(missed.sum())
+        if not self.config["zerounk"]:
+            embed_matrix[missed] = np.random.normal(scale=0.5, size=(n_missed, emb_dim))
 
         logger.info(f"embedding matrix {self.config['embeddings']} constructed, with shape {embed_matrix.shape}")
         if n_missed > 0:
@@ -156,7 +162,6 @@ class SlowEmbedText(Extractor):
         self.itos = {self.pad: self.pad_tok}
         self.stoi = {self.pad_tok: self.pad}
         self.qid2toks = defaultdict(list)
-        self.docid2toks = defaultdict(list)
         self.idf = defaultdict(lambda: 0)
         self.embeddings = None
         # self.cache = self.load_cache()    # TODO
@@ -168,19 +173,25 @@ class SlowEmbedText(Extractor):
         # return [self.embeddings[self.stoi[tok]] for tok in toks]
         return [self.stoi[tok] for tok in toks]
 
+    def _pad_ids(self, ids, maxlen):
+        padded = np.full(maxlen, self.pad, dtype=np.int64)
+        ids = ids[:maxlen]
+        padded[: len(ids)] = ids
+        return padded
+
     def id2vec(self, qid, posid, negid=None, label=None):
         assert label is not None
         query = self.qid2toks[qid]
 
         # TODO find a way to calculate qlen/doclen stats earlier, so we can log them and check sanity of our values
         qlen, doclen = self.config["maxqlen"], self.config["maxdoclen"]
-        posdoc = self.docid2toks.get(posid, None)
-        if not posdoc:
+        posdoc = self.docid2ids.get(posid)
+        if posdoc is None or len(posdoc) == 0:
             raise MissingDocError(qid, posid)
 
         idfs = padlist(self._get_idf(query), qlen, 0)
         query = self._tok2vec(padlist(query, qlen, self.pad_tok))
-        posdoc = self._tok2vec(padlist(posdoc, doclen, self.pad_tok))
+        posdoc = self._pad_ids(posdoc, doclen)
 
         # TODO determine whether pin_memory is happening. may not be because we don't place the strings in a np or torch object
         data = {
@@ -188,7 +199,7 @@ class SlowEmbedText(Extractor):
             "posdocid": posid,
             "idfs": np.array(idfs, dtype=np.float32),
             "query": np.array(query, dtype=np.long),
-            "posdoc": np.array(posdoc, dtype=np.long),
+            "posdoc": posdoc,
             "query_idf": np.array(idfs, dtype=np.float32),
             "negdocid": "",
             "negdoc": np.zeros(self.config["maxdoclen"], dtype=np.long),
@@ -196,12 +207,11 @@ class SlowEmbedText(Extractor):
         }
 
         if negid:
-            negdoc = self.docid2toks.get(negid, None)
-            if not negdoc:
+            negdoc = self.docid2ids.get(negid)
+            if negdoc is None or len(negdoc) == 0:
                 raise MissingDocError(qid, negid)
 
-            negdoc = self._tok2vec(padlist(negdoc, doclen, self.pad_tok))
             data["negdocid"] = negid
-            data["negdoc"] = np.array(negdoc, dtype=np.long)
+            data["negdoc"] = self._pad_ids(negdoc, doclen)
 
         return data
@@ -0,0 +1,106 @@
+import os
+from itertools import chain
+
+import numpy as np
+
+
+class TokenIds:
+    """Token id sequences stored in CSR form: one flat ``int32`` array of ids plus ``int64`` offsets into it.
+
+    Each key (e.g., a docid) maps either to a single sequence or, when ``nested``, to a list of sequences (e.g., a doc's
+    passages). Saved stores are loaded with ``mmap_mode="r"``, so processes that load the same store share its pages.
+
+    Args:
+        keys (list): the keys in storage order
+        ids (array): the token ids of every sequence, concatenated
+        offsets (array): sequence ``i`` is at ``ids[offsets[i]:offsets[i + 1]]``
+        key_offsets (array): if not None, key ``j`` maps to sequences ``key_offsets[j]:key_offsets[j + 1]``
+    """
+
+    def __init__(self, keys, ids, offsets, key_offsets=None):
+        self.keys = list(keys)
+        self.ids = ids
+        self.offsets = offsets
+        self.key_offsets = key_offsets
+        self._rows = {key: row for row, key in enumerate(self.keys)}
+
+    @property
+    def nested(self):
+        return self.key_offsets is not None
+
+    @classmethod
+    def from_lists(cls, key2ids, nested=False):
+        """ Create a store from a dict in the format ``{key: ids}``, or ``{key: [ids, ...]}`` if ``nested`` """
+        keys = list(key2ids)
+        seqs = list(chain.from_iterable(key2ids[key] for key in keys)) if nested else [key2ids[key] for key in keys]
+        ids = np.fromiter(chain.from_iterable(seqs), dtype=np.int32, count=sum(len(seq) for seq in seqs))
+        offsets = np.cumsum([0] + [len(seq) for seq in seqs], dtype=np.int64)
+        key_offsets = np.cumsum([0] + [len(key2ids[key]) for key in keys], dtype=np.int64) if nested else None
+        return cls(keys, ids, offsets, key_offsets)
+
+    @classmethod
+    def from_toks(cls, key2toks, stoi, unk=None):
+        """ Create a store from a dict in the format ``{key: tokens}``, mapping tokens missing from ``stoi`` to ``unk`` """
+        lookup = stoi.__getitem__ if unk is None else lambda tok: stoi.get(tok, unk)
+        return cls.from_lists({key: [lookup(tok) for tok in toks] for key, toks in key2toks.items()})
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _sequence(self, idx):
+        return self.ids[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def __getitem__(self, key):
+        row = self._rows[key]
+        if not self.nested:
+            return self._sequence(row)
+
+        return [self._sequence(idx) for idx in range(self.key_offsets[row], self.key_offsets[row + 1])]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._rows else default
+
+    def items(self):
+        return ((key, self[key]) for key in self.keys)
+
+    def to_toks(self, itos):
+        """ Return a dict in the format ``{key: tokens}`` (or ``{key: [tokens, ...]}`` if ``nested``) """
+        itos = np.asarray([itos[idx] for idx in range(len(itos))], dtype=object)
+        if not self.nested:
+            return {key: itos[ids].tolist() for key, ids in self.items()}
+        return {key: [itos[ids].tolist() for ids in seqs] for key, seqs in self.items()}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "ids.npy"), self.ids, allow_pickle=False)
+        np.save(os.path.join(path, "offsets.npy"), self.offsets, allow_pickle=False)
+        np.save(os.path.join(path, "keys.npy"), np.array(self.keys, dtype=str), allow_pickle=False)
+        if self.nested:
+            np.save(os.path.join(path, "key_offsets.npy"), self.key_offsets, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path):
+        ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        keys = np.load(os.path.join(path, "keys.npy")).tolist()
+        key_offsets_fn = os.path.join(path, "key_offsets.npy")
+        key_offsets = np.load(key_offsets_fn, mmap_mode="r") if os.path.exists(key_offsets_fn) else None
+        return cls(keys, ids, offsets, key_offsets)
+
+
+def save_vocab(path, itos):
+    """ Save the vocabulary ``itos``, which must map each id in ``range(len(itos))`` to a term, as an array of terms """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "vocab.npy"), np.array([itos[idx] for idx in range(len(itos))], dtype=str), allow_pickle=False)
+
+
+def load_vocab(path):
+    """ Load a vocabulary saved by ``save_vocab``, returning ``(stoi, itos)`` """
+    terms = np.load(os.path.join(path, "vocab.npy")).tolist()
+    return {term: idx for idx, term in enumerate(terms)}, dict(enumerate(terms))
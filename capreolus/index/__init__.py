@@ -1,3 +1,5 @@
+import numpy as np
+
 from capreolus import Dependency, ModuleBase, get_logger
 
 
@@ -11,6 +13,7 @@ class Index(ModuleBase):
         - a ``_create_index`` method that creates an index on the ``Collection`` dependency
         - a ``get_doc(docid)`` and a ``get_docs(docid)`` method
         - a ``get_df(term)`` method
+        - optionally, batched ``get_dfs(terms)`` and ``get_idfs(terms)`` methods returning NumPy arrays
     """
 
     module_type = "index"
@@ -41,6 +44,12 @@ class Index(ModuleBase):
     def get_docs(self, doc_ids):
         raise NotImplementedError()
 
+    def get_idf(self, term):
+        raise NotImplementedError()
+
+    def get_idfs(self, terms):
+        return np.array([self.get_idf(term) for term in terms], dtype=np.float64)
+
 
 from profane import import_all_modules
 
@@ -1,3 +1,4 @@
+import json
 import math
 import os
 import subprocess
@@ -6,6 +7,8 @@ from capreolus import ConfigOption, constants, get_logger
 from capreolus.utils.common import Anserini
 
 from . import Index
+from .docstore import DocStore
+from .termstats import TermStats
 
 logger = get_logger(__name__)  # pylint: disable=invalid-name
 MAX_THREADS = constants["MAX_THREADS"]
@@ -17,7 +20,41 @@ class AnseriniIndex(Index):
     config_spec = [
         ConfigOption("indexstops", False, "should stopwords be indexed? (if False, stopwords are removed)"),
         ConfigOption("stemmer", "porter", "stemmer: porter, krovetz, or none"),
+        ConfigOption("docstore", False, "also build a memory-mapped docstore that get_doc and get_docs read from"),
+        ConfigOption("docstorecompress", False, "compress the docstore in zstd blocks (requires zstandard)"),
     ]
+    # the docstore is a sidecar of the Lucene index, so its options should not change the index's path
+    config_keys_not_in_path = ["docstore", "docstorecompress"]
+
+    def create_index(self):
+        super().create_index()
+
+        if self.config["docstore"] and not DocStore.exists(self.get_docstore_path()):
+            logger.info("building docstore %s", self.get_docstore_path())
+            self._docstore = DocStore.build(
+                self.get_docstore_path().as_posix(), self._iter_collection_contents(), compress=self.config["docstorecompress"]
+            )
+
+    def get_docstore_path(self):
+        return self.get_cache_path() / ("docstore-zstd" if self.config["docstorecompress"] else "docstore")
+
+    def _iter_collection_contents(self):
+        """ Yield a ``(docid, contents)`` tuple for each document, matching the contents Anserini indexes """
+        for doc in self.collection:
+            # IRDCollection yields ir_datasets documents, which are converted to the JSON that Anserini indexes
+            if hasattr(doc, "doc_id"):
+                doc = json.loads(self.collection.doc_as_json(doc))
+                yield doc["id"], doc["contents"]
+            else:
+                docid, _title, contents = doc
+                yield docid, contents
+
+    @property
+    def docstore(self):
+        if not hasattr(self, "_docstore"):
+            path = self.get_docstore_path()
+            self._docstore = DocStore(path.as_posix()) if self.config["docstore"] and DocStore.exists(path) else None
+        return self._docstore
 
     def _create_index(self):
         outdir = self.get_index_path()
@@ -71,11 +108,34 @@ class AnseriniIndex(Index):
             raise RuntimeError("command failed")
 
     def get_docs(self, doc_ids):
-        # if self.collection.is_large_collection:
-        #     return self.get_documents_from_disk(doc_ids)
-        return [self.get_doc(doc_id) for doc_id in doc_ids]
+        """Fetch the contents of many documents at once.
+
+        If a docstore has been built, documents are read from it without using the JVM. Otherwise, the ``BulkFields`` Java
+        helper resolves the docids and reads their stored contents (in Lucene docid order) in a single JNI call. If the
+        helper could not be compiled, each document is read with a separate ``documentContents`` call instead.
+
+        Args:
+            doc_ids (list): docids to fetch
+
+        Returns:
+            A list containing the contents of each document in ``doc_ids`` (in the same order), or None for missing docids
+        """
+
+        if self.docstore is not None:
+            return self.docstore.get_docs(doc_ids)
+
+        if not hasattr(self, "reader") or self.reader is None:
+            self.open()
+
+        if self.JBulkFields is None:
+            return [self.index_reader_utils.documentContents(self.reader, self.JString(doc_id)) for doc_id in doc_ids]
+
+        return list(self.JBulkFields.documentFields(self.reader, list(doc_ids), "contents"))
 
     def get_doc(self, docid):
+        if self.docstore is not None:
+            return self.docstore.get_doc(docid)
+
         try:
             if not hasattr(self, "index_utils") or self.index_utils is None:
                 self.open()
@@ -97,8 +157,41 @@ class AnseriniIndex(Index):
         idf = math.log(1 + idf)
         return max(idf, 0)
 
+    def get_termstats_path(self):
+        return self.get_cache_path() / "termstats"
+
+    def get_termstats(self):
+        """ Return the :class:`~capreolus.index.termstats.TermStats` for this index, exporting them on first use """
+        if not hasattr(self, "_termstats"):
+            path = self.get_termstats_path()
+            if not TermStats.exists(path):
+                if not hasattr(self, "reader") or self.reader is None:
+                    self.open()
+                logger.info("exporting term statistics to %s", path)
+                TermStats.build(path.as_posix(), self._iter_term_stats(), self.numdocs)
+            self._termstats = TermStats(path.as_posix())
+
+        return self._termstats
+
+    def _iter_term_stats(self):
+        terms = self.JMultiTerms.getTerms(self.reader, "contents")
+        if terms is None:
+            return
+
+        terms_enum = terms.iterator()
+        while terms_enum.next() is not None:
+            yield terms_enum.term().utf8ToString(), terms_enum.docFreq(), terms_enum.totalTermFreq()
+
+    def get_dfs(self, terms):
+        """ Return a NumPy array containing the document frequency of each term (0 for missing terms) """
+        return self.get_termstats().get_dfs(terms)
+
+    def get_idfs(self, terms):
+        """ Return a NumPy array containing BM25's IDF with a floor of 0 for each term """
+        return self.get_termstats().get_idfs(terms)
+
     def open(self):
-        from jnius import autoclass
+        from jnius import JavaException, autoclass
 
         index_path = self.get_index_path().as_posix()
 
@@ -114,3 +207,10 @@ class AnseriniIndex(Index):
         self.numdocs = self.reader.numDocs()
         self.JTerm = autoclass("org.apache.lucene.index.Term")
         self.JString = autoclass("java.lang.String")
+        self.JMultiTerms = autoclass("org.apache.lucene.index.MultiTerms")
+
+        try:
+            self.JBulkFields = autoclass("capreolus.BulkFields")
+        except JavaException:
+            # the helper is missing from the classpath when it could not be compiled (see Anserini.get_helper_classpath)
+            self.JBulkFields = None
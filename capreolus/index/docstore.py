@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from capreolus import get_logger
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+
+class DocStore:
+    """A read-only, memory-mapped store of document contents that can be used without a JVM.
+
+    The store is a directory containing:
+        - ``data.bin``: the concatenated UTF-8 contents of every document (in zstd-compressed blocks if ``compress=True``)
+        - ``offsets.npy``: ``ndocs + 1`` byte offsets into the uncompressed contents
+        - ``block_offsets.npy``: byte offsets of each compressed block in ``data.bin`` (only when compressed)
+        - ``docids.bin`` and ``docid_offsets.npy``: the concatenated UTF-8 docids and their offsets
+        - ``table.npy``: an open addressing hash table mapping ``crc32(docid)`` to a row, with -1 marking empty slots
+
+    All arrays are opened with ``mmap_mode="r"``, so many worker processes can share one store's pages. Pickling a
+    DocStore only pickles its path; the arrays are mapped again in the receiving process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._load()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._load()
+
+    def __len__(self):
+        return self.ndocs
+
+    def __contains__(self, docid):
+        return self.get_row(docid) >= 0
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "done"))
+
+    @classmethod
+    def build(cls, path, docs, compress=False, block_size=64):
+        """Write a DocStore to ``path`` containing each ``(docid, contents)`` pair in the ``docs`` iterable.
+
+        Args:
+            path (str): output directory
+            docs (iterable): ``(docid, contents)`` tuples
+            compress (bool): compress the contents with zstd in blocks of ``block_size`` documents (requires ``zstandard``)
+            block_size (int): number of documents per compressed block
+
+        Returns:
+            the DocStore at ``path``
+        """
+
+        path = str(path)
+        if cls.exists(path):
+            return cls(path)
+
+        if compress:
+            import zstandard
+
+            compressor = zstandard.ZstdCompressor()
+
+        tmp_path = f"{path}.tmp_{os.getpid()}"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        offsets, docid_offsets, block_offsets = [0], [0], [0]
+        block = []
+        with open(os.path.join(tmp_path, "data.bin"), "wb") as dataf, open(os.path.join(tmp_path, "docids.bin"), "wb") as idf:
+            for docid, contents in docs:
+                encoded_docid = docid.encode("utf-8")
+                idf.write(encoded_docid)
+                docid_offsets.append(docid_offsets[-1] + len(encoded_docid))
+
+                encoded = (contents or "").encode("utf-8")
+                offsets.append(offsets[-1] + len(encoded))
+                if not compress:
+                    dataf.write(encoded)
+                    continue
+
+                block.append(encoded)
+                if len(block) == block_size:
+                    block_offsets.append(block_offsets[-1] + dataf.write(compressor.compress(b"".join(block))))
+                    block = []
+
+            if block:
+                block_offsets.append(block_offsets[-1] + dataf.write(compressor.compress(b"".join(block))))
+
+        ndocs = len(offsets) - 1
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "docid_offsets.npy"), np.array(docid_offsets, dtype=np.int64))
+        if compress:
+            np.save(os.path.join(tmp_path, "block_offsets.npy"), np.array(block_offsets, dtype=np.int64))
+
+        with open(os.path.join(tmp_path, "docids.bin"), "rb") as idf:
+            docids = idf.read()
+        np.save(os.path.join(tmp_path, "table.npy"), cls._build_table(docids, docid_offsets))
+
+        with open(os.path.join(tmp_path, "meta.json"), "wt") as outf:
+            json.dump({"ndocs": ndocs, "compress": compress, "block_size": block_size}, outf)
+
+        with open(os.path.join(tmp_path, "done"), "wt") as donef:
+            print("done", file=donef)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        shutil.move(tmp_path, path)
+        logger.info("wrote docstore with %s documents to %s", ndocs, path)
+        return cls(path)
+
+    @staticmethod
+    def _build_table(docids, docid_offsets):
+        ndocs = len(docid_offsets) - 1
+        # keep the load factor at or below 0.5 so that probe sequences stay short
+        size = 1 << max(1, (2 * ndocs - 1).bit_length())
+        mask = size - 1
+        table = np.full(size, -1, dtype=np.int64)
+        for row in range(ndocs):
+            slot = zlib.crc32(docids[docid_offsets[row] : docid_offsets[row + 1]]) & mask
+            while table[slot] != -1:
+                slot = (slot + 1) & mask
+            table[slot] = row
+        return table
+
+    def _load(self):
+        with open(os.path.join(self.path, "meta.json"), "rt") as f:
+            meta = json.load(f)
+
+        self.ndocs = meta["ndocs"]
+        self.compress = meta["compress"]
+        self.block_size = meta["block_size"]
+
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        self.docid_offsets = np.load(os.path.join(self.path, "docid_offsets.npy"), mmap_mode="r")
+        self.table = np.load(os.path.join(self.path, "table.npy"), mmap_mode="r")
+        self.mask = len(self.table) - 1
+        self.data = self._memmap_bytes(os.path.join(self.path, "data.bin"))
+        self.docids = self._memmap_bytes(os.path.join(self.path, "docids.bin"))
+
+        if self.compress:
+            import zstandard
+
+            self.block_offsets = np.load(os.path.join(self.path, "block_offsets.npy"), mmap_mode="r")
+            self.decompressor = zstandard.ZstdDecompressor()
+
+    @staticmethod
+    def _memmap_bytes(fn):
+        # np.memmap cannot map an empty file
+        if os.path.getsize(fn) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(fn, dtype=np.uint8, mode="r")
+
+    def get_row(self, docid):
+        """ Return the row containing ``docid``, or -1 if it is not in the store """
+        encoded_docid = docid.encode("utf-8")
+        slot = zlib.crc32(encoded_docid) & self.mask
+        while True:
+            row = int(self.table[slot])
+            if row == -1:
+                return -1
+
+            if self.docids[self.docid_offsets[row] : self.docid_offsets[row + 1]].tobytes() == encoded_docid:
+                return row
+
+            slot = (slot + 1) & self.mask
+
+    def get_doc(self, docid):
+        """ Return the contents of ``docid``, or None if it is not in the store """
+        row = self.get_row(docid)
+        if row == -1:
+            return None
+
+        if not self.compress:
+            return self.data[self.offsets[row] : self.offsets[row + 1]].tobytes().decode("utf-8")
+
+        return self._read_block(row // self.block_size)[row % self.block_size]
+
+    def get_docs(self, doc_ids):
+        """ Return the contents of each docid in ``doc_ids``, decompressing each needed block only once """
+        if not self.compress:
+            return [self.get_doc(docid) for docid in doc_ids]
+
+        rows = [self.get_row(docid) for docid in doc_ids]
+        blocks = {row // self.block_size: None for row in rows if row != -1}
+        for blockid in blocks:
+            blocks[blockid] = self._read_block(blockid)
+
+        return [blocks[row // self.block_size][row % self.block_size] if row != -1 else None for row in rows]
+
+    def _read_block(self, blockid):
+        first_row = blockid * self.block_size
+        last_row = min(first_row + self.block_size, self.ndocs)
+        compressed = self.data[self.block_offsets[blockid] : self.block_offsets[blockid + 1]].tobytes()
+        block = self.decompressor.decompress(compressed, max_output_size=int(self.offsets[last_row] - self.offsets[first_row]))
+
+        doc_offsets = self.offsets[first_row : last_row + 1] - self.offsets[first_row]
+        return [block[start:end].decode("utf-8") for start, end in zip(doc_offsets[:-1], doc_offsets[1:])]
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from capreolus import get_logger
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+
+def _hash_terms(terms):
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little") for term in terms],
+        dtype=np.uint64,
+    )
+
+
+class TermStats:
+    """An exported copy of an index's term dictionary that supports batched df and idf lookups without a JVM.
+
+    The stats are stored in a directory containing:
+        - ``terms.bin`` and ``term_offsets.npy``: the concatenated UTF-8 terms (in the index's sorted order) and their offsets
+        - ``df.npy`` and ``cf.npy``: the document frequency and collection frequency of each term
+        - ``hashes.npy`` and ``hash_rows.npy``: the sorted 64-bit hash of each term and the corresponding term row
+
+    Terms are looked up by binary searching their hashes with ``np.searchsorted``, and each hit is verified against
+    the stored term so that a hash collision cannot return another term's stats.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, "meta.json"), "rt") as f:
+            self.numdocs = json.load(f)["numdocs"]
+
+        self.term_offsets = np.load(os.path.join(path, "term_offsets.npy"), mmap_mode="r")
+        self.df = np.load(os.path.join(path, "df.npy"), mmap_mode="r")
+        self.cf = np.load(os.path.join(path, "cf.npy"), mmap_mode="r")
+        self.hashes = np.load(os.path.join(path, "hashes.npy"), mmap_mode="r")
+        self.hash_rows = np.load(os.path.join(path, "hash_rows.npy"), mmap_mode="r")
+        with open(os.path.join(path, "terms.bin"), "rb") as f:
+            self.terms = f.read()
+
+    def __len__(self):
+        return len(self.df)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "done"))
+
+    @classmethod
+    def build(cls, path, terms, numdocs):
+        """Write the ``(term, df, cf)`` tuples in the ``terms`` iterable to ``path``
+
+        Args:
+            path (str): output directory
+            terms (iterable): ``(term, df, cf)`` tuples
+            numdocs (int): number of documents in the index, which is used to calculate IDF
+
+        Returns:
+            the TermStats at ``path``
+        """
+
+        path = str(path)
+        tmp_path = f"{path}.tmp_{os.getpid()}"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        term_list, dfs, cfs, offsets = [], [], [], [0]
+        with open(os.path.join(tmp_path, "terms.bin"), "wb") as outf:
+            for term, df, cf in terms:
+                offsets.append(offsets[-1] + outf.write(term.encode("utf-8")))
+                term_list.append(term)
+                dfs.append(df)
+                cfs.append(cf)
+
+        hashes = _hash_terms(term_list)
+        hash_rows = np.argsort(hashes, kind="stable")
+        np.save(os.path.join(tmp_path, "term_offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "df.npy"), np.array(dfs, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "cf.npy"), np.array(cfs, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "hashes.npy"), hashes[hash_rows])
+        np.save(os.path.join(tmp_path, "hash_rows.npy"), hash_rows.astype(np.int64))
+
+        with open(os.path.join(tmp_path, "meta.json"), "wt") as outf:
+            json.dump({"numdocs": numdocs}, outf)
+
+        with open(os.path.join(tmp_path, "done"), "wt") as donef:
+            print("done", file=donef)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        shutil.move(tmp_path, path)
+        logger.info("exported stats for %s terms to %s", len(term_list), path)
+        return cls(path)
+
+    def get_rows(self, terms):
+        """ Return an array containing the row of each term in ``terms``, or -1 for terms missing from the index """
+        terms = list(terms)
+        if len(self.hashes) == 0 or not terms:
+            return np.full(len(terms), -1, dtype=np.int64)
+
+        hashes = _hash_terms(terms)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        rows = np.where(self.hashes[positions] == hashes, self.hash_rows[positions], -1)
+
+        for i in np.flatnonzero(rows >= 0):
+            row = rows[i]
+            if self.terms[self.term_offsets[row] : self.term_offsets[row + 1]] != terms[i].encode("utf-8"):
+                rows[i] = -1
+
+        return rows
+
+    def get_dfs(self, terms):
+        """ Return an array containing the document frequency of each term in ``terms`` (0 for missing terms) """
+        rows = self.get_rows(terms)
+        dfs = np.zeros(len(rows), dtype=np.int64)
+        found = rows >= 0
+        dfs[found] = self.df[rows[found]]
+        return dfs
+
+    def get_idfs(self, terms):
+        """ Return an array containing BM25's IDF with a floor of 0 for each term in ``terms`` """
+        df = self.get_dfs(terms)
+        idf = np.log(1 + (self.numdocs - df + 0.5) / (df + 0.5))
+        return np.maximum(idf, 0)
@@ -2,7 +2,8 @@ import pytest
 
 from capreolus import module_registry
 from capreolus.collection import DummyCollection
-from capreolus.index import Index
+from capreolus.index import AnseriniIndex, Index
+from capreolus.index.docstore import DocStore
 from capreolus.tests.common_fixtures import dummy_index, tmpdir_as_cache
 
 indexs = set(module_registry.get_module_names("index"))
@@ -35,3 +36,51 @@ def test_anserini_get_df(tmpdir_as_cache, dummy_index):
 def test_anserini_get_idf(tmpdir_as_cache, dummy_index):
     idf = dummy_index.get_idf("hello")
     assert idf == 0.1823215567939546
+
+
+def test_anserini_get_docs_missing(tmpdir_as_cache, dummy_index):
+    doc_ids = ["LA010189-0002", "LA010189-0001", "missing-docid", "LA010189-0002"]
+    assert dummy_index.get_docs(doc_ids) == [dummy_index.get_doc(doc_id) for doc_id in doc_ids]
+    assert dummy_index.get_docs(doc_ids) == [
+        "Dummy LessDummy Hello world, greetings from outer space!",
+        "Dummy Dummy Dummy Hello world, greetings from outer space!",
+        None,
+        "Dummy LessDummy Hello world, greetings from outer space!",
+    ]
+
+
+def test_docstore(tmpdir):
+    docs = [("doc%s" % i, "contents of doc %s \u00e9" % i) for i in range(100)] + [("empty", "")]
+    docstore = DocStore.build(tmpdir / "docstore", docs)
+
+    assert len(docstore) == len(docs)
+    assert "missing" not in docstore
+    for docid, contents in docs:
+        assert docstore.get_doc(docid) == contents
+    assert docstore.get_docs(["doc5", "missing", "doc1"]) == ["contents of doc 5 \u00e9", None, "contents of doc 1 \u00e9"]
+
+
+def test_anserini_docstore(tmpdir_as_cache):
+    index = AnseriniIndex(
+        {"name": "anserini", "indexstops": False, "stemmer": "porter", "docstore": True, "collection": {"name": "dummy"}}
+    )
+    index.create_index()
+    assert DocStore.exists(index.get_docstore_path())
+
+    # the docstore options do not change the path of the Lucene index
+    plain_index = AnseriniIndex({"name": "anserini", "indexstops": False, "stemmer": "porter", "collection": {"name": "dummy"}})
+    assert plain_index.get_index_path() == index.get_index_path()
+
+    docs = index.get_docs(["LA010189-0001", "LA010189-0002"])
+    assert docs == [
+        "Dummy Dummy Dummy Hello world, greetings from outer space!",
+        "Dummy LessDummy Hello world, greetings from outer space!",
+    ]
+    assert index.get_doc("LA010189-0001") == docs[0]
+
+
+def test_anserini_get_idfs(tmpdir_as_cache, dummy_index):
+    terms = ["hello", "dummi", "lessdummi", "notaterm"]
+    assert dummy_index.get_dfs(terms).tolist() == [dummy_index.get_df(term) for term in terms]
+    assert dummy_index.get_idfs(terms) == pytest.approx([dummy_index.get_idf(term) for term in terms])
+    assert len(dummy_index.get_idfs([])) == 0
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 
@@ -8,25 +10,44 @@ from capreolus.utils.loginit import get_logger
 logger = get_logger(__name__)
 
 
+class SparseLinear(nn.Module):
+    """A linear layer over sparse inputs given as (term id, count) pairs, which is equivalent to ``nn.Linear`` over the
+    dense term count vectors. Its cost depends on the number of terms per input rather than the vocabulary size."""
+
+    def __init__(self, in_features, out_features):
+        super(SparseLinear, self).__init__()
+        self.embedding = nn.EmbeddingBag(in_features, out_features, mode="sum")
+        self.bias = nn.Parameter(torch.empty(out_features))
+
+        # initialize like nn.Linear
+        bound = 1 / math.sqrt(in_features)
+        nn.init.uniform_(self.embedding.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, ids, counts):
+        return self.embedding(ids, per_sample_weights=counts.float()) + self.bias
+
+
 class DSSM_class(nn.Module):
     def __init__(self, extractor, config):
         super(DSSM_class, self).__init__()
         p = config
         nvocab = len(extractor.stoi)
         nhiddens = [nvocab] + list(map(int, p["nhiddens"].split()))
+        self.input_layer = SparseLinear(nhiddens[0], nhiddens[1])
         self.ffw = nn.Sequential()
-        for i in range(len(nhiddens) - 1):
+        self.ffw.add_module("activate0", nn.ReLU())
+        self.ffw.add_module("dropout0", nn.Dropout(0.5))
+        for i in range(1, len(nhiddens) - 1):
             self.ffw.add_module("linear%d" % i, nn.Linear(nhiddens[i], nhiddens[i + 1]))
             self.ffw.add_module("activate%d" % i, nn.ReLU())
             self.ffw.add_module("dropout%i" % i, nn.Dropout(0.5))
 
         self.output_layer = nn.Sigmoid()
 
-    def forward(self, sentence, query, query_idf):
-        query = query.float()
-        sentence = sentence.float()
-        query = self.ffw(query)
-        sentence = self.ffw(sentence)
+    def forward(self, sentence, sentence_counts, query, query_counts, query_idf):
+        query = self.ffw(self.input_layer(query, query_counts))
+        sentence = self.ffw(self.input_layer(sentence, sentence_counts))
 
         query_norm = query.norm(dim=-1)[:, None] + 1e-7
         sentence_norm = sentence.norm(dim=-1)[:, None] + 1e-7
@@ -66,16 +87,11 @@ class DSSM(Reranker):
         return self.model
 
     def score(self, d):
-        query_idf = d["query_idf"]
-        query_sentence = d["query"]
-        pos_sentence, neg_sentence = d["posdoc"], d["negdoc"]
+        query = (d["query"], d["query_counts"], d["query_idf"])
         return [
-            self.model(pos_sentence, query_sentence, query_idf).view(-1),
-            self.model(neg_sentence, query_sentence, query_idf).view(-1),
+            self.model(d["posdoc"], d["posdoc_counts"], *query).view(-1),
+            self.model(d["negdoc"], d["negdoc_counts"], *query).view(-1),
         ]
 
     def test(self, d):
-        query_idf = d["query_idf"]
-        query_sentence = d["query"]
-        pos_sentence = d["posdoc"]
-        return self.model(pos_sentence, query_sentence, query_idf).view(-1)
+        return self.model(d["posdoc"], d["posdoc_counts"], d["query"], d["query_counts"], d["query_idf"]).view(-1)
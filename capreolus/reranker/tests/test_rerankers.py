@@ -1,13 +1,10 @@
 import os
-from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
 import pytest
 import torch
-from pymagnitude import Magnitude
 
-import capreolus
 from capreolus import Reranker, module_registry
 from capreolus.benchmark import DummyBenchmark
 from capreolus.extractor.deeptileextractor import DeepTileExtractor
@@ -79,8 +76,8 @@ def test_knrm_pytorch(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_knrm_tf(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -108,14 +105,9 @@ def test_knrm_tf(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_knrm_tf_ce(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        vectors = np.zeros((8, 32))
-        stoi = defaultdict(lambda x: 0)
-        itos = defaultdict(lambda x: "dummy")
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 32), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-        return vectors, stoi, itos
-
-    monkeypatch.setattr(capreolus.extractor.common, "load_pretrained_embeddings", fake_magnitude_embedding)
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark()
     reranker = TFKNRM(
@@ -207,8 +199,8 @@ def test_dssm_unigram(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_tk(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -249,8 +241,8 @@ def test_tk(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_tk_get_mask(tmpdir, dummy_index, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -319,10 +311,10 @@ def test_tk_get_mask(tmpdir, dummy_index, monkeypatch):
 
 
 def test_deeptilebars(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return Magnitude(None)
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-    monkeypatch.setattr(DeepTileExtractor, "_get_pretrained_emb", fake_magnitude_embedding)
+    monkeypatch.setattr(DeepTileExtractor, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark()
     reranker = DeepTileBar(
         {
@@ -355,8 +347,8 @@ def test_deeptilebars(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_HINT(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -384,8 +376,8 @@ def test_HINT(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_POSITDRMM(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -412,8 +404,8 @@ def test_POSITDRMM(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
 
 
 def test_CDSSM(dummy_index, tmpdir, tmpdir_as_cache, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
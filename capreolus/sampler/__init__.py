@@ -13,6 +13,7 @@ logger = get_logger(__name__)
 class Sampler(ModuleBase):
     module_type = "sampler"
     requires_random_seed = True
+    batch_size = None
 
     def prepare(self, qid_to_docids, qrels, extractor, relevance_level=1, **kwargs):
         """
@@ -53,6 +54,17 @@ class Sampler(ModuleBase):
     def generate_samples(self):
         raise NotImplementedError
 
+    def set_batch_size(self, batch_size):
+        """
+        Make the sampler yield whole batches of ``batch_size`` samples created with the extractor's ``batch2vec``, rather
+        than individual samples. The sampler should then be used with a DataLoader created with ``batch_size=None``.
+        Pass ``None`` to yield individual samples again.
+        """
+        self.batch_size = batch_size
+
+    def generate_batches(self):
+        raise NotImplementedError
+
 
 class TrainingSamplerMixin:
     def clean(self):
@@ -85,7 +97,7 @@ class TrainingSamplerMixin:
                 self.rng = np.random.Generator(np.random.PCG64(seeds))
                 self._last_worker_seed = worker_info.seed
 
-        return iter(self.generate_samples())
+        return iter(self.generate_batches() if self.batch_size else self.generate_samples())
 
 
 @Sampler.register
@@ -105,10 +117,7 @@ class TrainTripletSampler(Sampler, TrainingSamplerMixin, torch.utils.data.Iterab
         key = hashlib.md5(key_content.encode("utf-8")).hexdigest()
         return "triplet_{0}".format(key)
 
-    def generate_samples(self):
-        """
-        Generates triplets infinitely.
-        """
+    def _generate_triplets(self):
         all_qids = sorted(self.qid_to_reldocs)
         if len(all_qids) == 0:
             raise RuntimeError("TrainDataset has no valid qids")
@@ -119,16 +128,46 @@ class TrainTripletSampler(Sampler, TrainingSamplerMixin, torch.utils.data.Iterab
             for qid in all_qids:
                 posdocid = self.rng.choice(self.qid_to_reldocs[qid])
                 negdocid = self.rng.choice(self.qid_to_negdocs[qid])
+                yield qid, posdocid, negdocid
 
-                try:
-                    # Convention for label - [1, 0] indicates that doc belongs to class 1 (i.e relevant
-                    # ^ This is used with categorical cross entropy loss
-                    yield self.extractor.id2vec(qid, posdocid, negdocid, label=[1, 0])
-                except MissingDocError:
-                    # at training time we warn but ignore on missing docs
-                    logger.warning(
-                        "skipping training pair with missing features: qid=%s posid=%s negid=%s", qid, posdocid, negdocid
-                    )
+    def generate_samples(self):
+        """
+        Generates triplets infinitely.
+        """
+        for qid, posdocid, negdocid in self._generate_triplets():
+            try:
+                # Convention for label - [1, 0] indicates that doc belongs to class 1 (i.e relevant
+                # ^ This is used with categorical cross entropy loss
+                yield self.extractor.id2vec(qid, posdocid, negdocid, label=[1, 0])
+            except MissingDocError:
+                # at training time we warn but ignore on missing docs
+                logger.warning("skipping training pair with missing features: qid=%s posid=%s negid=%s", qid, posdocid, negdocid)
+
+    def generate_batches(self):
+        """
+        Generates batches of ``batch_size`` triplets infinitely. The triplets are sampled as in generate_samples.
+        """
+        triplets = []
+        for triplet in self._generate_triplets():
+            triplets.append(triplet)
+            if len(triplets) < self.batch_size:
+                continue
+
+            qids, posdocids, negdocids = zip(*triplets)
+            try:
+                batch = self.extractor.batch2vec(qids, posdocids, negdocids, labels=[[1, 0]] * len(triplets))
+            except MissingDocError as e:
+                # at training time we warn but ignore on missing docs, and keep sampling to refill the batch
+                logger.warning("skipping training pairs with missing features: qid=%s docid=%s", e.related_qid, e.missed_docid)
+                triplets = [
+                    (qid, posdocid, negdocid)
+                    for qid, posdocid, negdocid in triplets
+                    if qid != e.related_qid or e.missed_docid not in (posdocid, negdocid)
+                ]
+                continue
+
+            triplets = []
+            yield batch
 
 
 @Sampler.register
@@ -147,7 +186,7 @@ class TrainPairSampler(Sampler, TrainingSamplerMixin, torch.utils.data.IterableD
         key = hashlib.md5(key_content.encode("utf-8")).hexdigest()
         return "pair_{0}".format(key)
 
-    def generate_samples(self):
+    def _generate_pairs(self):
         all_qids = sorted(self.qid_to_reldocs)
         if len(all_qids) == 0:
             raise RuntimeError("TrainDataset has no valid training pairs")
@@ -158,13 +197,26 @@ class TrainPairSampler(Sampler, TrainingSamplerMixin, torch.utils.data.IterableD
                 # Convention for label - [1, 0] indicates that doc belongs to class 1 (i.e relevant
                 # ^ This is used with categorical cross entropy loss
                 for docid in self.qid_to_reldocs[qid]:
-                    yield self.extractor.id2vec(qid, docid, negid=None, label=[0, 1])
+                    yield qid, docid, [0, 1]
                 for docid in self.qid_to_negdocs[qid]:
-                    yield self.extractor.id2vec(qid, docid, negid=None, label=[1, 0])
+                    yield qid, docid, [1, 0]
                 # REF-TODO returning all docs in a row does not make sense w/ pytorch
                 #          (with TF the dataset itself is shuffled, so this is okay)
                 # REF-TODO make sure always negid empty is ok
 
+    def generate_samples(self):
+        for qid, docid, label in self._generate_pairs():
+            yield self.extractor.id2vec(qid, docid, negid=None, label=label)
+
+    def generate_batches(self):
+        pairs = []
+        for pair in self._generate_pairs():
+            pairs.append(pair)
+            if len(pairs) == self.batch_size:
+                qids, docids, labels = zip(*pairs)
+                pairs = []
+                yield self.extractor.batch2vec(qids, docids, None, labels=list(labels))
+
 
 @Sampler.register
 class PredSampler(Sampler, torch.utils.data.IterableDataset):
@@ -195,6 +247,18 @@ class PredSampler(Sampler, torch.utils.data.IterableDataset):
                     logger.error("got none features for prediction: qid=%s posid=%s", qid, docid)
                     raise
 
+    def generate_batches(self):
+        pairs = list(self.get_qid_docid_pairs())
+        for start in range(0, len(pairs), self.batch_size):
+            qids, docids = zip(*pairs[start : start + self.batch_size])
+            labels = [[0, 1] if docid in self.qid_to_reldocs[qid] else [1, 0] for qid, docid in zip(qids, docids)]
+            try:
+                yield self.extractor.batch2vec(qids, docids, labels=labels)
+            except MissingDocError as e:
+                # when predictiong we raise an exception on missing docs, as this may invalidate results
+                logger.error("got none features for prediction: qid=%s posid=%s", e.related_qid, e.missed_docid)
+                raise
+
     def clean(self):
         total_samples = 0  # keep tracks of the total possible number of unique training triples for this dataset
         for qid in list(self.qid_to_docids.keys()):
@@ -212,7 +276,7 @@ class PredSampler(Sampler, torch.utils.data.IterableDataset):
         Returns: Tuples of the form (query_feature, posdoc_feature)
         """
 
-        return iter(self.generate_samples())
+        return iter(self.generate_batches() if self.batch_size else self.generate_samples())
 
     def __len__(self):
         return sum(len(docids) for docids in self.qid_to_docids.values())
@@ -38,6 +38,31 @@ def test_train_sampler(monkeypatch, tmpdir):
             break
 
 
+def test_train_sampler_batches(monkeypatch, tmpdir):
+    benchmark = DummyBenchmark()
+    extractor = EmbedText(
+        {"tokenizer": {"keepstops": True}}, provide={"collection": benchmark.collection, "benchmark": benchmark}
+    )
+    training_judgments = benchmark.qrels.copy()
+    train_dataset = TrainTripletSampler()
+    train_dataset.prepare(training_judgments, training_judgments, extractor)
+    train_dataset.set_batch_size(32)
+
+    def mock_batch2vec(self, qids, posids, negids=None, labels=None):
+        assert len(qids) == len(posids) == len(negids) == len(labels) == 32
+        return {"qid": list(qids), "query": np.ones((len(qids), 4), dtype=np.int64)}
+
+    monkeypatch.setattr(EmbedText, "batch2vec", mock_batch2vec)
+    dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=None)
+    for idx, batch in enumerate(dataloader):
+        assert len(batch["qid"]) == 32
+        assert torch.is_tensor(batch["query"])
+        assert batch["query"].shape == (32, 4)
+
+        if idx > 3:
+            break
+
+
 def test_pred_sampler(monkeypatch, tmpdir):
     benchmark = DummyBenchmark()
     extractor = EmbedText(
@@ -61,3 +86,24 @@ def test_pred_sampler(monkeypatch, tmpdir):
         assert np.array_equal(batch["query"][1], np.array([1, 2, 3, 4]))
         assert np.array_equal(batch["posdoc"][0], np.array([1, 1, 1, 1]))
         assert np.array_equal(batch["posdoc"][1], np.array([1, 1, 1, 1]))
+
+
+def test_pred_sampler_batches(monkeypatch, tmpdir):
+    benchmark = DummyBenchmark()
+    extractor = EmbedText(
+        {"tokenizer": {"keepstops": True}}, provide={"collection": benchmark.collection, "benchmark": benchmark}
+    )
+    search_run = {"301": {"LA010189-0001": 50, "LA010189-0002": 100}}
+    pred_dataset = PredSampler()
+    pred_dataset.prepare(benchmark.qrels, search_run, extractor)
+    pred_dataset.set_batch_size(3)
+
+    def mock_batch2vec(self, qids, posids, negids=None, labels=None):
+        return {"qid": list(qids), "posdocid": list(posids), "label": np.array(labels)}
+
+    monkeypatch.setattr(EmbedText, "batch2vec", mock_batch2vec)
+    batches = list(torch.utils.data.DataLoader(pred_dataset, batch_size=None))
+    assert len(batches) == 1
+    assert batches[0]["qid"] == ["301", "301"]
+    assert batches[0]["posdocid"] == ["LA010189-0001", "LA010189-0002"]
+    assert batches[0]["label"].tolist() == [[0, 1], [0, 1]]
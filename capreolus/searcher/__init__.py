@@ -3,9 +3,11 @@ from collections import defaultdict, OrderedDict
 
 from capreolus import ModuleBase, constants
 from capreolus.utils.loginit import get_logger
-from capreolus.utils.trec import topic_to_trectxt
+from capreolus.utils.trec import load_trec_run_columns, topic_to_trectxt, write_trec_run_columns
 from capreolus.utils.common import OrderedDefaultDict
 
+from .gridrun import GRID_SUFFIX, GridRun
+
 logger = get_logger(__name__)  # pylint: disable=invalid-name
 MAX_THREADS = constants["MAX_THREADS"]
 
@@ -27,29 +29,33 @@ class Searcher(ModuleBase):
     module_type = "searcher"
 
     @staticmethod
-    def load_trec_run(fn):
-        # Docids in the run file appear according to decreasing score, hence it makes sense to preserve this order
-        run = OrderedDefaultDict()
+    def load_trec_run(fn, sidecar=False):
+        """Load a run file as a ``{qid: {docid: score}}`` dict.
+
+        Docids in the run file appear according to decreasing score, hence it makes sense to preserve this order.
+        If ``sidecar`` is True, a binary copy of the parsed run is cached next to the file (see :func:`~capreolus.utils.trec.load_trec_run_columns`).
+        """
 
-        with open(fn, "rt") as f:
-            for line in f:
-                line = line.strip()
-                if len(line) > 0:
-                    qid, _, docid, rank, score, desc = line.split(" ")
-                    run[qid][docid] = float(score)
+        qids, offsets, docs, vocab, scores = load_trec_run_columns(fn, sidecar=sidecar)
+        docids, scores = vocab[docs].tolist(), scores.tolist()
+
+        run = OrderedDefaultDict()
+        for idx, qid in enumerate(qids):
+            start, end = offsets[idx], offsets[idx + 1]
+            run[qid] = OrderedDefaultDict(zip(docids[start:end], scores[start:end]))
         return run
 
     @staticmethod
     def write_trec_run(preds, outfn):
-        count = 0
-        with open(outfn, "wt") as outf:
-            qids = sorted(preds.keys(), key=lambda k: int(k))
-            for qid in qids:
-                rank = 1
-                for docid, score in sorted(preds[qid].items(), key=lambda x: x[1], reverse=True):
-                    print(f"{qid} Q0 {docid} {rank} {score} capreolus", file=outf)
-                    rank += 1
-                    count += 1
+        qids, docids, ranks, scores = [], [], [], []
+        for qid in sorted(preds.keys(), key=lambda k: int(k)):
+            ranked = sorted(preds[qid].items(), key=lambda x: x[1], reverse=True)
+            qids.extend([qid] * len(ranked))
+            docids.extend(docid for docid, _ in ranked)
+            ranks.extend(range(1, len(ranked) + 1))
+            scores.extend(score for _, score in ranked)
+
+        write_trec_run_columns(outfn, qids, docids, ranks, scores, "capreolus")
 
     def _query_from_file(self, topicsfn, output_path, cfg):
         raise NotImplementedError()
@@ -77,8 +83,12 @@ class Searcher(ModuleBase):
         config2runs = {}
         for runfile in runfile_fns:
             runfile_fn = runfile_dir / runfile
-            runs = self.load_trec_run(runfile_fn)
-            config2runs[runfile.replace("searcher_", "")] = OrderedDict(runs[fake_qid])
+            if runfile.endswith(GRID_SUFFIX):
+                grid = GridRun.load(runfile_fn)
+                config2runs.update({config: grid.get_run(config)[fake_qid] for config in grid.configs})
+            else:
+                runs = self.load_trec_run(runfile_fn)
+                config2runs[runfile.replace("searcher_", "")] = OrderedDict(runs[fake_qid])
             os.remove(runfile_fn)  # remove it in case the file accumulate
         os.remove(runfile_dir / "done")
 
@@ -1,6 +1,7 @@
 import math
 import os
 import subprocess
+from collections import Counter, OrderedDict
 
 import numpy as np
 
@@ -9,20 +10,246 @@ from capreolus.utils.common import Anserini
 from capreolus.utils.loginit import get_logger
 
 from . import Searcher
+from .gridrun import GRID_SUFFIX, GridRun
 
 logger = get_logger(__name__)  # pylint: disable=invalid-name
 MAX_THREADS = constants["MAX_THREADS"]
+# number of candidate docs scored for every (k1, b) combination at once by the shared scan grid search
+GRID_CHUNK_SIZE = 10000
 
 
 def list2str(l, delimiter="-"):
     return delimiter.join(str(x) for x in l)
 
 
+def _single_value(value):
+    return value[0] if isinstance(value, (list, tuple)) else value
+
+
+class AnseriniInProcessEngine:
+    """Searches an Anserini index from a Lucene IndexSearcher kept open in this process, rather than from a JVM subprocess.
+
+    The engine supports BM25 and Dirichlet QL similarities with bag-of-words or SDM queries. RM3 expansion is not
+    supported, so BM25RM3 always uses SearchCollection.
+    """
+
+    def __init__(self, index):
+        from jnius import autoclass
+
+        index.create_index()
+        if not hasattr(index, "reader") or index.reader is None:
+            index.open()
+
+        self.reader = index.reader
+        self.numdocs = index.numdocs
+        self.doclens_path = index.get_cache_path() / "doclens.npy"
+        self.searcher = autoclass("org.apache.lucene.search.IndexSearcher")(self.reader)
+        self.JBulkFields = index.JBulkFields
+
+        stemmer = "none" if index.config["stemmer"] is None else index.config["stemmer"]
+        Analyzer = autoclass("io.anserini.analysis.DefaultEnglishAnalyzer")
+        if index.config["indexstops"]:
+            self.analyzer = Analyzer.newStemmingInstance(stemmer, autoclass("org.apache.lucene.analysis.CharArraySet").EMPTY_SET)
+        else:
+            self.analyzer = Analyzer.newStemmingInstance(stemmer)
+        self.analyze = autoclass("io.anserini.analysis.AnalyzerUtils").analyze
+
+        self.JBM25Similarity = autoclass("org.apache.lucene.search.similarities.BM25Similarity")
+        self.JLMDirichletSimilarity = autoclass("org.apache.lucene.search.similarities.LMDirichletSimilarity")
+        self.JBagOfWordsQueryGenerator = autoclass("io.anserini.search.query.BagOfWordsQueryGenerator")
+        self.JSdmQueryGenerator = autoclass("io.anserini.search.query.SdmQueryGenerator")
+        self.JTerm = autoclass("org.apache.lucene.index.Term")
+        self.JBytesRef = autoclass("org.apache.lucene.util.BytesRef")
+        self.JMultiTerms = autoclass("org.apache.lucene.index.MultiTerms")
+        self.FREQS = autoclass("org.apache.lucene.index.PostingsEnum").FREQS
+        self.NO_MORE_DOCS = autoclass("org.apache.lucene.search.DocIdSetIterator").NO_MORE_DOCS
+        self._doclens = None
+
+        self.set_bm25()
+
+    def set_bm25(self, k1=0.9, b=0.4):
+        self.searcher.setSimilarity(self.JBM25Similarity(float(k1), float(b)))
+        self.query_generator = self.JBagOfWordsQueryGenerator()
+
+    def set_qld(self, mu=1000):
+        self.searcher.setSimilarity(self.JLMDirichletSimilarity(float(mu)))
+        self.query_generator = self.JBagOfWordsQueryGenerator()
+
+    def set_sdm(self, tw=0.85, ow=0.15, uw=0.05):
+        self.query_generator = self.JSdmQueryGenerator(float(tw), float(ow), float(uw))
+
+    def search(self, query, hits=1000):
+        """ Return an OrderedDict mapping each of the top ``hits`` docids for ``query`` to its score """
+        jquery = self.query_generator.buildQuery("contents", self.analyzer, query)
+        score_docs = [(score_doc.doc, score_doc.score) for score_doc in self.searcher.search(jquery, hits).scoreDocs]
+        return OrderedDict(zip(self.get_docids([doc for doc, _ in score_docs]), [score for _, score in score_docs]))
+
+    def get_docids(self, lucene_ids):
+        """ Return the external docid of each Lucene docid, reading all of them in one JNI call when possible """
+        lucene_ids = [int(doc) for doc in lucene_ids]
+        if self.JBulkFields is None:
+            return [self.reader.document(doc).get("id") for doc in lucene_ids]
+        return list(self.JBulkFields.storedFields(self.reader, lucene_ids, "id"))
+
+    def grid_search_bm25(self, query, k1s, bs, hits=1000):
+        """Score ``query`` with BM25 for every (k1, b) combination in a single pass over each query term's postings.
+
+        Candidates are scored in chunks in decreasing order of an upper bound on their score under any combination,
+        keeping only each combination's top ``hits`` docs, and scoring stops once no remaining candidate can enter any
+        combination's top ``hits``.
+
+        Returns:
+            a ``(docids, scores)`` tuple, where ``scores`` has one row per docid and one column per combination
+            (ordered as ``[(k1, b) for k1 in k1s for b in bs]``). Docs outside a combination's top ``hits`` are ``-inf``.
+        """
+
+        k1 = np.array([k1 for k1 in k1s for b in bs], dtype=np.float32)[:, None]
+        b = np.array([b for k1 in k1s for b in bs], dtype=np.float32)[:, None]
+
+        terms = self.JMultiTerms.getTerms(self.reader, "contents")
+        doc_count, avgdl = terms.getDocCount(), terms.getSumTotalTermFreq() / terms.getDocCount()
+
+        postings = []
+        for term, count in Counter(self.analyze(self.analyzer, query).toArray()).items():
+            docs, tfs = self._get_postings(term)
+            if len(docs) > 0:
+                df = self.reader.docFreq(self.JTerm("contents", term))
+                postings.append((docs, tfs, count * math.log(1 + (doc_count - df + 0.5) / (df + 0.5))))
+
+        if not postings:
+            return [], np.zeros((0, len(k1)), dtype=np.float32)
+
+        # a (terms, candidates) tf matrix holds the postings of every query term over the shared candidate set
+        candidates = np.unique(np.concatenate([docs for docs, _, _ in postings]))
+        tfs = np.zeros((len(postings), len(candidates)), dtype=np.float32)
+        for row, (docs, term_tfs, _) in enumerate(postings):
+            tfs[row, np.searchsorted(candidates, docs)] = term_tfs
+        weights = np.array([weight for _, _, weight in postings], dtype=np.float32)[:, None]
+        doclens = self.get_doclens()[candidates] / avgdl
+
+        # the smallest length normalization of any combination gives each candidate's highest possible score
+        min_norms = k1.min() * np.minimum(1 - b.max() + b.max() * doclens, 1 - b.min() + b.min() * doclens)
+        # (with a margin for float32 rounding, so that a doc's exact score cannot exceed its bound)
+        upper_bounds = (weights * tfs / (tfs + min_norms)).sum(axis=0) * (1 + 1e-4)
+        order = np.argsort(-upper_bounds, kind="stable")
+
+        top_scores = np.zeros((len(k1), 0), dtype=np.float32)
+        top_cols = np.zeros((len(k1), 0), dtype=np.int64)
+        for start in range(0, len(order), GRID_CHUNK_SIZE):
+            cols = order[start : start + GRID_CHUNK_SIZE]
+            if top_scores.shape[1] == hits and upper_bounds[cols[0]] < top_scores.min(axis=1).min():
+                break
+
+            norms = k1 * (1 - b + b * doclens[cols][None, :])
+            scores = np.zeros((len(k1), len(cols)), dtype=np.float32)
+            for row in range(len(postings)):
+                scores += weights[row] * tfs[row, cols] / (tfs[row, cols] + norms)
+
+            top_scores = np.concatenate([top_scores, scores], axis=1)
+            top_cols = np.concatenate([top_cols, np.broadcast_to(cols, scores.shape)], axis=1)
+            if top_scores.shape[1] > hits:
+                top = np.argpartition(-top_scores, hits - 1, axis=1)[:, :hits]
+                top_scores = np.take_along_axis(top_scores, top, axis=1)
+                top_cols = np.take_along_axis(top_cols, top, axis=1)
+
+        retrieved = np.unique(top_cols)
+        scores = np.full((len(k1), len(retrieved)), -np.inf, dtype=np.float32)
+        np.put_along_axis(scores, np.searchsorted(retrieved, top_cols), top_scores, axis=1)
+
+        return self.get_docids(candidates[retrieved]), scores.T
+
+    def _get_postings(self, term):
+        postings = self.JMultiTerms.getTermPostingsEnum(self.reader, "contents", self.JBytesRef(term.encode("utf-8")), self.FREQS)
+        docs, tfs = [], []
+        if postings is not None:
+            doc = postings.nextDoc()
+            while doc != self.NO_MORE_DOCS:
+                docs.append(doc)
+                tfs.append(postings.freq())
+                doc = postings.nextDoc()
+
+        return np.array(docs, dtype=np.int64), np.array(tfs, dtype=np.float32)
+
+    def get_doclens(self):
+        """Return the length of each doc as encoded in Lucene's norms, which is the length BM25Similarity uses.
+        The lengths are exported to the index's cache path on first use."""
+        if self._doclens is None:
+            if not os.path.exists(self.doclens_path):
+                os.makedirs(self.doclens_path.parent, exist_ok=True)
+                tmp_path = self.doclens_path.with_name(f"doclens.tmp_{os.getpid()}.npy")
+                np.save(tmp_path, self._read_doclens())
+                os.replace(tmp_path, self.doclens_path)
+
+            self._doclens = np.load(self.doclens_path, mmap_mode="r")
+
+        return self._doclens
+
+    def _read_doclens(self):
+        from jnius import autoclass
+
+        SmallFloat = autoclass("org.apache.lucene.util.SmallFloat")
+        length_table = np.array([SmallFloat.byte4ToInt(i if i < 128 else i - 256) for i in range(256)], dtype=np.float32)
+
+        doclens = np.zeros(self.reader.maxDoc(), dtype=np.float32)
+        norms = autoclass("org.apache.lucene.index.MultiDocValues").getNormValues(self.reader, "contents")
+        doc = norms.nextDoc()
+        while doc != self.NO_MORE_DOCS:
+            doclens[doc] = length_table[norms.longValue() & 0xFF]
+            doc = norms.nextDoc()
+
+        return doclens
+
+
 class AnseriniSearcherMixIn:
     """ MixIn for searchers that use Anserini's SearchCollection script """
 
     dependencies = [Dependency(key="index", module="index", name="anserini")]
 
+    def _configure_engine(self, engine, config):
+        """ Configure an :class:`AnseriniInProcessEngine` to match ``config``. Searchers that support in-process search should override this. """
+        raise NotImplementedError()
+
+    def supports_inprocess(self, config=None):
+        """ Searchers overriding :meth:`_configure_engine` search in-process only when their ``inprocess`` option is set """
+        config = self.config if config is None else config
+        if type(self)._configure_engine is AnseriniSearcherMixIn._configure_engine or not config.get("inprocess"):
+            return False
+
+        # grid searches produce one run per parameter combination, which requires SearchCollection
+        return all(len(v) == 1 for v in config.values() if isinstance(v, (list, tuple)))
+
+    def get_engine(self):
+        if not hasattr(self, "_engine"):
+            self._engine = AnseriniInProcessEngine(self.index)
+        return self._engine
+
+    def query(self, query, **kwargs):
+        """
+        search document based on given query, using parameters in config as default.
+        searchers supporting in-process search answer from an IndexSearcher kept open in this process
+        """
+        config = {k: kwargs.get(k, self.config[k]) for k in self.config}
+        if not self.supports_inprocess(config):
+            return super().query(query, **kwargs)
+
+        return self.query_many({"1": query}, **kwargs)["1"]
+
+    def query_many(self, queries, **kwargs):
+        """Search for each query in the ``{qid: query}`` dict ``queries`` without writing a run file
+
+        Returns:
+            a ``{qid: {docid: score}}`` dict
+        """
+
+        config = {k: kwargs.get(k, self.config[k]) for k in self.config}
+        if not self.supports_inprocess(config):
+            raise ValueError(f"searcher {self.module_name} does not support in-process search with config: {config}")
+
+        engine = self.get_engine()
+        self._configure_engine(engine, config)
+        hits = _single_value(config["hits"])
+        return OrderedDict((qid, engine.search(query, hits)) for qid, query in queries.items())
+
     def _anserini_query_from_file(self, topicsfn, anserini_param_str, output_base_path):
         if not os.path.exists(topicsfn):
             raise IOError(f"could not find topics file: {topicsfn}")
@@ -99,7 +326,7 @@ class PostprocessMixin:
             raise
 
         for fn in os.listdir(run_dir):
-            if fn == "done":
+            if fn == "done" or os.path.isdir(os.path.join(run_dir, fn)):
                 continue
 
             run_fn = os.path.join(run_dir, fn)
@@ -125,7 +352,7 @@ class PostprocessMixin:
 
     def dedup(self, run_dir, topn=None):
         for fn in os.listdir(run_dir):
-            if fn == "done":
+            if fn == "done" or os.path.isdir(os.path.join(run_dir, fn)):
                 continue
             run_fn = os.path.join(run_dir, fn)
             self._dedup(run_fn, topn)
@@ -156,7 +383,11 @@ class BM25(AnseriniSearcherMixIn, Searcher):
         ConfigOption("k1", 0.9, "controls term saturation", value_type="floatlist"),
         ConfigOption("b", 0.4, "controls document length normalization", value_type="floatlist"),
         ConfigOption("hits", 1000, "number of results to return"),
+        ConfigOption("sharedscan", False, "score every (k1, b) combination in-process from one scan of the postings"),
+        ConfigOption("inprocess", False, "answer query() from an IndexSearcher kept open in this process"),
     ]
+    # both modes score docs with the same BM25 parameters, so runs searched with either one can be reused
+    config_keys_not_in_path = ["sharedscan", "inprocess"]
 
     def _query_from_file(self, topicsfn, output_path, config):
         """
@@ -168,6 +399,9 @@ class BM25(AnseriniSearcherMixIn, Searcher):
         Returns: Path to the run file where the results of the search are stored
 
         """
+        if config.get("sharedscan"):
+            return self._grid_query_from_file(topicsfn, output_path, config)
+
         bstr, k1str = list2str(config["b"], delimiter=" "), list2str(config["k1"], delimiter=" ")
         hits = config["hits"]
         anserini_param_str = f"-bm25 -bm25.b {bstr} -bm25.k1 {k1str} -hits {hits}"
@@ -175,6 +409,37 @@ class BM25(AnseriniSearcherMixIn, Searcher):
 
         return output_path
 
+    def _grid_query_from_file(self, topicsfn, output_path, config):
+        """ Write a columnar :class:`~capreolus.searcher.gridrun.GridRun` with one column per (k1, b) combination """
+        donefn = os.path.join(output_path, "done")
+        if os.path.exists(donefn):
+            logger.debug(f"skipping shared scan grid search because path already exists: {donefn}")
+            return output_path
+
+        k1s, bs = config["k1"], config["b"]
+        if not isinstance(k1s, (list, tuple)):
+            k1s = [k1s]
+        if not isinstance(bs, (list, tuple)):
+            bs = [bs]
+
+        engine = self.get_engine()
+        grid = GridRun([f"bm25(k1={k1},b={b})_default" for k1 in k1s for b in bs])
+        with open(topicsfn, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    qid, query = line.strip().split("\t", 1)
+                    grid.add(qid, *engine.grid_search_bm25(query, k1s, bs, _single_value(config["hits"])))
+
+        os.makedirs(output_path, exist_ok=True)
+        grid.save(os.path.join(output_path, "searcher" + GRID_SUFFIX))
+        with open(donefn, "wt") as donef:
+            print("done", file=donef)
+
+        return output_path
+
+    def _configure_engine(self, engine, config):
+        engine.set_bm25(_single_value(config["k1"]), _single_value(config["b"]))
+
 
 @Searcher.register
 class BM25Grid(AnseriniSearcherMixIn, Searcher):
@@ -387,7 +652,9 @@ class DirichletQL(AnseriniSearcherMixIn, Searcher):
     config_spec = [
         ConfigOption("mu", 1000, "smoothing parameter", value_type="intlist"),
         ConfigOption("hits", 1000, "number of results to return"),
+        ConfigOption("inprocess", False, "answer query() from an IndexSearcher kept open in this process"),
     ]
+    config_keys_not_in_path = ["inprocess"]
 
     def _query_from_file(self, topicsfn, output_path, config):
         """
@@ -406,6 +673,9 @@ class DirichletQL(AnseriniSearcherMixIn, Searcher):
 
         return output_path
 
+    def _configure_engine(self, engine, config):
+        engine.set_qld(_single_value(config["mu"]))
+
 
 @Searcher.register
 class QLJM(AnseriniSearcherMixIn, Searcher):
@@ -513,7 +783,9 @@ class SDM(AnseriniSearcherMixIn, Searcher):
         ConfigOption("ow", 0.15, "ordered window weight"),
         ConfigOption("uw", 0.05, "unordered window weight"),
         ConfigOption("hits", 1000, "number of results to return"),
+        ConfigOption("inprocess", False, "answer query() from an IndexSearcher kept open in this process"),
     ]
+    config_keys_not_in_path = ["inprocess"]
 
     def _query_from_file(self, topicsfn, output_path, config):
         hits = config["hits"]
@@ -523,3 +795,7 @@ class SDM(AnseriniSearcherMixIn, Searcher):
         self._anserini_query_from_file(topicsfn, anserini_param_str, output_path)
 
         return output_path
+
+    def _configure_engine(self, engine, config):
+        engine.set_bm25(_single_value(config["k1"]), _single_value(config["b"]))
+        engine.set_sdm(*[_single_value(config[k]) for k in ["tw", "ow", "uw"]])
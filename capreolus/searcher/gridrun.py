@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+import numpy as np
+
+GRID_SUFFIX = ".grid.npz"
+
+
+class GridRun:
+    """Columnar search results for many searcher configurations that share the same queries.
+
+    Each query's results are stored as an array of candidate docids and a ``(len(docids), len(configs))`` score
+    matrix containing one column per config. A doc that was not retrieved by a config has a score of ``-inf`` in
+    that config's column. Config names follow Anserini's run file naming, so ``"searcher_" + config`` is the name
+    SearchCollection would give the corresponding run file.
+    """
+
+    def __init__(self, configs, results=None):
+        self.configs = list(configs)
+        self.results = OrderedDict() if results is None else results
+
+    def add(self, qid, docids, scores):
+        scores = np.asarray(scores, dtype=np.float32).reshape(len(docids), len(self.configs))
+        self.results[qid] = (np.asarray(docids, dtype=object), scores)
+
+    def get_run(self, config):
+        """ Return the ``{qid: {docid: score}}`` run for ``config``, with each query's docs sorted by decreasing score """
+        column = self.configs.index(config)
+        run = OrderedDict()
+        for qid, (docids, scores) in self.results.items():
+            col_scores = scores[:, column]
+            order = [idx for idx in np.argsort(-col_scores, kind="stable") if col_scores[idx] != -np.inf]
+            run[qid] = OrderedDict((docids[idx], float(col_scores[idx])) for idx in order)
+        return run
+
+    def write_trec_run(self, config, outfn):
+        from capreolus.searcher import Searcher
+
+        Searcher.write_trec_run(self.get_run(config), outfn)
+
+    def save(self, fn):
+        qids = list(self.results)
+        docids = [docid for qid in qids for docid in self.results[qid][0]]
+        offsets = np.cumsum([0] + [len(self.results[qid][0]) for qid in qids])
+        scores = (
+            np.concatenate([self.results[qid][1] for qid in qids]) if qids else np.zeros((0, len(self.configs)), dtype=np.float32)
+        )
+
+        with open(fn, "wb") as outf:
+            np.savez(
+                outf, configs=np.array(self.configs), qids=np.array(qids), docids=np.array(docids), offsets=offsets, scores=scores
+            )
+
+    @classmethod
+    def load(cls, fn):
+        data = np.load(fn)
+        offsets = data["offsets"]
+        docids, scores = data["docids"].astype(object), data["scores"]
+
+        results = OrderedDict()
+        for idx, qid in enumerate(data["qids"].tolist()):
+            start, end = offsets[idx], offsets[idx + 1]
+            results[qid] = (docids[start:end], scores[start:end])
+
+        return cls(data["configs"].tolist(), results)
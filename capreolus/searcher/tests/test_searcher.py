@@ -6,6 +6,7 @@ import pytest
 from capreolus import module_registry
 from capreolus.benchmark import DummyBenchmark
 from capreolus.searcher.anserini import BM25, BM25Grid, Searcher
+from capreolus.searcher.gridrun import GRID_SUFFIX, GridRun
 from capreolus.tests.common_fixtures import dummy_index, tmpdir_as_cache
 
 skip_searchers = {"bm25staticrob04yang19", "BM25Grid", "BM25Postprocess", "axiomatic"}
@@ -67,3 +68,54 @@ def test_searcher_bm25_grid(tmpdir_as_cache, tmpdir, dummy_index):
         for b in bs:
             assert os.path.exists(os.path.join(output_dir, "searcher_bm25(k1={0},b={1})_default".format(k1, b)))
     assert os.path.exists(os.path.join(output_dir, "done"))
+
+
+def test_searcher_bm25_inprocess(tmpdir_as_cache, tmpdir, dummy_index):
+    searcher = BM25(config={"inprocess": True}, provide={"index": dummy_index})
+    topics_fn = DummyBenchmark().get_topics_file()
+    queries = {qid: query for qid, query in (line.strip().split("\t") for line in open(topics_fn))}
+
+    assert searcher.get_module_path() == BM25(provide={"index": dummy_index}).get_module_path()
+    assert not BM25(provide={"index": dummy_index}).supports_inprocess()
+    assert searcher.supports_inprocess()
+    results = searcher.query_many(queries)
+    assert list(results["301"].keys()) == ["LA010189-0001", "LA010189-0002"]
+    assert list(results["301"].values()) == pytest.approx([0.1395, 0.0970], abs=1e-4)
+    assert searcher.query(queries["301"]) == results["301"]
+
+    assert not searcher.supports_inprocess({"k1": [0.8, 0.9], "b": [0.4], "hits": 1000, "inprocess": True})
+
+
+def test_gridrun(tmpdir):
+    grid = GridRun(["a", "b"])
+    grid.add("1", ["d1", "d2", "d3"], [[1.0, -np.inf], [2.0, 0.5], [-np.inf, 1.5]])
+    grid.add("2", [], np.zeros((0, 2)))
+
+    fn = os.path.join(tmpdir, "searcher" + GRID_SUFFIX)
+    grid.save(fn)
+    loaded = GridRun.load(fn)
+
+    assert loaded.configs == ["a", "b"]
+    assert loaded.get_run("a") == {"1": {"d2": 2.0, "d1": 1.0}, "2": {}}
+    assert list(loaded.get_run("b")["1"].keys()) == ["d3", "d2"]
+
+
+def test_searcher_bm25_sharedscan(tmpdir_as_cache, tmpdir, dummy_index):
+    topics_fn = DummyBenchmark().get_topics_file()
+    config = {"k1": "0.8,1.2", "b": "0.4,0.75"}
+
+    searcher = BM25(config=config, provide={"index": dummy_index})
+    anserini_dir = searcher.query_from_file(topics_fn, os.path.join(tmpdir, "anserini"))
+
+    grid_searcher = BM25(config=dict(config, sharedscan=True), provide={"index": dummy_index})
+    assert grid_searcher.get_module_path() == searcher.get_module_path()
+    grid_dir = grid_searcher.query_from_file(topics_fn, os.path.join(tmpdir, "grid"))
+    grid = GridRun.load(os.path.join(grid_dir, "searcher" + GRID_SUFFIX))
+
+    assert len(grid.configs) == 4
+    for config in grid.configs:
+        expected = Searcher.load_trec_run(os.path.join(anserini_dir, "searcher_" + config))
+        run = grid.get_run(config)
+        for qid in expected:
+            assert list(run[qid].keys()) == list(expected[qid].keys())
+            assert list(run[qid].values()) == pytest.approx(list(expected[qid].values()), abs=1e-4)
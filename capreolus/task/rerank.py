@@ -241,7 +241,7 @@ class RerankTask(Task):
         searcher_runs = {}
         rank_results = self.rank.evaluate()
         for fold in self.benchmark.folds:
-            searcher_runs[fold] = {"dev": Searcher.load_trec_run(rank_results["path"][fold])}
+            searcher_runs[fold] = {"dev": Searcher.load_trec_run(rank_results["path"][fold], sidecar=True)}
             searcher_runs[fold]["test"] = searcher_runs[fold]["dev"]
 
         reranker_runs = {}
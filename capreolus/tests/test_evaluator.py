@@ -1,3 +1,5 @@
+import pytest
+
 import capreolus.evaluator as evaluator
 
 
@@ -8,3 +10,56 @@ def test_interpolate_runs():
     qids = run1.keys()
     assert evaluator.interpolate_runs(run1, run2, qids, 0.5) == {1: {"d1": 0.5, "d2": 0.5}, 2: {"d1": 0.0, "d2": 1.0}}
     assert evaluator.interpolate_runs(run1, run2, qids, 0.2) == {1: {"d1": 0.8, "d2": 0.2}, 2: {"d1": 0.0, "d2": 1.0}}
+
+
+def test_run_evaluator_per_query_scores(tmpdir):
+    qrels = {"1": {"d1": 1, "d2": 0}, "2": {"d3": 1}}
+    run = {"1": {"d1": 2.0, "d2": 1.0}, "2": {"d4": 1.0}}
+
+    run_evaluator = evaluator.RunEvaluator(qrels, ["P_1", "judged_10"], relevance_level=1)
+    qids, scores = run_evaluator.evaluate(run)
+    assert qids == ["1", "2"]
+    assert scores.tolist() == [[1.0, 1.0], [0.0, 0.0]]
+
+    runfile = str(tmpdir / "searcher")
+    with open(runfile, "wt") as outf:
+        print("1 Q0 d1 1 2.0 tag\n1 Q0 d2 2 1.0 tag\n2 Q0 d4 1 1.0 tag", file=outf)
+
+    for _ in range(2):
+        [(file_qids, file_scores)] = evaluator.evaluate_runfiles([runfile], qrels, ["P_1", "judged_10"], 1, processes=1)
+        assert file_qids == qids
+        assert file_scores.tolist() == scores.tolist()
+
+
+def test_eval_fused_runs_matches_interpolated_runs():
+    qrels = {"1": {"d1": 1, "d2": 0, "d3": 2}, "2": {"d2": 1}}
+    run1 = {"1": {"d1": 1.0, "d2": 3.0, "d3": 2.0}, "2": {"d1": 1.0, "d2": 0.5}}
+    run2 = {"1": {"d1": 3.0, "d4": 2.0}, "2": {"d2": 2.0, "d3": 1.0}}
+    metrics = ["P_1", "map", "ndcg_cut_2", "recall_2"]
+    alphas = [0.0, 0.3, 1.0]
+
+    aligned = evaluator.align_runs(run1, run2, ["1", "2"])
+    qids, scores = evaluator.eval_fused_runs(
+        aligned, qrels, metrics, 1, lambda scores: evaluator.interpolate_scores(scores, alphas)
+    )
+    assert qids == ["1", "2"]
+    for idx, alpha in enumerate(alphas):
+        expected = evaluator.eval_runs(evaluator.interpolate_runs(run1, run2, qids, alpha), qrels, metrics)
+        assert scores[:, idx].mean(axis=0).tolist() == pytest.approx([expected[metric] for metric in metrics])
+
+
+def test_judged_by_cutoff():
+    qrels = {"1": {"d1": 0, "d3": 1}, "2": {"d1": 1}}
+    runs = {"1": {"d1": 3.0, "d2": 2.0, "d3": 1.0}, "2": {}, "3": {"d1": 1.0}}
+
+    scores = evaluator.judged_by_cutoff(qrels, runs, [1, 2, 10])
+    assert sorted(scores) == ["1", "2"]
+    assert scores["1"].tolist() == pytest.approx([1.0, 0.5, 2 / 3])
+    assert scores["2"].tolist() == [0, 0, 0]
+    assert evaluator.judged(qrels, runs, 2) == pytest.approx(0.25)
+
+    # the pytrec_eval fallback (for bpref) computes judged_k like the native metrics
+    native = evaluator.eval_runs(runs, qrels, ["judged_1", "judged_2"])
+    fallback = evaluator.eval_runs(runs, qrels, ["judged_1", "judged_2", "bpref"])
+    assert fallback["judged_1"] == pytest.approx(native["judged_1"])
+    assert fallback["judged_2"] == pytest.approx(native["judged_2"])
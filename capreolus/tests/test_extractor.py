@@ -7,13 +7,15 @@ import pytest
 from nltk import TextTilingTokenizer
 from pymagnitude import Magnitude
 
-from capreolus import Extractor, module_registry
+from capreolus import Extractor, constants, module_registry
 from capreolus.benchmark import DummyBenchmark
 from capreolus.collection import DummyCollection
 from capreolus.extractor.bagofwords import BagOfWords
+from capreolus.extractor.common import load_embedding_subset, save_vocab_file
 from capreolus.extractor.deeptileextractor import DeepTileExtractor
 from capreolus.extractor.embedtext import EmbedText
 from capreolus.extractor.slowembedtext import SlowEmbedText
+from capreolus.extractor.tokenids import TokenIds
 from capreolus.index import AnseriniIndex
 from capreolus.tests.common_fixtures import dummy_index, tmpdir_as_cache
 from capreolus.tokenizer import AnseriniTokenizer
@@ -52,6 +54,8 @@ def test_embedtext_id2vec(monkeypatch):
     docids = list(benchmark.qrels[qid].keys())
 
     extractor.preprocess(qids, docids, benchmark.topics[benchmark.query_type])
+    # docs are converted to rows of token ids by preprocess
+    assert extractor.doc_ids.shape == (len(docids), MAXDOCLEN)
 
     docid1, docid2 = docids[0], docids[1]
     data = extractor.id2vec(qid, docid1, docid2)
@@ -82,10 +86,46 @@ def test_embedtext_id2vec(monkeypatch):
 
     assert error_thrown
 
+    # batch2vec stacks the same features as id2vec
+    batch = extractor.batch2vec([qid, qid], [docid1, docid2], [docid2, docid1])
+    assert batch["qid"] == [qid, qid]
+    assert batch["negdocid"] == [docid2, docid1]
+    for idx, (posid, negid) in enumerate([(docid1, docid2), (docid2, docid1)]):
+        data = extractor.id2vec(qid, posid, negid)
+        for k in ["idfs", "query", "posdoc", "query_idf", "negdoc"]:
+            assert np.array_equal(batch[k][idx], data[k])
+            assert batch[k].dtype == data[k].dtype
+
+    batch = extractor.batch2vec([qid], [docid1])
+    assert batch["negdocid"] == [""]
+    assert not batch["negdoc"].any()
+
+    with pytest.raises(MissingDocError) as err:
+        extractor.batch2vec([qid, qid], [docid1, "0000000"])
+    assert err.value.missed_docid == "0000000"
+
+
+def test_load_embedding_subset(tmpdir_as_cache):
+    embedding_cache = constants["CACHE_BASE_PATH"] / "embeddings"
+    embedding_cache.mkdir()
+    vectors = np.arange(12, dtype=np.float32).reshape(4, 3)
+    np.save(embedding_cache / "glove6b.npy", vectors)
+    save_vocab_file({0: "<pad>", 1: "world", 2: "hello", 3: "dummy"}, embedding_cache / "glove6b.vocab.txt")
+
+    terms = ["hello", "missing", "dummy", "world", "<pad>"]
+    subset, found = load_embedding_subset("glove6b", terms)
+    assert found.tolist() == [True, False, True, True, True]
+    assert np.array_equal(subset, vectors[[2, 0, 3, 1, 0]] * found[:, None])
+
+    # the subset is cached
+    (embedding_cache / "glove6b.npy").unlink()
+    cached_subset, cached_found = load_embedding_subset("glove6b", terms)
+    assert np.array_equal(cached_subset, subset) and np.array_equal(cached_found, found)
+
 
 def test_slowembedtext_creation(monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -123,8 +163,8 @@ def test_slowembedtext_creation(monkeypatch):
 
 
 def test_slowembedtext_id2vec(monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -177,8 +217,8 @@ def test_slowembedtext_id2vec(monkeypatch):
 
 
 def test_slowembedtext_caching(dummy_index, monkeypatch):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
@@ -325,20 +365,25 @@ def test_bagofwords_id2vec(tmpdir, dummy_index):
     extractor.stoi["doc"] = 2
     extractor.itos[1] = "dummy"
     extractor.itos[2] = "doc"
-    extractor.docid2toks = {
+    docid2toks = {
         "LA010189-0001": ["dummy", "dummy", "dummy", "hello", "world", "greetings", "from", "outer", "space"],
         "LA010189-0002": ["dummy", "dummy", "dummy", "hello", "world", "greetings", "from", "outer", "space"],
     }
+    extractor.docid2ids = TokenIds.from_toks(docid2toks, extractor.stoi, unk=extractor.pad)
+    extractor.set_max_terms()
     transformed = extractor.id2vec("301", "LA010189-0001", "LA010189-0001")
     # stoi only knows about the word 'dummy' and 'doc'. So the transformation of every other word is set as 0
 
     assert transformed["qid"] == "301"
     assert transformed["posdocid"] == "LA010189-0001"
     assert transformed["negdocid"] == "LA010189-0001"
-    assert np.array_equal(transformed["query"], [0, 1, 1])
-    assert np.array_equal(transformed["posdoc"], [6, 3, 0])
-    assert np.array_equal(transformed["negdoc"], [6, 3, 0])
-    assert np.array_equal(transformed["query_idf"], [0, 0, 0])
+    assert np.array_equal(transformed["query"], [1, 2])
+    assert np.array_equal(transformed["query_counts"], [1, 1])
+    assert np.array_equal(transformed["posdoc"], [0, 1])
+    assert np.array_equal(transformed["posdoc_counts"], [6, 3])
+    assert np.array_equal(transformed["negdoc"], [0, 1])
+    assert np.array_equal(transformed["negdoc_counts"], [6, 3])
+    assert np.array_equal(transformed["query_idf"], [0, 0])
 
 
 def test_bagofwords_id2vec_trigram(tmpdir, dummy_index):
@@ -354,17 +399,17 @@ def test_bagofwords_id2vec_trigram(tmpdir, dummy_index):
     extractor.idf = defaultdict(lambda: 0)
     # extractor.preprocess(["301"], ["LA010189-0001", "LA010189-0002"], benchmark.topics["title"])
 
-    extractor.qid2toks = {"301": ["dummy", "doc"]}
-    extractor.docid2toks = {
-        "LA010189-0001": ["dummy", "dummy", "dummy", "hello", "world", "greetings", "from", "outer", "space"],
-        "LA010189-0002": ["dummy", "dummy", "dummy", "hello", "world", "greetings", "from", "outer", "space"],
-    }
+    extractor.qid2toks = {"301": extractor.get_trigrams_for_toks(["dummy", "doc"])}
+    doc_toks = ["dummy", "dummy", "dummy", "hello", "world", "greetings", "from", "outer", "space"]
+    docid2toks = {docid: extractor.get_trigrams_for_toks(doc_toks) for docid in ["LA010189-0001", "LA010189-0002"]}
     extractor.stoi["#du"] = 1
     extractor.stoi["dum"] = 2
     extractor.stoi["umm"] = 3
     extractor.itos[1] = "#du"
     extractor.itos[2] = "dum"
     extractor.itos[3] = "umm"
+    extractor.docid2ids = TokenIds.from_toks(docid2toks, extractor.stoi, unk=extractor.pad)
+    extractor.set_max_terms()
     transformed = extractor.id2vec("301", "LA010189-0001")
 
     # stoi only knows about the word 'dummy'. So the transformation of every other word is set as 0
@@ -373,10 +418,11 @@ def test_bagofwords_id2vec_trigram(tmpdir, dummy_index):
     assert transformed.get("negdocid") is None
 
     # Right now we have only 3 words in the vocabular - "<pad>", "dummy" and "doc"
-    assert np.array_equal(transformed["query"], [5, 1, 1, 1])
-    assert np.array_equal(
-        transformed["posdoc"], [39, 3, 3, 3]
-    )  # There  are 6 unknown words in the doc, so all of them is encoded as 0
+    assert np.array_equal(transformed["query"], [0, 1, 2, 3])
+    assert np.array_equal(transformed["query_counts"], [5, 1, 1, 1])
+    assert np.array_equal(transformed["posdoc"], [0, 1, 2, 3])
+    # There  are 6 unknown words in the doc, so all of them is encoded as 0
+    assert np.array_equal(transformed["posdoc_counts"], [39, 3, 3, 3])
     assert np.array_equal(transformed["query_idf"], [0, 0, 0, 0])
 
     # Learn another word
@@ -387,9 +433,12 @@ def test_bagofwords_id2vec_trigram(tmpdir, dummy_index):
     extractor.itos[5] = "my#"
     extractor.itos[6] = "#he"
 
+    extractor.docid2ids = TokenIds.from_toks(docid2toks, extractor.stoi, unk=extractor.pad)
+    extractor.set_max_terms()
     transformed = extractor.id2vec("301", "LA010189-0001")
     # The posdoc transformation changes to reflect the new word
-    assert np.array_equal(transformed["posdoc"], [32, 3, 3, 3, 3, 3, 1])
+    assert np.array_equal(transformed["posdoc"], [0, 1, 2, 3, 4, 5, 6])
+    assert np.array_equal(transformed["posdoc_counts"], [32, 3, 3, 3, 3, 3, 1])
 
 
 def test_bagofwords_caching(dummy_index, monkeypatch):
@@ -422,10 +471,10 @@ nltk.download("stopwords")
 
 
 def test_deeptiles_extract_segment_long_text(tmpdir, monkeypatch, dummy_index):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return Magnitude(None)
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-    monkeypatch.setattr(DeepTileExtractor, "_get_pretrained_emb", fake_magnitude_embedding)
+    monkeypatch.setattr(DeepTileExtractor, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark()
     # nltk.TextTilingTokenizer only works with large blobs of text
     ttt = TextTilingTokenizer(k=6)
@@ -462,10 +511,10 @@ def test_deeptiles_extract_segment_long_text(tmpdir, monkeypatch, dummy_index):
 
 
 def test_deeptiles_extract_segment_short_text(tmpdir, monkeypatch, dummy_index):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return Magnitude(None)
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-    monkeypatch.setattr(DeepTileExtractor, "_get_pretrained_emb", fake_magnitude_embedding)
+    monkeypatch.setattr(DeepTileExtractor, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark()
     # The text is too short for TextTilingTokenizer. Test if the fallback works
     ttt = TextTilingTokenizer(k=6)
@@ -513,10 +562,10 @@ def test_deeptiles_clean_segments(tmpdir, dummy_index):
 
 
 def test_deeptiles_create_visualization_matrix(monkeypatch, tmpdir, dummy_index):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return Magnitude(None)
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-    monkeypatch.setattr(DeepTileExtractor, "_get_pretrained_emb", fake_magnitude_embedding)
+    monkeypatch.setattr(DeepTileExtractor, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark()
     pipeline_config = {"name": "deeptiles", "tilechannels": 3, "maxqlen": 5, "passagelen": 3, "slicelen": 20, "tfchannel": True}
     extractor = DeepTileExtractor(pipeline_config, provide={"index": dummy_index, "benchmark": benchmark})
@@ -534,10 +583,10 @@ def test_deeptiles_create_visualization_matrix(monkeypatch, tmpdir, dummy_index)
 
 
 def test_deeptiles_create(monkeypatch, tmpdir, dummy_index):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return Magnitude(None)
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
-    monkeypatch.setattr(DeepTileExtractor, "_get_pretrained_emb", fake_magnitude_embedding)
+    monkeypatch.setattr(DeepTileExtractor, "_load_pretrained_embeddings", fake_magnitude_embedding)
     benchmark = DummyBenchmark({})
     extractor_config = {
         "name": "deeptiles",
@@ -591,14 +640,16 @@ def test_bertpassage_build_vocab(monkeypatch):
         return "O that we now had here but one ten thousand of those men in"
 
     monkeypatch.setattr(AnseriniIndex, "get_doc", get_doc)
+    monkeypatch.setattr(AnseriniIndex, "get_docs", lambda self, doc_ids: [get_doc(docid) for docid in doc_ids])
     topics = {"301": "scooby dooby doo where are you"}
 
     extractor._build_vocab(["301"], ["some_docid"], topics)
 
-    assert len(extractor.docid2passages["some_docid"]) == 5
+    assert len(extractor._get_passages("some_docid")) == 5
 
-    print(extractor.docid2passages["some_docid"])
-    assert extractor.docid2passages["some_docid"] == [
+    # passages are stored as token ids
+    passages = [extractor.tokenizer.bert_tokenizer.convert_ids_to_tokens(ids) for ids in extractor._get_passages("some_docid")]
+    assert passages == [
         ["o", "that", "we", "now", "had"],
         ["now", "had", "here", "but", "one"],
         ["but", "one", "ten", "thousand", "of"],
@@ -609,6 +660,42 @@ def test_bertpassage_build_vocab(monkeypatch):
     assert extractor.qid2toks["301"] == ["sc", "##oo", "##by", "doo", "##by", "doo", "where", "are", "you"]
 
 
+def test_bertpassage_sampled_passages(monkeypatch):
+    benchmark = DummyBenchmark()
+    extractor = BertPassage(
+        {"numpassages": 3, "passagelen": 5, "stride": 3, "index": {"collection": {"name": "dummy"}}}, provide=benchmark
+    )
+
+    def get_doc(*args, **kwargs):
+        return "O that we now had here but one ten thousand of those men in"
+
+    monkeypatch.setattr(AnseriniIndex, "get_doc", get_doc)
+    monkeypatch.setattr(AnseriniIndex, "get_docs", lambda self, doc_ids: [get_doc(docid) for docid in doc_ids])
+    topics = {"301": "scooby dooby doo where are you"}
+
+    extractor._build_vocab(["301"], ["some_docid"], topics)
+    passages = [extractor.tokenizer.bert_tokenizer.convert_ids_to_tokens(ids) for ids in extractor._get_passages("some_docid")]
+
+    # the first and last of the doc's 5 passages are always kept
+    assert len(passages) == 3
+    assert passages[0] == ["o", "that", "we", "now", "had"]
+    assert passages[-1] == ["men", "in"]
+    assert passages[1] in (
+        ["now", "had", "here", "but", "one"],
+        ["but", "one", "ten", "thousand", "of"],
+        ["thousand", "of", "those", "men", "in"],
+    )
+
+    # the sample does not change across calls or when the passages are built again
+    assert [ids.tolist() for ids in extractor._get_passages("some_docid")] == [
+        ids.tolist() for ids in extractor._get_passages("some_docid")
+    ]
+    starts = extractor._docid2starts["some_docid"].tolist()
+    extractor._build_vocab(["301"], ["some_docid"], topics)
+    extractor._get_passages("some_docid")
+    assert extractor._docid2starts["some_docid"].tolist() == starts
+
+
 def test_bertpassage_id2vec(monkeypatch):
     benchmark = DummyBenchmark()
     extractor = BertPassage(
@@ -620,6 +707,7 @@ def test_bertpassage_id2vec(monkeypatch):
         return "O that we now had here but one ten thousand of those men in"
 
     monkeypatch.setattr(AnseriniIndex, "get_doc", get_doc)
+    monkeypatch.setattr(AnseriniIndex, "get_docs", lambda self, doc_ids: [get_doc(docid) for docid in doc_ids])
     topics = {"301": "scooby dooby doo where are you"}
 
     extractor._build_vocab(["301"], ["some_docid"], topics)
@@ -777,6 +865,7 @@ def test_bertpassage_id2vec_with_pad(monkeypatch):
         return "O that we now had here but one ten thousand of those men in"
 
     monkeypatch.setattr(AnseriniIndex, "get_doc", get_doc)
+    monkeypatch.setattr(AnseriniIndex, "get_docs", lambda self, doc_ids: [get_doc(docid) for docid in doc_ids])
     topics = {"301": "scooby dooby doo where are you"}
 
     extractor._build_vocab(["301"], ["some_docid"], topics)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import pytrec_eval
+
+from capreolus.utils.metrics import evaluate_columns, evaluate_dense, is_supported, parse_metric
+
+METRICS = ["P_1", "P_5", "P_20", "map", "ndcg_cut_5", "ndcg_cut_20", "recall_10", "recall_100", "recip_rank"]
+
+
+def random_run_and_qrels(seed):
+    rng = np.random.default_rng(seed)
+    qrels, run = {}, {}
+    for qid in map(str, range(25)):
+        qrels[qid] = {f"d{docid}": int(rng.integers(-1, 4)) for docid in rng.choice(60, rng.integers(1, 20), replace=False)}
+        docids = [f"d{docid}" for docid in rng.choice(60, rng.integers(0, 30), replace=False)]
+        # round the scores so that ties must be broken like trec_eval
+        run[qid] = dict(zip(docids, np.round(rng.normal(size=len(docids)), 1).tolist()))
+    return qrels, run
+
+
+def test_parse_metric():
+    assert parse_metric("ndcg_cut_20") == ("ndcg_cut", 20)
+    assert parse_metric("map") == ("map", None)
+    assert is_supported("judged_200")
+    assert not is_supported("bpref")
+    assert not is_supported("P_x")
+
+
+@pytest.mark.parametrize("relevance_level", [1, 2])
+def test_evaluate_columns_matches_pytrec_eval(relevance_level):
+    qrels, run = random_run_and_qrels(relevance_level)
+    qids = list(run)
+    offsets = np.cumsum([0] + [len(run[qid]) for qid in qids])
+    docids = np.array([docid for qid in qids for docid in run[qid]], dtype=object)
+    scores = np.array([score for qid in qids for score in run[qid].values()])
+
+    scores = evaluate_columns(qrels, qids, offsets, docids, scores, METRICS + ["judged_10"], relevance_level)
+    expected = pytrec_eval.RelevanceEvaluator(qrels, METRICS, relevance_level=relevance_level).evaluate(run)
+    for idx, qid in enumerate(qids):
+        assert scores[idx, :-1].tolist() == pytest.approx([expected[qid][metric] for metric in METRICS])
+
+        topn = sorted(run[qid], key=run[qid].get, reverse=True)[:10]
+        if len(set(run[qid][docid] for docid in topn)) == len(topn):
+            assert scores[idx, -1] == pytest.approx(sum(docid in qrels[qid] for docid in topn) / max(len(topn), 1))
+
+
+def test_evaluate_dense_matches_columns():
+    qrels, run = random_run_and_qrels(3)
+    qids = list(run)
+    rng = np.random.default_rng(0)
+    docids = [np.array(list(run[qid]), dtype=object) for qid in qids]
+    scores = [rng.normal(size=(3, len(run[qid]))) for qid in qids]
+    for q_scores in scores:
+        q_scores[1, ::2] = -np.inf
+
+    dense = evaluate_dense(qrels, qids, docids, scores, METRICS)
+    for ranking in range(3):
+        retrieved = [q_scores[ranking] != -np.inf for q_scores in scores]
+        offsets = np.cumsum([0] + [mask.sum() for mask in retrieved])
+        columns = evaluate_columns(
+            qrels,
+            qids,
+            offsets,
+            np.concatenate([q_docids[mask] for q_docids, mask in zip(docids, retrieved)]),
+            np.concatenate([q_scores[ranking][mask] for q_scores, mask in zip(scores, retrieved)]),
+            METRICS,
+        )
+        assert dense[:, ranking] == pytest.approx(columns)
@@ -1,5 +1,5 @@
 from capreolus.index import AnseriniIndex
-from capreolus.tokenizer import AnseriniTokenizer
+from capreolus.tokenizer import AnseriniTokenizer, EnglishTokenizer
 
 
 def test_anserini_tokenzier():
@@ -11,3 +11,14 @@ def test_anserini_tokenzier():
 
     docs = index.get_docs(["LA010189-0001"])
     print(tokenizer.tokenize(docs))
+
+
+def test_english_tokenizer():
+    text = "John's U.S.A. e-mail costs $1,000.50; it's running"
+
+    tokenizer = EnglishTokenizer({"name": "english", "keepstops": True, "stemmer": "none"})
+    assert tokenizer.tokenize(text) == ["john", "u.s.a", "e", "mail", "costs", "1,000.50", "it", "running"]
+    assert tokenizer.tokenize([text, ""])[1] == []
+
+    tokenizer = EnglishTokenizer({"name": "english", "keepstops": False, "stemmer": "porter"})
+    assert tokenizer.tokenize(text) == ["john", "u.s.a", "e", "mail", "cost", "1,000.50", "run"]
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from capreolus.trecrun import TrecRun
+from capreolus.utils.trec import load_trec_run_columns
+
+
+def test_trecrun_arithmetic():
+    run1 = TrecRun({"1": {"d1": 1.0, "d2": 2.0}, "2": {"d3": 3.0}})
+    run2 = TrecRun({"2": {"d3": 1.0}, "1": {"d2": 0.5, "d1": 0.25}})
+
+    assert (run1 + run2).to_dict() == {"1": {"d1": 1.25, "d2": 2.5}, "2": {"d3": 4.0}}
+    assert (run1 * 2).to_dict() == {"1": {"d1": 2.0, "d2": 4.0}, "2": {"d3": 6.0}}
+    assert (5 - run1)["1"] == {"d1": 4.0, "d2": 3.0}
+
+    with pytest.raises(ValueError):
+        run1 + TrecRun({"1": {"d1": 1.0}})
+
+
+def test_trecrun_topk_and_normalize():
+    run = TrecRun({"1": {"d1": 1.0, "d2": 3.0, "d3": 2.0}, "2": {"d4": 1.0}, "3": {}})
+
+    assert run.topk(2).to_dict() == {"1": {"d2": 3.0, "d3": 2.0}, "2": {"d4": 1.0}, "3": {}}
+    assert run.normalize("rr")["1"] == {"d1": pytest.approx(1 / 3), "d2": 1.0, "d3": 0.5}
+    assert run.normalize("minmax").to_dict() == {"1": {"d1": 0.0, "d2": 1.0, "d3": 0.5}, "2": {"d4": 0.0}, "3": {}}
+
+
+def test_trecrun_set_operations():
+    run1 = TrecRun({"1": {"d1": 1.0, "d2": 2.0}, "2": {"d3": 3.0}})
+    run2 = TrecRun({"1": {"d2": 5.0, "d5": 1.0}, "3": {"d3": 3.0}})
+
+    assert run1.intersect(run2).to_dict() == {"1": {"d2": 2.0}}
+    assert run1.difference(run2).to_dict() == {"1": {"d1": 1.0}, "2": {"d3": 3.0}}
+    assert run1.qids() == {"1", "2"}
+    assert len(run1) == 3
+
+    concat = run1.concat(run2)
+    assert list(concat["1"]) == ["d1", "d2", "d5"]
+    assert concat["1"]["d5"] < concat["1"]["d1"]
+
+    union = run1.union_qids(TrecRun({"3": {"d9": 1.0}}))
+    assert union.to_dict() == {"1": {"d1": 1.0, "d2": 2.0}, "2": {"d3": 3.0}, "3": {"d9": 1.0}}
+
+
+def test_trecrun_write_and_read(tmpdir):
+    run = TrecRun({"1": {"d1": 1.5, "d2": 2.5}, "2": {"d3": 3.0}})
+    fn = str(tmpdir / "test.run")
+    run.write_trec_run(fn)
+
+    with open(fn) as f:
+        assert f.readline() == "1 Q0 d2 1 2.5 capreolus\n"
+    assert TrecRun(fn) == run
+
+
+def test_load_trec_run_columns_sidecar(tmpdir):
+    fn = str(tmpdir / "test.run")
+    with open(fn, "wt") as outf:
+        print("2 Q0 NA 1 3.5 tag\n1 Q0 d1 1 2 tag\n2 Q0 d2 2 1.25 tag", file=outf)
+
+    for _ in range(2):
+        qids, offsets, docs, vocab, scores = load_trec_run_columns(fn, sidecar=True)
+        assert qids == ["2", "1"]
+        assert offsets.tolist() == [0, 2, 3]
+        assert docs.dtype == np.int32
+        assert vocab.tolist() == ["NA", "d1", "d2"]
+        assert vocab[docs].tolist() == ["NA", "d2", "d1"]
+        assert scores.tolist() == [3.5, 1.25, 2.0]
+        assert (tmpdir / ".runcache" / "test.run.run.npz").exists()
+
+
+def test_trecrun_results_are_read_only():
+    run = TrecRun({"1": {"d1": 1.0, "d2": 2.0}})
+
+    with pytest.raises(TypeError):
+        run["1"]["d1"] = 5.0
+    with pytest.raises(TypeError):
+        run.results["1"]["d3"] = 5.0
+
+    results = run.to_dict()
+    results["1"]["d1"] = 5.0
+    assert run["1"] == {"d1": 1.0, "d2": 2.0}
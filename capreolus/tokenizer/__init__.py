@@ -15,5 +15,6 @@ from profane import import_all_modules
 
 from .anserini import AnseriniTokenizer
 from .bert import BertTokenizer
+from .english import EnglishTokenizer
 
 import_all_modules(__file__, __package__)
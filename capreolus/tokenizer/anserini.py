@@ -1,7 +1,14 @@
+import numpy as np
+
 from capreolus import ConfigOption
 
 from . import Tokenizer
 
+# a numeric token that no stemmer or stopword filter changes, used to separate documents analyzed together in one JNI call
+DOC_SEPARATOR = "7309215864210386597"
+# maximum number of documents to analyze in one call
+BATCH_SIZE = 256
+
 
 @Tokenizer.register
 class AnseriniTokenizer(Tokenizer):
@@ -31,6 +38,36 @@ class AnseriniTokenizer(Tokenizer):
 
         return _tokenize
 
+    def _tokenize_batch(self, sentences):
+        """ Analyze ``sentences`` with a single JNI call and return a list containing each sentence's tokens """
+        if len(sentences) == 1:
+            return [list(self._tokenize(sentences[0]))]
+
+        toks = self._tokenize(f"\n{DOC_SEPARATOR}\n".join(sentences))
+        separators = [idx for idx, tok in enumerate(toks) if tok == DOC_SEPARATOR]
+        if len(separators) != len(sentences) - 1:
+            # a sentence contains the separator itself, so it cannot be split reliably
+            return [list(self._tokenize(sentence)) for sentence in sentences]
+
+        bounds = zip([-1] + separators, separators + [len(toks)])
+        return [toks[start + 1 : end] for start, end in bounds]
+
+    def tokenize_flat(self, sentences):
+        """Tokenize a list of strings using one analyzer call per batch of ``BATCH_SIZE`` strings
+
+        Returns:
+            a tuple ``(tokens, offsets)``, where ``tokens`` is a flat list containing every sentence's tokens and the tokens
+            of ``sentences[i]`` are at ``tokens[offsets[i]:offsets[i + 1]]``
+        """
+
+        tokens, lengths = [], [0]
+        for start in range(0, len(sentences), BATCH_SIZE):
+            for toks in self._tokenize_batch([s if s else "" for s in sentences[start : start + BATCH_SIZE]]):
+                tokens.extend(toks)
+                lengths.append(len(toks))
+
+        return tokens, np.cumsum(lengths)
+
     def tokenize(self, sentences):
         if not sentences or len(sentences) == 0:  # either "" or []
             return []
@@ -38,4 +75,5 @@ class AnseriniTokenizer(Tokenizer):
         if isinstance(sentences, str):
             return self._tokenize(sentences)
 
-        return [self._tokenize(s) for s in sentences]
+        tokens, offsets = self.tokenize_flat(sentences)
+        return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
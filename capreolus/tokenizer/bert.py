@@ -1,3 +1,4 @@
+import numpy as np
 from transformers import AutoTokenizer
 
 from capreolus import ConfigOption, get_logger
@@ -30,6 +31,43 @@ class BertTokenizer(Tokenizer):
     def convert_tokens_to_ids(self, tokens):
         return self.bert_tokenizer.convert_tokens_to_ids(tokens)
 
+    def _batch_encode(self, sentences, return_offsets=False):
+        return self.bert_tokenizer(
+            [s if s else "" for s in sentences],
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            return_offsets_mapping=return_offsets,
+        )
+
+    def encode(self, sentences, return_offsets=False):
+        """Tokenize ``sentences`` and convert the tokens to ids in a single batch call to the tokenizer.
+
+        Args:
+            sentences (list): strings to tokenize
+            return_offsets (bool): also return the ``(start, end)`` character offsets of each token (fast tokenizers only)
+
+        Returns:
+            a list containing an int64 array of token ids for each sentence, or a ``(ids, offsets)`` tuple of lists if
+            ``return_offsets=True``
+        """
+
+        if isinstance(sentences, str):
+            sentences = [sentences]
+
+        if not self.bert_tokenizer.is_fast:
+            if return_offsets:
+                raise ValueError(f"token offsets are not available for the slow {self.config['pretrained']} tokenizer")
+            return [np.array(self.convert_tokens_to_ids(toks), dtype=np.int64) for toks in self.tokenize(list(sentences))]
+
+        encoded = self._batch_encode(sentences, return_offsets=return_offsets)
+        ids = [np.array(input_ids, dtype=np.int64) for input_ids in encoded["input_ids"]]
+        if not return_offsets:
+            return ids
+
+        offsets = [np.array(offsets, dtype=np.int64).reshape(-1, 2) for offsets in encoded["offset_mapping"]]
+        return ids, offsets
+
     def tokenize(self, sentences):
         if not sentences or len(sentences) == 0:  # either "" or []
             return []
@@ -37,4 +75,8 @@ class BertTokenizer(Tokenizer):
         if isinstance(sentences, str):
             return self.bert_tokenizer.tokenize(sentences)
 
-        return [self.bert_tokenizer.tokenize(s) for s in sentences]
+        if not self.bert_tokenizer.is_fast:
+            return [self.bert_tokenizer.tokenize(s) for s in sentences]
+
+        encoded = self._batch_encode(sentences)
+        return [encoded.tokens(i) for i in range(len(sentences))]
@@ -0,0 +1,86 @@
+import re
+
+from capreolus import ConfigOption
+
+from . import Tokenizer
+
+# Lucene's EnglishAnalyzer.ENGLISH_STOP_WORDS_SET, which Anserini's DefaultEnglishAnalyzer uses by default
+STOPWORDS = frozenset(
+    "a an and are as at be but by for if in into is it no not of on or such that the their then there these they this "
+    "to was will with".split()
+)
+# StandardTokenizer splits longer tokens
+MAX_TOKEN_LENGTH = 255
+
+_LETTER = r"[^\W\d_]"
+_IDEOGRAPH = r"[぀-ゟ㐀-䶿一-鿿豈-﫿]"
+# approximates the UAX#29 word boundaries used by Lucene's StandardTokenizer: runs of letters, digits and underscores
+# that may be joined by ' ’ or . (between letters or digits), : (between letters), or , ; (between digits).
+# ideographs and hiragana are emitted as single-character tokens.
+_TOKEN_RE = re.compile(
+    rf"{_IDEOGRAPH}|(?:(?!{_IDEOGRAPH})\w)+"
+    rf"(?:(?:['’.](?=\w)|(?<={_LETTER}):(?={_LETTER})|(?<=\d)[,;](?=\d))(?:(?!{_IDEOGRAPH})\w)+)*"
+)
+_POSSESSIVE_RE = re.compile(r"['’＇][sS]$")
+
+
+@Tokenizer.register
+class EnglishTokenizer(Tokenizer):
+    """Pure Python approximation of Anserini's ``DefaultEnglishAnalyzer`` (see :class:`AnseriniTokenizer`), which does not
+    need a JVM and can thus be used cheaply in worker processes. Output may differ from Lucene's on unusual punctuation
+    and scripts. The krovetz stemmer requires the ``krovetzstemmer`` package."""
+
+    module_name = "english"
+    config_spec = [
+        ConfigOption("keepstops", True, "keep stopwords if True"),
+        ConfigOption("stemmer", "none", "stemmer: porter, krovetz, or none"),
+    ]
+
+    def build(self):
+        self._stem = self._get_stem_fn()
+        self._stem_cache = {}
+
+    def _get_stem_fn(self):
+        stemmer = self.config["stemmer"]
+        if stemmer is None or stemmer == "none":
+            return None
+
+        if stemmer == "porter":
+            from nltk.stem.porter import PorterStemmer
+
+            # Lucene's PorterStemFilter implements the original algorithm rather than NLTK's extensions
+            return PorterStemmer(mode=PorterStemmer.ORIGINAL_ALGORITHM).stem
+
+        if stemmer == "krovetz":
+            from krovetzstemmer import Stemmer
+
+            return Stemmer().stem
+
+        raise ValueError(f"unknown stemmer: {stemmer}")
+
+    def _tokenize(self, sentence):
+        toks = []
+        for tok in _TOKEN_RE.findall(sentence):
+            tok = _POSSESSIVE_RE.sub("", tok).lower()
+            toks.extend(tok[start : start + MAX_TOKEN_LENGTH] for start in range(0, len(tok), MAX_TOKEN_LENGTH))
+
+        if not self.config["keepstops"]:
+            toks = [tok for tok in toks if tok not in STOPWORDS]
+
+        if self._stem:
+            stem_cache = self._stem_cache
+            for idx, tok in enumerate(toks):
+                if tok not in stem_cache:
+                    stem_cache[tok] = self._stem(tok)
+                toks[idx] = stem_cache[tok]
+
+        return toks
+
+    def tokenize(self, sentences):
+        if not sentences or len(sentences) == 0:  # either "" or []
+            return []
+
+        if isinstance(sentences, str):
+            return self._tokenize(sentences)
+
+        return [self._tokenize(s) if s else [] for s in sentences]
@@ -222,10 +222,7 @@ class PytorchTrainer(Trainer):
             train_output_path, dev_output_path
         )
 
-        num_workers = 1 if self.config["multithread"] else 0
-        train_dataloader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=self.config["batch"], pin_memory=True, num_workers=num_workers
-        )
+        train_dataloader = self.create_dataloader(train_dataset, self.config["batch"])
 
         # if we're fastforwarding, set first iteration and load last saved weights
         initial_iter, metrics = (
@@ -328,8 +325,7 @@ class PytorchTrainer(Trainer):
 
         preds = {}
         evalbatch = self.config["evalbatch"] if self.config["evalbatch"] > 0 else self.config["batch"]
-        num_workers = 1 if self.config["multithread"] else 0
-        pred_dataloader = torch.utils.data.DataLoader(pred_data, batch_size=evalbatch, pin_memory=True, num_workers=num_workers)
+        pred_dataloader = self.create_dataloader(pred_data, evalbatch)
         with torch.autograd.no_grad():
             for batch in tqdm(pred_dataloader, desc="Predicting", total=len(pred_data) // evalbatch):
                 if len(batch["qid"]) != evalbatch:
@@ -340,14 +336,26 @@ class PytorchTrainer(Trainer):
                     scores = reranker.test(batch)
                 scores = scores.view(-1).cpu().numpy()
                 for qid, docid, score in zip(batch["qid"], batch["posdocid"], scores):
-                    # Need to use float16 because pytrec_eval's c function call crashes with higher precision floats
-                    preds.setdefault(qid, {})[docid] = score.astype(np.float16).item()
+                    preds.setdefault(qid, {})[docid] = score.item()
 
         os.makedirs(os.path.dirname(pred_fn), exist_ok=True)
         Searcher.write_trec_run(preds, pred_fn)
 
         return preds
 
+    def create_dataloader(self, dataset, batch_size):
+        """
+        Create a DataLoader yielding batches of ``batch_size`` samples from ``dataset``. If the dataset's extractor provides
+        ``batch2vec``, the sampler creates whole batches and the DataLoader only converts them to tensors.
+        """
+        num_workers = 1 if self.config["multithread"] else 0
+        if dataset.extractor.provides_batch2vec():
+            dataset.set_batch_size(batch_size)
+            return torch.utils.data.DataLoader(dataset, batch_size=None, pin_memory=True, num_workers=num_workers)
+
+        dataset.set_batch_size(None)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, pin_memory=True, num_workers=num_workers)
+
     def fill_incomplete_batch(self, batch, batch_size=None):
         """
         If a batch is incomplete (i.e shorter than the desired batch size), this method fills in the batch with some data.
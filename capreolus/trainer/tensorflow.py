@@ -481,8 +481,7 @@ class TensorflowTrainer(Trainer):
         pred_dict = defaultdict(lambda: dict())
 
         for i, (qid, docid) in enumerate(dev_data.get_qid_docid_pairs()):
-            # Pytrec_eval has problems with high precision floats
-            pred_dict[qid][docid] = predictions[i].numpy().astype(np.float16).item()
+            pred_dict[qid][docid] = predictions[i].numpy().item()
 
         return dict(pred_dict)
 
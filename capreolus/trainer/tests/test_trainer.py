@@ -70,8 +70,8 @@ def test_tf_get_tf_dataset(monkeypatch):
 
 
 def test_tf_find_cached_tf_records(monkeypatch, dummy_index):
-    def fake_magnitude_embedding(*args, **kwargs):
-        return np.zeros((1, 8), dtype=np.float32), {0: "<pad>"}, {"<pad>": 0}
+    def fake_magnitude_embedding(self, terms):
+        return np.zeros((len(terms), 8), dtype=np.float32), np.zeros(len(terms), dtype=bool)
 
     monkeypatch.setattr(SlowEmbedText, "_load_pretrained_embeddings", fake_magnitude_embedding)
 
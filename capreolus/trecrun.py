@@ -1,53 +1,208 @@
 import operator
-from copy import deepcopy
+import os
+from collections.abc import Mapping
+from types import MappingProxyType
 
-import sklearn.preprocessing
+import numpy as np
 import smart_open
 
+from capreolus.utils.trec import load_trec_run_columns, write_trec_run_columns
+
+
+def _segment_ids(offsets):
+    """ Return the index of the query that each entry belongs to """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _segment_reduce(ufunc, values, offsets, empty_value):
+    """Reduce ``values`` within each query's segment with ``ufunc`` (e.g., ``np.minimum``).
+    Empty queries are given ``empty_value``."""
+    lengths = np.diff(offsets)
+    out = np.full(len(lengths), empty_value, dtype=np.float64)
+    nonempty = lengths > 0
+    if values.size:
+        # empty segments are skipped, so each nonempty segment's reduction ends where the next nonempty one starts
+        out[nonempty] = ufunc.reduceat(values.astype(np.float64), offsets[:-1][nonempty])
+    return out
+
+
+def _ranks(scores, offsets):
+    """ Return each entry's 0-based rank within its query when sorting by decreasing score (ties keep their order) """
+    segments = _segment_ids(offsets)
+    order = np.lexsort((-scores, segments))
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[order] = np.arange(len(scores)) - offsets[segments[order]]
+    return ranks
+
+
+def _group_scores(run, qid):
+    start, end = run._query_slice(qid)
+    grouped = {}
+    for docid, score in zip(run._vocab[run._docs[start:end]].tolist(), run._scores[start:end].tolist()):
+        grouped.setdefault(docid, []).append(score)
+    return grouped
+
+
+class _ResultsView(Mapping):
+    """A read-only ``{qid: {docid: score}}`` view of a TrecRun that builds each query's dict on first access. The dicts
+    are cached, so they are returned as read-only ``MappingProxyType`` views that cannot be modified."""
+
+    def __init__(self, run):
+        self._run = run
+        self._cache = {}
+
+    def __getitem__(self, qid):
+        if qid not in self._cache:
+            start, end = self._run._query_slice(qid)
+            docids = self._run._vocab[self._run._docs[start:end]].tolist()
+            self._cache[qid] = MappingProxyType(dict(zip(docids, self._run._scores[start:end].tolist())))
+        return self._cache[qid]
+
+    def __iter__(self):
+        return iter(self._run._qids.tolist())
+
+    def __len__(self):
+        return len(self._run._qids)
+
+    def __contains__(self, qid):
+        return qid in self._run._qid_index
+
 
 class TrecRun:
+    """A run containing a score for each ``(qid, docid)`` pair.
+
+    Runs are stored in columnar form: the qids in order, an offsets array giving each qid's slice of the entries,
+    each entry's docid as an integer code into a sorted array of unique docids, and a float32 score array. Operations
+    are vectorized over these arrays, and ``results`` provides a lazy ``{qid: {docid: score}}`` view for compatibility.
+
+    The view (and ``run[qid]``) is read-only: modifying a query's results raises a ``TypeError``. Use ``to_dict`` to
+    obtain a mutable copy, and create a new TrecRun from it.
+    """
+
     # hashlib.md5(json.dumps(mrl.results, sort_keys=True).encode()).hexdigest()
 
     def __init__(self, results):
-        if isinstance(results, dict):
-            self.results = {str(qid): {docid: score for docid, score in results[qid].items()} for qid in results}
+        if isinstance(results, TrecRun):
+            self._set_columns(results._qids, results._offsets, results._docs, results._vocab, results._scores)
+        elif isinstance(results, Mapping):
+            self._set_from_dict(results)
+        elif isinstance(results, str) and os.path.exists(results):
+            self._set_from_file(results)
         elif isinstance(results, str):
-            self.results = {}
+            parsed = {}
             with smart_open.open(results) as f:
                 for line in f:
                     fields = line.strip().split()
                     if len(fields) > 0:
                         qid, _, docid, rank, score = fields[:5]
                         score = float(score)
-                        self.results.setdefault(qid, {})
+                        parsed.setdefault(qid, {})
 
-                        if docid in self.results[qid]:
-                            score = max(score, self.results[qid][docid])
-                        self.results[qid][docid] = score
+                        if docid in parsed[qid]:
+                            score = max(score, parsed[qid][docid])
+                        parsed[qid][docid] = score
 
-            if not self.results:
+            if not parsed:
                 raise IOError("provided path contained no results: %s" % results)
+            self._set_from_dict(parsed)
         else:
             raise ValueError("results must be a dict or a string containing a path")
 
+    def _set_from_file(self, fn):
+        qids, offsets, docs, vocab, scores = load_trec_run_columns(fn)
+        if not qids:
+            raise IOError("provided path contained no results: %s" % fn)
+
+        self._set_columns(np.array(qids, dtype=object), offsets, docs, vocab, scores)
+
+        keys = _segment_ids(self._offsets) * len(self._vocab) + self._docs
+        if len(np.unique(keys)) != len(keys):
+            # a docid appears more than once for a query, so keep its first position and its max score
+            self._set_from_dict(
+                {
+                    qid: {docid: max(docscores) for docid, docscores in _group_scores(self, qid).items()}
+                    for qid in self._qids.tolist()
+                }
+            )
+
+    def _set_from_dict(self, results):
+        qids = [str(qid) for qid in results]
+        lengths = [len(results[qid]) for qid in results]
+        docids = np.array([docid for qid in results for docid in results[qid]], dtype=object)
+        scores = np.fromiter((score for qid in results for score in results[qid].values()), dtype=np.float32, count=len(docids))
+
+        vocab, docs = np.unique(docids.astype(str), return_inverse=True) if len(docids) else (np.array([], dtype=str), docids)
+        self._set_columns(np.array(qids, dtype=object), np.cumsum([0] + lengths), docs, vocab.astype(object), scores)
+
+    def _set_columns(self, qids, offsets, docs, vocab, scores):
+        self._qids = np.asarray(qids, dtype=object)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._docs = np.asarray(docs, dtype=np.int64)
+        self._vocab = np.asarray(vocab, dtype=object)
+        self._scores = np.asarray(scores, dtype=np.float32)
+        self._qid_index = {qid: idx for idx, qid in enumerate(self._qids.tolist())}
+        self._results = None
+
+    @classmethod
+    def _from_columns(cls, qids, offsets, docs, vocab, scores):
+        run = cls.__new__(cls)
+        run._set_columns(qids, offsets, docs, vocab, scores)
+        return run
+
+    def _select(self, mask, scores=None):
+        """ Return a new TrecRun containing the entries where ``mask`` is True, keeping every qid """
+        scores = self._scores if scores is None else scores
+        lengths = _segment_reduce(np.add, mask, self._offsets, 0).astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return TrecRun._from_columns(self._qids, offsets, self._docs[mask], self._vocab, scores[mask])
+
+    def _query_slice(self, qid):
+        idx = self._qid_index[qid]
+        return self._offsets[idx], self._offsets[idx + 1]
+
+    def _keys(self, qids, vocab):
+        """ Return an int64 key identifying each entry's (qid, docid) pair, using the given sorted qid and docid arrays """
+        qid_codes = np.searchsorted(qids, self._qids.astype(str))
+        doc_codes = np.searchsorted(vocab, self._vocab.astype(str))
+        return qid_codes[_segment_ids(self._offsets)] * len(vocab) + doc_codes[self._docs]
+
+    def _shared_keys(self, other):
+        """ Return entry keys for this run and ``other`` that are comparable with each other """
+        qids = np.union1d(self._qids.astype(str), other._qids.astype(str))
+        vocab = np.union1d(self._vocab.astype(str), other._vocab.astype(str))
+        return self._keys(qids, vocab), other._keys(qids, vocab)
+
+    @property
+    def results(self):
+        if self._results is None:
+            self._results = _ResultsView(self)
+        return self._results
+
+    def to_dict(self):
+        """ Return the run as a ``{qid: {docid: score}}`` dict """
+        return {qid: dict(docscores) for qid, docscores in self.results.items()}
+
     def _arithmetic_op(self, other, operator):
         if isinstance(other, TrecRun):
-            try:
-                results = {
-                    qid: {docid: operator(score, other.results[qid][docid]) for docid, score in self.results[qid].items()}
-                    for qid in self.results
-                }
-            except KeyError:
-                raise ValueError(
-                    "both TrecRuns must contain the same qids and docids; perhaps you should intersect or concat first?"
-                )
+            self_keys, other_keys = self._shared_keys(other)
+            if len(self_keys) == 0 or len(other_keys) == 0:
+                if len(self_keys) > 0:
+                    raise ValueError(
+                        "both TrecRuns must contain the same qids and docids; perhaps you should intersect or concat first?"
+                    )
+                other_scores = other._scores[:0]
+            else:
+                order = np.argsort(other_keys, kind="stable")
+                positions = order[np.minimum(np.searchsorted(other_keys, self_keys, sorter=order), len(order) - 1)]
+                if not np.array_equal(other_keys[positions], self_keys):
+                    raise ValueError(
+                        "both TrecRuns must contain the same qids and docids; perhaps you should intersect or concat first?"
+                    )
+                other_scores = other._scores[positions]
         else:
-            scalar = other
-            results = {
-                qid: {docid: operator(score, scalar) for docid, score in self.results[qid].items()} for qid in self.results
-            }
+            other_scores = other
 
-        return TrecRun(results)
+        return TrecRun._from_columns(self._qids, self._offsets, self._docs, self._vocab, operator(self._scores, other_scores))
 
     def add(self, other):
         return self._arithmetic_op(other, operator.add)
@@ -62,27 +217,24 @@ class TrecRun:
         return self._arithmetic_op(other, operator.truediv)
 
     def topk(self, k):
-        results = {}
-        for qid, docscores in self.results.items():
-            if len(docscores) > k:
-                results[qid] = dict(sorted(docscores.items(), key=lambda x: x[1], reverse=True)[:k])
-            else:
-                results[qid] = docscores.copy()
-
-        return TrecRun(results)
+        return self._select(_ranks(self._scores, self._offsets) < k)
 
     def intersect(self, other):
         if not isinstance(other, TrecRun):
             raise NotImplementedError()
 
-        shared_results = {
-            qid: {docid: score for docid, score in self.results[qid].items() if docid in other.results[qid]}
-            for qid in self.results.keys() & other.results.keys()
-        }
-        return TrecRun(shared_results)
+        self_keys, other_keys = self._shared_keys(other)
+        shared_qids = np.array([qid in other._qid_index for qid in self._qids.tolist()], dtype=bool)
+        mask = np.isin(self_keys, other_keys) & shared_qids[_segment_ids(self._offsets)]
+        run = self._select(mask)
+
+        lengths = np.diff(run._offsets)[shared_qids]
+        return TrecRun._from_columns(
+            run._qids[shared_qids], np.concatenate([[0], np.cumsum(lengths)]), run._docs, run._vocab, run._scores
+        )
 
     def qids(self):
-        return set(self.results.keys())
+        return set(self._qids.tolist())
 
     def union_qids(self, other, shared_qids="disallow"):
         if not isinstance(other, TrecRun):
@@ -91,68 +243,86 @@ class TrecRun:
         if shared_qids == "disallow":
             if self.qids().intersection(other.qids()):
                 raise ValueError("inputs share some qids but shared_qids='disallow'")
-
-            new_results = deepcopy(self.results)
-            new_results.update(deepcopy(other.results))
         else:
             raise NotImplementedError("only disallow is implemented")
 
-        return TrecRun(new_results)
+        vocab = np.union1d(self._vocab.astype(str), other._vocab.astype(str))
+        docs = np.concatenate(
+            [
+                np.searchsorted(vocab, self._vocab.astype(str))[self._docs],
+                np.searchsorted(vocab, other._vocab.astype(str))[other._docs],
+            ]
+        )
+        offsets = np.concatenate([self._offsets, other._offsets[1:] + self._offsets[-1]])
+        return TrecRun._from_columns(
+            np.concatenate([self._qids, other._qids]),
+            offsets,
+            docs,
+            vocab.astype(object),
+            np.concatenate([self._scores, other._scores]),
+        )
 
     def concat(self, other):
-        results = {qid: {docid: score for docid, score in self.results[qid].items()} for qid in self.results}
-        new_results = {
-            qid: {docid: score for docid, score in other.results[qid].items() if docid not in self.results[qid]}
-            for qid in other.results
-            if qid in self.results
-        }
-
-        for qid in new_results:
-            if len(new_results[qid]) == 0:
-                continue
-
-            mn, mx = min(other[qid]), max(other[qid])
-            newmx = min(results[qid]) - 1e-3
-            newmn = newmx - (mx - mn)
-            a = (newmx - newmn) / (mx - mn)
-            b = mx - a * mx
-
-            for docid, score in new_results[qid].items():
-                results[qid][docid] = a * score + b
-
-        return TrecRun(results)
+        """Add the docs from ``other`` that are missing from this run, rescaling their scores per query to fall below this
+        run's scores.
+
+        Only qids present in this run are kept.
+        """
+
+        self_keys, other_keys = self._shared_keys(other)
+        shared_qids = np.array([qid in self._qid_index for qid in other._qids.tolist()], dtype=bool)
+        new = other._select(~np.isin(other_keys, self_keys) & shared_qids[_segment_ids(other._offsets)])
+
+        # shift other's scores for each query so that its max score falls just below this run's min score
+        self_idx = np.array([self._qid_index.get(qid, -1) for qid in other._qids.tolist()], dtype=np.int64)
+        self_mins = _segment_reduce(np.minimum, self._scores, self._offsets, np.inf)[self_idx]
+        other_maxs = _segment_reduce(np.maximum, other._scores, other._offsets, 0)
+        shifts = np.where(np.isfinite(self_mins), self_mins - 1e-3 - other_maxs, 0)
+        new_scores = new._scores + shifts[_segment_ids(new._offsets)]
+
+        # place each query's new docs after its existing docs
+        vocab = np.union1d(self._vocab.astype(str), other._vocab.astype(str))
+        docs = np.concatenate(
+            [
+                np.searchsorted(vocab, self._vocab.astype(str))[self._docs],
+                np.searchsorted(vocab, new._vocab.astype(str))[new._docs],
+            ]
+        )
+        segments = np.concatenate([_segment_ids(self._offsets), self_idx[_segment_ids(new._offsets)]])
+        sources = np.concatenate([np.zeros(len(self._scores), dtype=np.int64), np.ones(len(new_scores), dtype=np.int64)])
+        order = np.lexsort((sources, segments))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(segments, minlength=len(self._qids)))])
+
+        return TrecRun._from_columns(
+            self._qids, offsets, docs[order], vocab.astype(object), np.concatenate([self._scores, new_scores])[order]
+        )
 
     def difference(self, other):
-        results = {
-            qid: {docid: score for docid, score in self.results[qid].items() if docid not in other.results.get(qid, {})}
-            for qid in self.results
-        }
-        return TrecRun(results)
+        self_keys, other_keys = self._shared_keys(other)
+        return self._select(~np.isin(self_keys, other_keys))
 
     def normalize(self, method="rr"):
-        normalization_funcs = {"minmax": sklearn.preprocessing.minmax_scale, "standard": sklearn.preprocessing.scale}
+        segments = _segment_ids(self._offsets)
+        scores = self._scores.astype(np.float64)
 
         if method == "rr":
-            sorted_results = {
-                qid: sorted(((docid, score) for docid, score in self.results[qid].items()), key=lambda x: x[1], reverse=True)
-                for qid in self.results
-            }
-            results = {
-                qid: {docid: 1 / (idx + 1) for idx, (docid, old_score) in enumerate(sorted_results[qid])}
-                for qid in sorted_results
-            }
-        elif method in normalization_funcs:
-            results = {qid: {} for qid in self.results}
-            for qid in self.results:
-                docids, scores = zip(*self.results[qid].items())
-                results[qid] = dict(zip(docids, normalization_funcs[method](scores)))
+            normalized = 1 / (_ranks(self._scores, self._offsets) + 1)
+        elif method == "minmax":
+            mins = _segment_reduce(np.minimum, scores, self._offsets, 0)[segments]
+            span = _segment_reduce(np.maximum, scores, self._offsets, 0)[segments] - mins
+            # like sklearn's minmax_scale, a query whose scores are all equal is scaled to 0
+            normalized = (scores - mins) / np.where(span == 0, 1, span)
+        elif method == "standard":
+            lengths = np.maximum(np.diff(self._offsets), 1)
+            means = (_segment_reduce(np.add, scores, self._offsets, 0) / lengths)[segments]
+            stds = np.sqrt(_segment_reduce(np.add, (scores - means) ** 2, self._offsets, 0) / lengths)[segments]
+            normalized = (scores - means) / np.where(stds == 0, 1, stds)
         else:
             raise ValueError(f"unknown method: {method}")
 
-        return TrecRun(results)
+        return TrecRun._from_columns(self._qids, self._offsets, self._docs, self._vocab, normalized)
 
     def __getitem__(self, k):
-        # TODO is it ok to NOT return a copy here?
         return self.results[k]
 
     def __and__(self, other):
@@ -183,33 +353,51 @@ class TrecRun:
         return self.multiply(-1)
 
     def __len__(self):
-        return sum(len(x) for x in self.results.values())
+        return len(self._scores)
 
     def __eq__(self, other):
         if isinstance(other, TrecRun):
-            return self.results == other.results
+            return self.to_dict() == other.to_dict()
         return NotImplemented
 
     def write_trec_run(self, outfn, tag="capreolus"):
-        preds = self.results
-        count = 0
-        with open(outfn, "wt") as outf:
-            qids = sorted(preds.keys())
-            for qid in qids:
-                rank = 1
-                for docid, score in sorted(preds[qid].items(), key=lambda x: x[1], reverse=True):
-                    print(f"{qid} Q0 {docid} {rank} {score} {tag}", file=outf)
-                    rank += 1
-                    count += 1
+        qid_order = np.argsort(self._qids.astype(str), kind="stable")
+        qid_rank = np.empty(len(qid_order), dtype=np.int64)
+        qid_rank[qid_order] = np.arange(len(qid_order))
+
+        segments = _segment_ids(self._offsets)
+        order = np.lexsort((-self._scores, qid_rank[segments]))
+        ranks = _ranks(self._scores, self._offsets)[order] + 1
+
+        qids = self._qids[segments[order]]
+        docids = self._vocab[self._docs[order]]
+        scores = self._scores[order].astype(str)
+        write_trec_run_columns(outfn, qids.tolist(), docids.tolist(), ranks.tolist(), scores.tolist(), tag)
 
     def remove_unjudged_documents(self, qrels):
-        results = {
-            qid: {docid: score for docid, score in self.results[qid].items() if docid in qrels[qid]} for qid in self.results
-        }
-        return TrecRun(results)
+        mask = np.zeros(len(self._scores), dtype=bool)
+        for idx, qid in enumerate(self._qids.tolist()):
+            start, end = self._offsets[idx], self._offsets[idx + 1]
+            judged = qrels[qid]
+            mask[start:end] = [docid in judged for docid in self._vocab[self._docs[start:end]].tolist()]
+        return self._select(mask)
 
     def evaluate(self, qrels, metrics, relevance_level=1, average_only=True):
-        return eval_runs(self.results, qrels, metrics, relevance_level, average_only)
+        from capreolus.evaluator import RunEvaluator
+
+        run_evaluator = RunEvaluator(qrels, metrics, relevance_level)
+        if not run_evaluator.native:
+            return eval_runs(self.to_dict(), qrels, list(metrics), relevance_level, average_only)
+
+        qids, scores = run_evaluator.evaluate_columns(
+            self._qids.tolist(), self._offsets, self._docs, self._vocab, self._scores.astype(np.float64)
+        )
+        avg_metrics = dict(zip(run_evaluator.metrics, scores.mean(axis=0).tolist()))
+        if average_only:
+            return avg_metrics
+
+        per_query_metrics = {qid: dict(zip(run_evaluator.metrics, row.tolist())) for qid, row in zip(qids, scores)}
+        return avg_metrics, per_query_metrics
 
 
 def eval_runs(runs, qrels, metrics, relevance_level, average_only=True):
@@ -1,7 +1,10 @@
 import hashlib
 import logging
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 from collections import OrderedDict
 from glob import glob
 
@@ -29,6 +32,42 @@ class Anserini:
 
         raise Exception("could not find anserini fat jar")
 
+    @classmethod
+    def get_helper_classpath(cls, cache_path):
+        """Return a directory containing capreolus' Java helpers compiled against the Anserini fat jar, compiling them on
+        first use. Returns None if they cannot be compiled (e.g., when no JDK is installed)."""
+        source = os.path.join(os.path.dirname(__file__), "java", "capreolus", "BulkFields.java")
+        fat_jar = cls.get_fat_jar()
+        with open(source, "rb") as f:
+            key = hashlib.md5(f.read() + fat_jar.encode("utf-8")).hexdigest()
+
+        outdir = os.path.join(cache_path, "java", key)
+        if os.path.exists(os.path.join(outdir, "capreolus", "BulkFields.class")):
+            return outdir
+
+        javac = shutil.which("javac")
+        if javac is None:
+            logger.warning("javac not found; Anserini stored fields will be read with one JNI call per document")
+            return None
+
+        os.makedirs(os.path.dirname(outdir), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(outdir))
+        try:
+            subprocess.run(
+                [javac, "-classpath", fat_jar, "-d", tmpdir, source], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            os.rename(tmpdir, outdir)
+        except subprocess.CalledProcessError as e:
+            logger.warning("failed to compile %s: %s", source, e.stdout.decode("utf-8", errors="replace"))
+            return None
+        except OSError:
+            # another process compiled the helpers first
+            pass
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        return outdir
+
     @classmethod
     def filter_and_log_anserini_output(cls, line, logger):
         """ Ignore DEBUG lines and require other lines pass our logging level """
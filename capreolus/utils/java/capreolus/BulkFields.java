@@ -0,0 +1,76 @@
+package capreolus;
+
+import java.io.IOException;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.Comparator;
+import java.util.Set;
+
+import org.apache.lucene.index.IndexReader;
+import org.apache.lucene.index.MultiTerms;
+import org.apache.lucene.index.PostingsEnum;
+import org.apache.lucene.index.Terms;
+import org.apache.lucene.index.TermsEnum;
+import org.apache.lucene.search.DocIdSetIterator;
+import org.apache.lucene.util.BytesRef;
+
+/**
+ * Reads stored fields for many documents in one call, so that Python pays for a single JNI crossing per batch rather
+ * than several per document.
+ */
+public class BulkFields {
+  /** Returns the Lucene docid of each external docid, or -1 for docids that are not in the index. */
+  public static int[] luceneDocids(IndexReader reader, String[] docids) throws IOException {
+    int[] luceneIds = new int[docids.length];
+    Arrays.fill(luceneIds, -1);
+
+    Terms terms = MultiTerms.getTerms(reader, "id");
+    if (terms == null) {
+      return luceneIds;
+    }
+
+    // seek in sorted order so that the terms dictionary is read front to back
+    Integer[] order = argsort(docids.length, Comparator.comparing(i -> docids[i]));
+    TermsEnum termsEnum = terms.iterator();
+    PostingsEnum postings = null;
+    for (int i : order) {
+      if (termsEnum.seekExact(new BytesRef(docids[i]))) {
+        postings = termsEnum.postings(postings, PostingsEnum.NONE);
+        int doc = postings.nextDoc();
+        luceneIds[i] = doc == DocIdSetIterator.NO_MORE_DOCS ? -1 : doc;
+      }
+    }
+
+    return luceneIds;
+  }
+
+  /** Returns the stored field of each Lucene docid (null for negative docids), reading documents in docid order. */
+  public static String[] storedFields(IndexReader reader, int[] luceneIds, String field) throws IOException {
+    String[] values = new String[luceneIds.length];
+    Set<String> fieldsToLoad = Collections.singleton(field);
+
+    // reading in docid order keeps access to the stored fields file sequential
+    Integer[] order = argsort(luceneIds.length, Comparator.comparingInt(i -> luceneIds[i]));
+    for (int i : order) {
+      if (luceneIds[i] >= 0) {
+        values[i] = reader.document(luceneIds[i], fieldsToLoad).get(field);
+      }
+    }
+
+    return values;
+  }
+
+  /** Returns the stored field of each external docid, or null for docids that are not in the index. */
+  public static String[] documentFields(IndexReader reader, String[] docids, String field) throws IOException {
+    return storedFields(reader, luceneDocids(reader, docids), field);
+  }
+
+  private static Integer[] argsort(int length, Comparator<Integer> comparator) {
+    Integer[] order = new Integer[length];
+    for (int i = 0; i < length; i++) {
+      order[i] = i;
+    }
+    Arrays.sort(order, comparator);
+    return order;
+  }
+}
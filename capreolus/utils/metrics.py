@@ -0,0 +1,223 @@
+import numpy as np
+
+CUTOFF_METRICS = {"P", "ndcg_cut", "recall", "judged"}
+FULL_METRICS = {"map", "recip_rank"}
+
+
+def parse_metric(metric):
+    """ Split ``metric`` into its name and cutoff (e.g., ``"ndcg_cut_20"`` becomes ``("ndcg_cut", 20)``) """
+    if metric in FULL_METRICS:
+        return metric, None
+
+    name, _, cutoff = metric.rpartition("_")
+    if name not in CUTOFF_METRICS or not cutoff.isdigit():
+        raise ValueError(f"unsupported metric: {metric}")
+
+    return name, int(cutoff)
+
+
+def is_supported(metric):
+    try:
+        parse_metric(metric)
+    except ValueError:
+        return False
+    return True
+
+
+def max_cutoff(metrics):
+    """ Return the deepest rank needed to compute ``metrics``, or None if any metric depends on the full ranking """
+    parsed = [parse_metric(metric) for metric in metrics]
+    if any(name in FULL_METRICS for name, _ in parsed):
+        return None
+    return max([cutoff for _, cutoff in parsed] + [0])
+
+
+def top_candidates(scores, depth):
+    """Return the indices of the ``scores`` that can appear in the top ``depth`` results, using ``argpartition``
+    rather than a full sort. Every doc tied with the ``depth``-th best score is kept, so that ties can still be broken by
+    docid. The indices are not sorted by score."""
+
+    scores = np.asarray(scores)
+    if not depth or len(scores) <= depth:
+        return np.arange(len(scores))
+
+    kth_score = scores[np.argpartition(-scores, depth - 1)[depth - 1]]
+    return np.flatnonzero(scores >= kth_score)
+
+
+def judged_at(judged_docs, docids, scores, cutoffs):
+    """Return the fraction of the top ``k`` docs that are judged for each ``k`` in ``cutoffs`` with a single top-K pass
+
+    Args:
+        judged_docs: a set (or dict) containing the query's judged docids
+        docids (list): the query's retrieved docids
+        scores (array): the corresponding scores
+        cutoffs (list): the ``k`` values to compute
+
+    Returns:
+        an array containing one value per cutoff, which is 0 if there are no retrieved docs
+    """
+
+    cutoffs = np.asarray(cutoffs, dtype=np.int64)
+    if len(docids) == 0:
+        return np.zeros(len(cutoffs))
+
+    scores = np.asarray(scores, dtype=np.float64)
+    candidates = top_candidates(scores, int(cutoffs.max()))
+    # order the candidates by decreasing docid, so that a stable sort on score breaks ties like trec_eval
+    candidate_docids = np.asarray([docids[idx] for idx in candidates], dtype=str)
+    candidates = candidates[np.argsort(candidate_docids, kind="stable")[::-1]]
+    ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+    judged_counts = np.cumsum([docids[idx] in judged_docs for idx in ranked])
+    depths = np.minimum(cutoffs, len(docids))
+    return judged_counts[depths - 1] / depths
+
+
+def _query_judgements(q_qrels, docids, relevance_level):
+    """ Return the label and judged flag of each doc in ``docids``, and the qrels' relevant count and ideal gains """
+    labels = np.array([q_qrels.get(docid, 0) for docid in docids], dtype=np.float64)
+    judged = np.array([docid in q_qrels for docid in docids], dtype=bool)
+
+    q_labels = np.fromiter(q_qrels.values(), dtype=np.float64, count=len(q_qrels))
+    ideal_gains = np.sort(q_labels[q_labels > 0])[::-1]
+    return labels, judged, (q_labels >= relevance_level).sum(), ideal_gains
+
+
+def _evaluate_segments(offsets, docids, scores, labels, judged, nrel, ideal_gains, metrics, relevance_level):
+    """Compute metrics for rankings stored as contiguous segments of the flat ``docids``, ``scores``, ``labels`` and
+    ``judged`` arrays, where segment ``i`` spans ``offsets[i]:offsets[i + 1]``. ``nrel`` and ``ideal_gains`` contain each
+    segment's number of relevant docs and decreasing positive qrels labels."""
+
+    parsed = [parse_metric(metric) for metric in metrics]
+    nsegments = len(offsets) - 1
+    lengths = np.diff(offsets)
+    segments = np.repeat(np.arange(nsegments), lengths)
+    out = np.zeros((nsegments, len(metrics)))
+    if len(scores) == 0:
+        return out
+
+    # rank each segment by decreasing score, breaking ties by decreasing docid like trec_eval
+    _, docid_codes = np.unique(np.asarray(docids, dtype=str), return_inverse=True)
+    order = np.lexsort((-docid_codes, -np.asarray(scores, dtype=np.float64), segments))
+    ranks = np.arange(1, len(order) + 1) - offsets[segments]
+    labels, judged = labels[order], judged[order]
+    relevant = labels >= relevance_level
+
+    def segment_sum(values):
+        return np.bincount(segments, weights=values, minlength=nsegments)
+
+    nrel = np.asarray(nrel, dtype=np.float64)
+    discounts = 1 / np.log2(ranks + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for metric_idx, (name, cutoff) in enumerate(parsed):
+            if name == "P":
+                out[:, metric_idx] = segment_sum(relevant & (ranks <= cutoff)) / cutoff
+            elif name == "recall":
+                out[:, metric_idx] = np.where(nrel > 0, segment_sum(relevant & (ranks <= cutoff)) / nrel, 0)
+            elif name == "map":
+                cumulative = np.cumsum(relevant)
+                segment_relevant = cumulative - np.concatenate(([0], cumulative))[offsets[:-1]][segments]
+                out[:, metric_idx] = np.where(nrel > 0, segment_sum(relevant * segment_relevant / ranks) / nrel, 0)
+            elif name == "recip_rank":
+                np.maximum.at(out[:, metric_idx], segments, np.where(relevant, 1 / ranks, 0))
+            elif name == "ndcg_cut":
+                dcg = segment_sum(np.where(ranks <= cutoff, np.maximum(labels, 0) * discounts, 0))
+                ideal = ideal_gains[:, :cutoff]
+                idcg = (ideal / np.log2(np.arange(2, ideal.shape[1] + 2))).sum(axis=1)
+                out[:, metric_idx] = np.where(idcg > 0, dcg / idcg, 0)
+            elif name == "judged":
+                out[:, metric_idx] = np.where(
+                    lengths > 0, segment_sum(judged & (ranks <= cutoff)) / np.maximum(np.minimum(lengths, cutoff), 1), 0
+                )
+
+    return out
+
+
+def _pad_ideal_gains(ideal_gains):
+    padded = np.zeros((len(ideal_gains), max([len(gains) for gains in ideal_gains] + [1])))
+    for idx, gains in enumerate(ideal_gains):
+        padded[idx, : len(gains)] = gains
+    return padded
+
+
+def evaluate_columns(qrels, qids, offsets, docids, scores, metrics, relevance_level=1):
+    """Compute per-query metrics for a run stored in columnar form (see ``capreolus.utils.trec.load_trec_run_columns``).
+
+    The results match pytrec_eval (and capreolus' ``judged_k``), including trec_eval's tie breaking by decreasing docid.
+
+    Args:
+        qrels: dict containing relevance judgements in the format ``{qid: {docid: label}}``
+        qids (list): the run's qids, which must all be present in ``qrels``
+        offsets (array): ``len(qids) + 1`` offsets, so that ``qids[i]``'s results are at ``offsets[i]:offsets[i + 1]``
+        docids (array): the docid of each result
+        scores (array): the score of each result
+        metrics (list): metrics to calculate (see ``parse_metric``)
+        relevance_level (int): relevance label threshold to use with non-graded metrics
+
+    Returns:
+        an array of shape ``(len(qids), len(metrics))``
+    """
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    labels, judged = np.zeros(len(docids)), np.zeros(len(docids), dtype=bool)
+    nrel, ideal_gains = np.zeros(len(qids)), []
+    for idx, qid in enumerate(qids):
+        start, end = offsets[idx], offsets[idx + 1]
+        labels[start:end], judged[start:end], nrel[idx], q_ideal_gains = _query_judgements(
+            qrels[qid], docids[start:end], relevance_level
+        )
+        ideal_gains.append(q_ideal_gains)
+
+    return _evaluate_segments(
+        offsets, docids, scores, labels, judged, nrel, _pad_ideal_gains(ideal_gains), metrics, relevance_level
+    )
+
+
+def evaluate_dense(qrels, qids, docids, scores, metrics, relevance_level=1):
+    """Compute per-query metrics for several rankings of each query's candidate docs in one vectorized pass.
+
+    Docs with a score of ``-inf`` are treated as not retrieved.
+
+    Args:
+        qrels: dict containing relevance judgements in the format ``{qid: {docid: label}}``
+        qids (list): the qids to evaluate, which must all be present in ``qrels``
+        docids (list): an array of candidate docids for each qid
+        scores (list): a ``(nrankings, len(docids[i]))`` score array for each qid, with one ranking per row
+        metrics (list): metrics to calculate (see ``parse_metric``)
+        relevance_level (int): relevance label threshold to use with non-graded metrics
+
+    Returns:
+        an array of shape ``(len(qids), nrankings, len(metrics))``
+    """
+
+    nrankings = scores[0].shape[0] if scores else 0
+    segment_docids, segment_scores, segment_labels, segment_judged = [], [], [], []
+    lengths, nrel, ideal_gains = [], [], []
+    for idx, qid in enumerate(qids):
+        q_docids, q_scores = np.asarray(docids[idx], dtype=str), np.asarray(scores[idx], dtype=np.float64)
+        labels, judged, q_nrel, q_ideal_gains = _query_judgements(qrels[qid], q_docids, relevance_level)
+        for ranking in range(nrankings):
+            retrieved = q_scores[ranking] != -np.inf
+            segment_docids.append(q_docids[retrieved])
+            segment_scores.append(q_scores[ranking][retrieved])
+            segment_labels.append(labels[retrieved])
+            segment_judged.append(judged[retrieved])
+            lengths.append(retrieved.sum())
+            nrel.append(q_nrel)
+            ideal_gains.append(q_ideal_gains)
+
+    if not lengths:
+        return np.zeros((len(qids), nrankings, len(metrics)))
+
+    out = _evaluate_segments(
+        np.cumsum([0] + lengths),
+        np.concatenate(segment_docids),
+        np.concatenate(segment_scores),
+        np.concatenate(segment_labels),
+        np.concatenate(segment_judged),
+        nrel,
+        _pad_ideal_gains(ideal_gains),
+        metrics,
+        relevance_level,
+    )
+    return out.reshape(len(qids), nrankings, len(metrics))
@@ -3,6 +3,10 @@ import os
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 
+import numpy as np
+
+SIDECAR_DIR = ".runcache"
+
 
 def load_ntcir_topics(fn):
     topics = {}
@@ -99,6 +103,86 @@ def load_qrels(qrelfile, qids=None, include_spam=True):
     return labels
 
 
+def _get_sidecar_path(runfn):
+    runfn = str(runfn)
+    return os.path.join(os.path.dirname(runfn), SIDECAR_DIR, os.path.basename(runfn) + ".run.npz")
+
+
+def load_trec_run_columns(runfn, sidecar=False):
+    """Parse a TREC run file into columns, keeping the order of docids within each qid.
+
+    The whole file is decoded at once with pandas' C parser rather than line by line. If ``sidecar`` is True, the
+    columns are also saved to a binary ``.run.npz`` sidecar (in the run file's ``.runcache`` directory) that later
+    calls load instead of parsing the file again, as long as the run file's size and mtime have not changed.
+
+    Returns:
+        a ``(qids, offsets, docs, vocab, scores)`` tuple, where ``qids`` is in order of first appearance and qid ``i``'s
+        entries are ``docs[offsets[i]:offsets[i + 1]]`` and ``scores[offsets[i]:offsets[i + 1]]``. Each entry's docid
+        is stored as an int32 code into ``vocab``, the sorted array of unique docids, so entry ``j``'s docid is
+        ``vocab[docs[j]]``.
+    """
+
+    import pandas as pd
+
+    stat = os.stat(runfn)
+    sidecar_fn = _get_sidecar_path(runfn)
+    if sidecar and os.path.exists(sidecar_fn):
+        data = np.load(sidecar_fn)
+        # sidecars written before docids were stored as codes lack a vocab, and are rebuilt
+        if "vocab" in data.files and data["stat"].tolist() == [stat.st_size, stat.st_mtime_ns]:
+            vocab = data["vocab"].tobytes().decode("utf-8").split("\0") if data["vocab"].size else []
+            return data["qids"].tolist(), data["offsets"], data["docs"], np.array(vocab, dtype=object), data["scores"]
+
+    try:
+        df = pd.read_csv(
+            runfn,
+            sep=r"\s+",
+            header=None,
+            usecols=[0, 2, 4],
+            dtype={0: str, 2: str, 4: np.float64},
+            na_filter=False,
+            engine="c",
+            # match float() on every score, so that scores and tie order match the line-by-line loader
+            float_precision="round_trip",
+        )
+        rows_qids, rows_docids, rows_scores = df[0].to_numpy(), df[2].to_numpy(dtype=object), df[4].to_numpy()
+    except pd.errors.EmptyDataError:
+        rows_qids, rows_docids, rows_scores = np.array([], dtype=object), np.array([], dtype=object), np.array([])
+
+    # group rows by qid (in order of first appearance) while keeping each qid's rows in file order
+    codes, qids = pd.factorize(rows_qids)
+    order = np.argsort(codes, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(qids)))]).astype(np.int64)
+    qids, scores = list(qids), rows_scores[order]
+    docs, vocab = pd.factorize(rows_docids[order], sort=True)
+    docs, vocab = docs.astype(np.int32), np.asarray(vocab, dtype=object)
+
+    if sidecar:
+        os.makedirs(os.path.dirname(sidecar_fn), exist_ok=True)
+        tmp_fn = f"{sidecar_fn}.tmp_{os.getpid()}"
+        with open(tmp_fn, "wb") as outf:
+            np.savez(
+                outf,
+                stat=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+                qids=np.array(qids, dtype=str),
+                offsets=offsets,
+                docs=docs,
+                # docids are stored as one "\0"-joined UTF-8 string rather than a fixed-width unicode array
+                vocab=np.frombuffer("\0".join(vocab.tolist()).encode("utf-8"), dtype=np.uint8),
+                scores=scores,
+            )
+        os.replace(tmp_fn, sidecar_fn)
+
+    return qids, offsets, docs, vocab, scores
+
+
+def write_trec_run_columns(outfn, qids, docids, ranks, scores, tag):
+    """ Write one run file line per entry in the given columns (already in output order) with a single write """
+    lines = [f"{qid} Q0 {docid} {rank} {score} {tag}\n" for qid, docid, rank, score in zip(qids, docids, ranks, scores)]
+    with open(outfn, "wt") as outf:
+        outf.write("".join(lines))
+
+
 def document_to_trectxt(docno, txt):
     s = f"<DOC>\n<DOCNO> {docno} </DOCNO>\n"
     s += f"<TEXT>\n{txt}\n</TEXT>\n</DOC>\n"